@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Compare cache hit latency and memory use of cachecontrol backends behind
+`cachecontrolware.CacheMiddleware`. Each backend runs in its own process;
+responses come from an in-memory connection pool.
+
+    python benchmarks/bench_cache_backends.py [--entries N] [--body-kb N]
+
+Memory is reported from /proc/self/status where available: `anon` is heap
+and other private memory, `file` is mapped file pages (page cache shared
+between processes).
+"""
+
+from __future__ import print_function
+
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+from cachecontrol.cache import DictCache
+
+from requests_middleware import MiddlewareHTTPAdapter
+from requests_middleware.utils import BufferedBody
+from requests_middleware.contrib.cachecontrolware import CacheMiddleware
+from requests_middleware.contrib.cachecontrolcache import LRUCache, MmapCache
+
+
+class StubPool(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def urlopen(self, method, url, **kwargs):
+        return HTTPResponse(
+            body=BufferedBody(self.body),
+            headers={
+                'Content-Length': str(len(self.body)),
+                'Cache-Control': 'max-age=3600',
+                'Date': time.strftime(
+                    '%a, %d %b %Y %H:%M:%S GMT', time.gmtime()
+                ),
+            },
+            status=200,
+            preload_content=False,
+        )
+
+
+class StubMiddlewareHTTPAdapter(MiddlewareHTTPAdapter):
+
+    def __init__(self, pool, *args, **kwargs):
+        self.pool = pool
+        super(StubMiddlewareHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+        return self.pool
+
+
+def memory():
+    usage = {}
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key in ('RssAnon', 'RssFile'):
+                    usage[key] = int(value.split()[0]) / 1024.0
+    except IOError:
+        usage['RssAnon'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return usage
+
+
+def run(name, entries, body_kb, hits, queue):
+    directory = tempfile.mkdtemp()
+    body = b'x' * (body_kb * 1024)
+    caches = {
+        'DictCache': lambda: DictCache(),
+        'LRUCache': lambda: LRUCache(max_bytes=2 * entries * len(body)),
+        'MmapCache': lambda: MmapCache(directory),
+    }
+    try:
+        adapter = StubMiddlewareHTTPAdapter(
+            StubPool(body), [CacheMiddleware(cache=caches[name]())],
+        )
+        urls = ['http://bench.local/{0}'.format(idx) for idx in range(entries)]
+        requests_ = [requests.Request('GET', url).prepare() for url in urls]
+        before = memory()
+        for request in requests_:
+            adapter.send(request.copy()).content
+        began = time.time()
+        for idx in range(hits):
+            response = adapter.send(requests_[idx % entries].copy())
+            assert response.raw.from_cache
+            response.content
+        latency = (time.time() - began) / hits * 1e6
+        after = memory()
+        queue.put((name, latency, before, after))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=64)
+    parser.add_argument('--body-kb', type=int, default=1024)
+    parser.add_argument('--hits', type=int, default=500)
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    for name in ('DictCache', 'LRUCache', 'MmapCache'):
+        process = multiprocessing.Process(
+            target=run, args=(name, args.entries, args.body_kb, args.hits, queue),
+        )
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise SystemExit('{0} benchmark failed'.format(name))
+        name, latency, before, after = queue.get()
+        print('{0:<10} {1:10.1f} us/hit  anon {2:+8.1f} MB  file {3:+8.1f} MB'.format(
+            name, latency,
+            after.get('RssAnon', 0) - before.get('RssAnon', 0),
+            after.get('RssFile', 0) - before.get('RssFile', 0),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Measure per-request overhead of `MiddlewareHTTPAdapter` relative to a
+plain `HTTPAdapter`. The network is replaced by an in-memory connection pool,
+so timings reflect Python overhead only.
+
+    python benchmarks/bench_dispatch.py [--requests N] [--middlewares N]
+"""
+
+from __future__ import print_function
+
+import io
+import timeit
+import argparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import HTTPResponse
+
+from requests_middleware import MiddlewareHTTPAdapter, BaseMiddleware
+from requests_middleware.instrument import Instrumentation
+
+
+class StubPool(object):
+
+    def urlopen(self, method, url, **kwargs):
+        return HTTPResponse(
+            body=io.BytesIO(b'content'),
+            headers={'Content-Length': '7'},
+            status=200,
+            preload_content=False,
+        )
+
+
+class StubTransport(object):
+    """Mixin that replaces connection lookup with an in-memory pool."""
+
+    pool = StubPool()
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                       cert=None):
+        return self.pool
+
+
+class StubHTTPAdapter(StubTransport, HTTPAdapter):
+    pass
+
+
+class StubMiddlewareHTTPAdapter(StubTransport, MiddlewareHTTPAdapter):
+    pass
+
+
+class NoopMiddleware(BaseMiddleware):
+    pass
+
+
+class HeaderMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        request.headers['X-Bench'] = '1'
+
+
+def measure(adapter, count):
+    request = requests.Request('GET', 'http://bench.local/').prepare()
+    timer = timeit.Timer(lambda: adapter.send(request).content)
+    best = min(timer.repeat(repeat=5, number=count))
+    return best / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--middlewares', type=int, default=8)
+    args = parser.parse_args()
+
+    noop = [NoopMiddleware() for _ in range(args.middlewares)]
+    mixed = [
+        HeaderMiddleware() if idx % 2 else NoopMiddleware()
+        for idx in range(args.middlewares)
+    ]
+    cases = [
+        ('HTTPAdapter', StubHTTPAdapter()),
+        ('MiddlewareHTTPAdapter (empty)', StubMiddlewareHTTPAdapter()),
+        ('MiddlewareHTTPAdapter ({0} no-op)'.format(args.middlewares),
+         StubMiddlewareHTTPAdapter(noop)),
+        ('MiddlewareHTTPAdapter ({0} mixed)'.format(args.middlewares),
+         StubMiddlewareHTTPAdapter(mixed)),
+        ('MiddlewareHTTPAdapter ({0} mixed, timed)'.format(args.middlewares),
+         StubMiddlewareHTTPAdapter(mixed, instrumentation=Instrumentation())),
+    ]
+
+    baseline = None
+    for name, adapter in cases:
+        per_request = measure(adapter, args.requests)
+        if baseline is None:
+            baseline = per_request
+        print('{0:<40} {1:8.2f} us/request  {2:+8.2f} us'.format(
+            name, per_request, per_request - baseline,
+        ))
+
+
+if __name__ == '__main__':
+    main()
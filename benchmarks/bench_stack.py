@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""Measure throughput and latency percentiles of adapters and middleware
+stacks against a local HTTP server, at several thread counts.
+
+    python benchmarks/bench_stack.py [--requests N] [--threads 1,8,32]
+        [--cases SUBSTRING ...] [--json PATH] [--compare BASELINE.json]
+
+Each case sends `--requests` GET requests per thread count through one
+shared adapter, cycling over `--urls` distinct pages, after one warm-up pass
+over those pages (so caches and robots.txt are populated). Pages are
+cacheable for an hour except under `/nocache/` and `/gzip/`, which serves
+them gzip-encoded. Besides each contrib middleware alone, the `full stack`
+cases run every installed contrib middleware together. Cases whose
+optional dependencies are missing are skipped.
+
+`--json` writes the results, with environment metadata, as JSON (`-` for
+stdout). `--compare` prints the change in throughput and p99 latency from a
+previous `--json` file, for comparing releases.
+"""
+
+from __future__ import print_function
+
+import io
+import ssl
+import sys
+import gzip
+import json
+import time
+import argparse
+import platform
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves import BaseHTTPServer, socketserver
+
+import requests_middleware
+from requests_middleware import MiddlewareHTTPAdapter, compat
+from requests_middleware import contrib
+from requests_middleware.contrib import (
+    breakerware, cachecontrolware, coalesceware, compressware, dnsware,
+    httpcacheware, poolware, retryware, robotware, sourceware, sslware,
+    throttleware,
+)
+
+
+ROBOTS = b'User-agent: *\nAllow: /\n'
+
+IP = '127.0.0.1'
+LOCALHOST = 'localhost'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'x' * 1024
+    gzipped = None
+
+    def do_GET(self):
+        encoding = None
+        if self.path == '/robots.txt':
+            body, cache_control = ROBOTS, 'max-age=3600'
+        elif self.path.startswith('/nocache/'):
+            body, cache_control = self.body, 'no-store'
+        elif self.path.startswith('/gzip/'):
+            body, cache_control = self.gzipped, 'no-store'
+            encoding = 'gzip'
+        else:
+            body, cache_control = self.body, 'max-age=3600'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def gzip_bytes(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as fp:
+        fp.write(data)
+    return buffer.getvalue()
+
+
+def start_server(body_bytes):
+    Handler.body = b'x' * body_bytes
+    Handler.gzipped = gzip_bytes(Handler.body)
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def throttle():
+    return throttleware.ThrottleMiddleware(
+        throttleware.KeyedThrottler(lambda: throttleware.DelayThrottler(0))
+    )
+
+
+def robots():
+    return robotware.RobotsMiddleware(
+        cache=robotware.bounded_robots_cache_class()(),
+    )
+
+
+def resolve_local(host):
+    return ['127.0.0.1'], None
+
+
+def full_stack():
+    """Every contrib middleware whose dependencies are installed, in the
+    order their documentation recommends. httpcacheware and
+    `RotatingSourceMiddleware` are left out, being alternatives to
+    cachecontrolware and `SourceMiddleware`.
+    """
+    middlewares = [
+        retryware.RetryMiddleware(budget=retryware.RetryBudget()),
+        breakerware.CircuitBreakerMiddleware(),
+    ]
+    if contrib.available('cachecontrol'):
+        middlewares.append(cachecontrolware.CacheMiddleware())
+    middlewares.append(coalesceware.CoalesceMiddleware())
+    if contrib.available('robots'):
+        middlewares.append(robots())
+    middlewares.extend([
+        throttle(),
+        compressware.CompressionMiddleware(),
+        dnsware.DNSCacheMiddleware(resolver=resolve_local),
+        poolware.PoolMiddleware(),
+        sourceware.SourceMiddleware('127.0.0.1', 0),
+        sslware.SSLMiddleware(),
+    ])
+    return middlewares
+
+
+def cases():
+    """Yield (name, host, path prefix, middleware factory or `None` for a
+    plain `HTTPAdapter`) for each case whose dependencies are installed.
+    Cases with `localhost` resolve it through `DNSCacheMiddleware`.
+    """
+    yield 'HTTPAdapter', IP, '/page/', None
+    yield 'MiddlewareHTTPAdapter (empty)', IP, '/page/', lambda: []
+    yield 'throttleware', IP, '/page/', lambda: [throttle()]
+    yield 'coalesceware', IP, '/nocache/', lambda: [
+        coalesceware.CoalesceMiddleware()
+    ]
+    yield 'breakerware', IP, '/page/', lambda: [
+        breakerware.CircuitBreakerMiddleware()
+    ]
+    yield 'retryware', IP, '/page/', lambda: [
+        retryware.RetryMiddleware(budget=retryware.RetryBudget())
+    ]
+    yield 'compressware (gzip)', IP, '/gzip/', lambda: [
+        compressware.CompressionMiddleware()
+    ]
+    yield 'dnsware', LOCALHOST, '/page/', lambda: [
+        dnsware.DNSCacheMiddleware(resolver=resolve_local)
+    ]
+    yield 'poolware', IP, '/page/', lambda: [poolware.PoolMiddleware()]
+    yield 'sourceware', IP, '/page/', lambda: [
+        sourceware.SourceMiddleware('127.0.0.1', 0)
+    ]
+    yield 'sourceware (4 addresses)', IP, '/page/', lambda: [
+        sourceware.RotatingSourceMiddleware(
+            ['127.0.0.{0}'.format(idx) for idx in range(1, 5)],
+            sourceware.LEAST_LOADED,
+        )
+    ]
+    yield 'sslware', IP, '/page/', lambda: [
+        sslware.SSLMiddleware(ssl.PROTOCOL_SSLv23)
+    ]
+    if contrib.available('cachecontrol'):
+        yield 'cachecontrolware (hit)', IP, '/page/', lambda: [
+            cachecontrolware.CacheMiddleware()
+        ]
+        yield 'cachecontrolware (miss)', IP, '/nocache/', lambda: [
+            cachecontrolware.CacheMiddleware()
+        ]
+    if contrib.available('httpcache'):
+        yield 'httpcacheware (hit)', IP, '/page/', lambda: [
+            httpcacheware.CacheMiddleware(capacity=10000)
+        ]
+    if contrib.available('robots'):
+        yield 'robotware', IP, '/page/', lambda: [robots()]
+    if contrib.available('cachecontrol') and contrib.available('robots'):
+        yield 'cache + robots + throttle (miss)', IP, '/nocache/', lambda: [
+            cachecontrolware.CacheMiddleware(), robots(), throttle(),
+        ]
+        yield (
+            'cache + coalesce + robots + throttle (hit)', IP, '/page/',
+            lambda: [
+                cachecontrolware.CacheMiddleware(),
+                coalesceware.CoalesceMiddleware(),
+                robots(),
+                throttle(),
+            ],
+        )
+    yield 'full stack (hit)', LOCALHOST, '/page/', full_stack
+    yield 'full stack (miss)', LOCALHOST, '/nocache/', full_stack
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_case(adapter, urls, threads, count):
+    """Send `count` requests from `threads` threads; return elapsed seconds,
+    sorted latencies and the number of failed requests.
+    """
+    headers = {'User-Agent': 'requests-middleware-bench'}
+    prepared = [
+        requests.Request('GET', url, headers=headers).prepare()
+        for url in urls
+    ]
+    per_thread = count // threads
+    latencies = [[] for _ in range(threads)]
+    errors = [0] * threads
+    start = threading.Event()
+    timer = compat.perf_counter
+
+    def worker(offset):
+        start.wait()
+        samples = latencies[offset]
+        for idx in range(per_thread):
+            request = prepared[(offset + idx * threads) % len(prepared)]
+            began = timer()
+            try:
+                response = adapter.send(request.copy(), timeout=30)
+                response.content
+                response.close()
+            except Exception:
+                errors[offset] += 1
+            samples.append(timer() - began)
+
+    workers = [
+        threading.Thread(target=worker, args=(offset, ))
+        for offset in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    began = timer()
+    start.set()
+    for thread in workers:
+        thread.join()
+    elapsed = timer() - began
+    ordered = sorted(sample for samples in latencies for sample in samples)
+    return elapsed, ordered, sum(errors)
+
+
+def measure(name, host, path, factory, port, threads, args):
+    urls = [
+        'http://{0}:{1}{2}{3}'.format(host, port, path, idx)
+        for idx in range(args.urls)
+    ]
+    if factory is None:
+        adapter = HTTPAdapter(pool_maxsize=threads)
+    else:
+        adapter = MiddlewareHTTPAdapter(factory(), pool_maxsize=threads)
+    try:
+        run_case(adapter, urls, threads, len(urls) * threads)
+        elapsed, ordered, errors = run_case(
+            adapter, urls, threads, args.requests,
+        )
+    finally:
+        adapter.close()
+    millis = [sample * 1000 for sample in ordered]
+    return {
+        'case': name,
+        'threads': threads,
+        'requests': len(ordered),
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput': len(ordered) / elapsed,
+        'latency_ms': {
+            'mean': sum(millis) / len(millis),
+            'p50': percentile(millis, 0.5),
+            'p90': percentile(millis, 0.9),
+            'p99': percentile(millis, 0.99),
+            'max': millis[-1],
+        },
+    }
+
+
+def metadata(args):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'requests_middleware': requests_middleware.__version__,
+        'requests': requests.__version__,
+        'requests_per_case': args.requests,
+        'urls': args.urls,
+        'body_bytes': args.body_bytes,
+    }
+
+
+def compare(results, path, out):
+    with open(path) as fp:
+        baseline = dict(
+            ((row['case'], row['threads']), row)
+            for row in json.load(fp)['results']
+        )
+    print('\nChange from {0}:'.format(path), file=out)
+    for row in results:
+        old = baseline.get((row['case'], row['threads']))
+        if old is None:
+            continue
+        print('{0:<45} {1:>3} threads  throughput {2:+7.1%}  '
+              'p99 {3:+7.1%}'.format(
+                  row['case'], row['threads'],
+                  row['throughput'] / old['throughput'] - 1,
+                  row['latency_ms']['p99'] / old['latency_ms']['p99'] - 1,
+              ), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', default='1,8,32')
+    parser.add_argument('--urls', type=int, default=50)
+    parser.add_argument('--body-bytes', type=int, default=1024)
+    parser.add_argument('--cases', nargs='*', default=[])
+    parser.add_argument('--json')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+    thread_counts = [int(value) for value in args.threads.split(',')]
+
+    server = start_server(args.body_bytes)
+    port = server.server_address[1]
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = []
+    try:
+        for name, host, path, factory in cases():
+            if args.cases and not any(part in name for part in args.cases):
+                continue
+            for threads in thread_counts:
+                row = measure(name, host, path, factory, port, threads, args)
+                results.append(row)
+                latency = row['latency_ms']
+                print('{0:<45} {1:>3} threads {2:>9,.0f} req/s  '
+                      'p50 {3:7.2f}  p99 {4:7.2f} ms  errors {5}'.format(
+                          name, threads, row['throughput'],
+                          latency['p50'], latency['p99'], row['errors'],
+                      ), file=out)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    document = {'meta': metadata(args), 'results': results}
+    if args.json == '-':
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+    elif args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(document, fp, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare, out)
+
+
+if __name__ == '__main__':
+    main()
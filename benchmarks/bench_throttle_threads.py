@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Stress the throttle and robots bookkeeping from many threads and report
+throughput. Network access is not involved; each operation is one `check`
+and one `store` (or one `check_crawl_delay` for robots).
+
+    python benchmarks/bench_throttle_threads.py [--ops N] [--hosts N]
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+import requests
+
+from requests_middleware import contrib
+from requests_middleware.contrib import robotware, throttleware
+
+
+THREAD_COUNTS = (1, 8, 64)
+
+
+class StubRobotsCache(object):
+
+    def delay(self, url, agent):
+        return 0
+
+
+def throttler_op(throttler):
+    def op(idx, host):
+        throttler.check(None)
+        throttler.store(None, None, None)
+    return op
+
+
+def keyed_op(throttler, hosts):
+    requests_by_host = dict(
+        (host, requests.Request('GET', 'http://{0}/'.format(host)).prepare())
+        for host in hosts
+    )
+
+    def op(idx, host):
+        request = requests_by_host[host]
+        throttler.check(request)
+        throttler.store(request, None, None)
+    return op
+
+
+def robots_op(middleware):
+    def op(idx, host):
+        middleware.check_crawl_delay('http://{0}/page'.format(host), 'bench')
+    return op
+
+
+def run(op, threads, ops, hosts):
+    per_thread = ops // threads
+    start = threading.Event()
+
+    def worker(offset):
+        start.wait()
+        for idx in range(per_thread):
+            op(idx, hosts[(offset + idx) % len(hosts)])
+
+    workers = [
+        threading.Thread(target=worker, args=(offset, ))
+        for offset in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    began = time.time()
+    start.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - began
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ops', type=int, default=128000)
+    parser.add_argument('--hosts', type=int, default=256)
+    args = parser.parse_args()
+    hosts = ['host{0}.test'.format(idx) for idx in range(args.hosts)]
+
+    cases = [
+        ('DelayThrottler', lambda: throttler_op(
+            throttleware.DelayThrottler(0))),
+        ('RequestsPerHourThrottler', lambda: throttler_op(
+            throttleware.RequestsPerHourThrottler(10 ** 9))),
+        ('KeyedThrottler(DelayThrottler)', lambda: keyed_op(
+            throttleware.KeyedThrottler(
+                lambda: throttleware.DelayThrottler(0)), hosts)),
+    ]
+    if contrib.available('robots'):
+        def make_robots():
+            middleware = robotware.RobotsMiddleware()
+            middleware.cache = StubRobotsCache()
+            return robots_op(middleware)
+        cases.append(('RobotsMiddleware.check_crawl_delay', make_robots))
+
+    for name, factory in cases:
+        for threads in THREAD_COUNTS:
+            rate = run(factory(), threads, args.ops, hosts)
+            print('{0:<40} {1:>3} threads {2:>12,.0f} ops/s'.format(
+                name, threads, rate,
+            ))
+
+
+if __name__ == '__main__':
+    main()
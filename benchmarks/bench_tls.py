@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Measure TLS connection setup cost with and without `sslware`'s shared
+context and session resumption, against a local HTTPS server using a
+self-signed certificate (generated with the `openssl` command).
+
+    python benchmarks/bench_tls.py [--requests N] [--key-type rsa:2048]
+
+The server closes the connection after every response, so each request
+reconnects as it would after a keep-alive timeout.
+"""
+
+from __future__ import print_function
+
+import os
+import ssl
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves import BaseHTTPServer, socketserver
+
+from requests_middleware import MiddlewareHTTPAdapter, compat
+from requests_middleware.contrib import sslware
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '7')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'content')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+def make_cert(directory, key_type):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', key_type, '-nodes',
+        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost',
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return cert, key
+
+
+def start_server(cert, key):
+    server = Server(('127.0.0.1', 0), Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def cases():
+    yield 'HTTPAdapter', None
+    yield 'sslware (shared context)', lambda: sslware.SSLMiddleware(
+        max_sessions=0,
+    )
+    yield 'sslware (shared context + resumption)', sslware.SSLMiddleware
+
+
+def measure(factory, url, cert, count):
+    middleware = None
+    if factory is None:
+        adapter = HTTPAdapter()
+    else:
+        middleware = factory()
+        adapter = MiddlewareHTTPAdapter([middleware])
+    session = requests.Session()
+    session.mount('https://', adapter)
+    try:
+        session.get(url, verify=cert).content
+        began = compat.perf_counter()
+        for _ in range(count):
+            session.get(url, verify=cert).content
+        elapsed = compat.perf_counter() - began
+    finally:
+        session.close()
+    stats = middleware.stats() if middleware is not None else None
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--key-type', default='rsa:2048')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cert, key = make_cert(directory, args.key_type)
+        server = start_server(cert, key)
+        url = 'https://localhost:{0}/'.format(server.server_address[1])
+        try:
+            for name, factory in cases():
+                elapsed, stats = measure(factory, url, cert, args.requests)
+                line = '{0:<40} {1:8.0f} req/s  {2:7.3f} ms/request'.format(
+                    name, args.requests / elapsed,
+                    elapsed / args.requests * 1000,
+                )
+                if stats is not None:
+                    line += '  resumed {0}/{1}'.format(
+                        stats['resumed'], stats['handshakes'],
+                    )
+                print(line)
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""asyncio counterpart to :class:`MiddlewareHTTPAdapter`. Requires Python 3
+and `aiohttp`, which provides the default transport.
+"""
+
+import asyncio
+import inspect
+
+import aiohttp
+from requests import Response, Request
+from requests.exceptions import ConnectionError, Timeout
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.response import HTTPResponse
+from requests.packages.urllib3._collections import HTTPHeaderDict
+
+from .middleware import MiddlewareStack, is_local, local_response
+from .utils import BufferedBody
+
+
+async def resolve(value):
+    """Await `value` if it is awaitable; else return it unchanged."""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class AiohttpTransport(object):
+    """Send `PreparedRequest` objects with an `aiohttp.ClientSession` and
+    return fully read urllib3 `HTTPResponse` objects, so that middlewares
+    written for :class:`MiddlewareHTTPAdapter` see the same types. Content
+    decoding is left to `requests`, as with `HTTPAdapter`.
+
+    :param int limit: Maximum number of simultaneous connections
+    :param int limit_per_host: Maximum simultaneous connections per host
+    """
+    def __init__(self, limit=100, limit_per_host=0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                ),
+                auto_decompress=False,
+                skip_auto_headers=('User-Agent', 'Accept-Encoding'),
+            )
+        return self.session
+
+    async def send(self, request, timeout=None, verify=True):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        else:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+        session = self.get_session()
+        try:
+            async with session.request(
+                request.method,
+                request.url,
+                data=request.body,
+                headers=dict(request.headers),
+                allow_redirects=False,
+                timeout=timeout,
+                ssl=None if verify else False,
+            ) as resp:
+                body = await resp.read()
+        except asyncio.TimeoutError as err:
+            raise Timeout(err, request=request)
+        except aiohttp.ClientError as err:
+            raise ConnectionError(err, request=request)
+        headers = HTTPHeaderDict()
+        for key, value in resp.raw_headers:
+            headers.add(key.decode('latin-1'), value.decode('latin-1'))
+        return HTTPResponse(
+            body=BufferedBody(body),
+            headers=headers,
+            status=resp.status,
+            reason=resp.reason,
+            preload_content=False,
+            decode_content=False,
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncMiddlewareHTTPAdapter(MiddlewareStack):
+    """Runs the :class:`BaseMiddleware <BaseMiddleware>` hook protocol on
+    asyncio. Hooks may be plain methods or coroutines, so existing
+    middlewares run unchanged; note that synchronous hooks that block (e.g.
+    a blocking throttler or a robots.txt fetch) block the event loop.
+    Redirects are not followed, as with `HTTPAdapter::send`.
+
+    :param list middlewares: List of :class:`BaseMiddleware <BaseMiddleware>`
+        objects
+    :param transport: Object with coroutine methods `send(request, timeout,
+        verify)`, returning a urllib3 `HTTPResponse`, and `close()`; defaults
+        to :class:`AiohttpTransport <AiohttpTransport>`
+    """
+    def __init__(self, middlewares=None, transport=None):
+        self.middlewares = middlewares or []
+        self._plan = self.build_plan()
+        self.transport = transport or AiohttpTransport()
+
+    async def request(self, method, url, **kwargs):
+        """Build, prepare and send a request. Keyword arguments `timeout` and
+        `verify` are passed to `send`; the rest are passed to `Request`.
+        """
+        send_kwargs = dict(
+            (key, kwargs.pop(key))
+            for key in ('timeout', 'verify')
+            if key in kwargs
+        )
+        prepared = Request(method, url, **kwargs).prepare()
+        return await self.send(prepared, **send_kwargs)
+
+    async def send(self, request, timeout=None, verify=True, **kwargs):
+        """Send the request. If any middleware in the stack returns a `Response`
+        or `HTTPResponse` value from its `before_send` method, short-circuit;
+        else delegate to the transport. Exceptions are passed to
+        `on_send_error` hooks, then re-raised unless a hook returned a
+        `Response`. As with :class:`MiddlewareHTTPAdapter`, a `Response`
+        returned from `before_send` is passed to the `on_local_response`
+        hooks of the middlewares before the one returning it. Middlewares
+        overriding `around_send` are not supported.
+
+        :param request: The :class:`PreparedRequest <PreparedRequest>`
+            being sent.
+        :returns: The :class:`Response <Response>` object.
+        """
+        kwargs.update(timeout=timeout, verify=verify)
+        plan = self.plan
+        if plan.around_send is not None:
+            raise TypeError('`around_send` middlewares are not supported by '
+                            '`AsyncMiddlewareHTTPAdapter`')
+        try:
+            for index, hook in enumerate(plan.before_send):
+                value = await resolve(hook(request, **kwargs))
+                if isinstance(value, Response):
+                    for exit_hook in plan.before_send_exits[index]:
+                        value = await resolve(exit_hook(request, value))
+                    return value
+                if isinstance(value, HTTPResponse):
+                    if is_local(value):
+                        return await self.build_local_response(request, value)
+                    return await self.build_response(request, value)
+                if value:
+                    raise ValueError('Middleware "before_send" methods must '
+                                     'return `Response`, `HTTPResponse`, or '
+                                     '`None`')
+            resp = await self.transport.send(
+                request, timeout=timeout, verify=verify,
+            )
+            return await self.build_response(request, resp)
+        except Exception as error:
+            recovered = None
+            for hook in plan.on_send_error:
+                value = await resolve(hook(request, error))
+                if recovered is None and isinstance(value, Response):
+                    recovered = value
+            if recovered is not None:
+                return recovered
+            raise
+
+    async def build_response(self, req, resp):
+        """Build the response, calling `before_build_response` and
+        `after_build_response` hooks as :class:`MiddlewareHTTPAdapter` does.
+        """
+        plan = self.plan
+        for hook in plan.before_build_response:
+            req, resp = await resolve(hook(req, resp))
+        response = HTTPAdapter.build_response(self, req, resp)
+        for hook in plan.after_build_response:
+            response = await resolve(hook(req, resp, response))
+        return response
+
+    async def build_local_response(self, req, resp):
+        """Build the response for a locally served `HTTPResponse`, calling
+        only `on_local_response` hooks as :class:`MiddlewareHTTPAdapter`
+        does.
+        """
+        response = local_response(self, req, resp)
+        for hook in self.plan.on_local_response:
+            response = await resolve(hook(req, response))
+        return response
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
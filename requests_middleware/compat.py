@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+try:
+    from time import monotonic, perf_counter
+except ImportError:  # Python 2
+    from time import time as monotonic
+    from timeit import default_timer as perf_counter
+
+__all__ = ['monotonic', 'perf_counter']
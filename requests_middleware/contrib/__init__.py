@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Contrib middlewares, loaded by name. Modules are imported by :func:`load`,
+and the third-party packages some middlewares depend on only when those
+middlewares are first created, so that importing contrib modules stays
+cheap.
+"""
+
+import importlib
+
+# Middleware name: (module, class, third-party modules required)
+MIDDLEWARES = {
+    'breaker': (
+        'requests_middleware.contrib.breakerware',
+        'CircuitBreakerMiddleware', (),
+    ),
+    'cachecontrol': (
+        'requests_middleware.contrib.cachecontrolware',
+        'CacheMiddleware', ('cachecontrol', ),
+    ),
+    'coalesce': (
+        'requests_middleware.contrib.coalesceware',
+        'CoalesceMiddleware', (),
+    ),
+    'compress': (
+        'requests_middleware.contrib.compressware',
+        'CompressionMiddleware', (),
+    ),
+    'dns': (
+        'requests_middleware.contrib.dnsware',
+        'DNSCacheMiddleware', (),
+    ),
+    'httpcache': (
+        'requests_middleware.contrib.httpcacheware',
+        'CacheMiddleware', ('httpcache', ),
+    ),
+    'pool': (
+        'requests_middleware.contrib.poolware',
+        'PoolMiddleware', (),
+    ),
+    'retry': (
+        'requests_middleware.contrib.retryware',
+        'RetryMiddleware', (),
+    ),
+    'robots': (
+        'requests_middleware.contrib.robotware',
+        'RobotsMiddleware', ('reppy', ),
+    ),
+    'rotating_source': (
+        'requests_middleware.contrib.sourceware',
+        'RotatingSourceMiddleware', (),
+    ),
+    'source': (
+        'requests_middleware.contrib.sourceware',
+        'SourceMiddleware', (),
+    ),
+    'ssl': (
+        'requests_middleware.contrib.sslware',
+        'SSLMiddleware', (),
+    ),
+    'throttle': (
+        'requests_middleware.contrib.throttleware',
+        'ThrottleMiddleware', (),
+    ),
+}
+
+
+def register(name, module, cls, requires=()):
+    """Make middleware class `cls` of `module` loadable as `name`.
+
+    :param str module: Dotted module path
+    :param str cls: Class name within `module`
+    :param requires: Third-party modules the middleware needs
+    """
+    MIDDLEWARES[name] = (module, cls, tuple(requires))
+
+
+def entry(name):
+    try:
+        return MIDDLEWARES[name]
+    except KeyError:
+        raise ValueError('Unknown middleware: {0}'.format(name))
+
+
+def load(name):
+    """Import and return the middleware class registered as `name`.
+
+    :raises: `ValueError` if `name` is not registered
+    """
+    module, cls, _ = entry(name)
+    return getattr(importlib.import_module(module), cls)
+
+
+def create(name, *args, **kwargs):
+    """Create the middleware registered as `name` with the given arguments.
+    Raises `ImportError` if a package it requires is missing.
+    """
+    return load(name)(*args, **kwargs)
+
+
+def available(name):
+    """Return whether the packages required by middleware `name` can be
+    imported. Importing them is the only reliable check, so this costs as
+    much as creating the middleware would.
+    """
+    for module in entry(name)[2]:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            return False
+    return True
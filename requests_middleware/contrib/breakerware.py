@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Per-host circuit breakers, failing requests to unhealthy hosts fast
+instead of waiting for their timeouts.
+"""
+
+import weakref
+import threading
+import collections
+
+from requests.exceptions import ConnectionError, RequestException, Timeout
+
+from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+from requests_middleware.utils import RollingWindow
+from requests_middleware.contrib.throttleware import scheme_host_key
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(RequestException):
+    """Raised instead of sending a request to a host whose circuit is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for one host. While closed, outcomes are counted over
+    the last `window` seconds; once at least `min_requests` were seen and
+    the share of failures reaches `failure_ratio`, the circuit opens and
+    :meth:`acquire` raises :class:`CircuitOpenError`. After `cooldown`
+    seconds it turns half-open and lets up to `probes` requests through at
+    a time: as many successes close it, any failure opens it again.
+
+    Outcomes of requests sent before the circuit last changed state are
+    ignored, so that requests in flight when it opens do not count
+    against the probes.
+
+    :param float failure_ratio: Share of failed requests opening the circuit
+    :param int min_requests: Requests in the window needed to open it
+    :param int window: Length of the window, in seconds
+    :param float cooldown: Seconds the circuit stays open
+    :param int probes: Requests let through while half-open
+    """
+    def __init__(self, failure_ratio=0.5, min_requests=20, window=10,
+                 cooldown=30.0, probes=1):
+        self.failure_ratio = failure_ratio
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.probes = probes
+        self.counts = RollingWindow(window)
+        self.state = CLOSED
+        self.changed = compat.monotonic()
+        self.in_flight = 0
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, now):
+        """Let a request through at `now` or raise `CircuitOpenError`.
+
+        :returns: `True` if the request is a half-open probe
+        """
+        with self.lock:
+            if self.state == OPEN and now - self.changed >= self.cooldown:
+                self.change(HALF_OPEN, now)
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and self.in_flight < self.probes:
+                self.in_flight += 1
+                return True
+            raise CircuitOpenError('Circuit open')
+
+    def record(self, sent, probe, failed, now):
+        """Record the outcome of a request let through at `sent`."""
+        with self.lock:
+            if probe:
+                self.in_flight -= 1
+            if sent < self.changed:
+                return
+            if self.state == HALF_OPEN:
+                if failed:
+                    self.change(OPEN, now)
+                elif probe:
+                    self.successes += 1
+                    if self.successes >= self.probes:
+                        self.change(CLOSED, now)
+            elif self.state == CLOSED:
+                self.counts.add(now, 1, int(failed))
+                requests, failures = self.counts.totals
+                tripped = requests >= self.min_requests
+                if tripped and failures >= self.failure_ratio * requests:
+                    self.change(OPEN, now)
+
+    def release(self, probe):
+        """Forget a request let through whose outcome says nothing about the
+        host, e.g. one served from a cache.
+        """
+        if probe:
+            with self.lock:
+                self.in_flight -= 1
+
+    def change(self, state, now):
+        """Called with `lock` held."""
+        self.state = state
+        self.changed = now
+        self.successes = 0
+        self.counts.clear()
+
+
+class CircuitBreakerMiddleware(BaseMiddleware):
+    """Keep a :class:`CircuitBreaker` per host and fail requests to hosts
+    whose circuit is open with :class:`CircuitOpenError` from `before_send`,
+    without taking a connection or waiting for a timeout. Connection errors,
+    timeouts, responses with a status in `failure_statuses` and, with
+    `slow_call_duration`, responses slower than it count as failures.
+    Breakers are kept in LRU order, at most `max_keys` of them.
+
+    With :class:`RetryMiddleware
+    <requests_middleware.contrib.retryware.RetryMiddleware>`, register the
+    breaker after it, so that each attempt counts and an open circuit
+    ends the retries; `CircuitOpenError` is not retried.
+
+    :param float failure_ratio: Share of failed requests opening a circuit
+    :param int min_requests: Requests in the window needed to open it
+    :param int window: Length of the window, in seconds
+    :param float cooldown: Seconds a circuit stays open
+    :param int probes: Requests let through while half-open
+    :param float slow_call_duration: Response time, in seconds, above which
+        a request counts as failed, or `None` to ignore latency
+    :param failure_statuses: Response statuses counted as failures
+    :param key: Callable mapping a `PreparedRequest` to its breaker key;
+        defaults to the scheme and host
+    :param int max_keys: Number of breakers kept
+    """
+    def __init__(self, failure_ratio=0.5, min_requests=20, window=10,
+                 cooldown=30.0, probes=1, slow_call_duration=None,
+                 failure_statuses=(500, 502, 503, 504), key=scheme_host_key,
+                 max_keys=10000):
+        self.options = {
+            'failure_ratio': failure_ratio,
+            'min_requests': min_requests,
+            'window': window,
+            'cooldown': cooldown,
+            'probes': probes,
+        }
+        self.slow_call_duration = slow_call_duration
+        self.failure_statuses = frozenset(failure_statuses)
+        self.key = key
+        self.max_keys = max_keys
+        self.breakers = collections.OrderedDict()
+        self.sent = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the breaker for `key`, creating it if necessary."""
+        with self.lock:
+            breaker = self.breakers.pop(key, None)
+            if breaker is None:
+                breaker = CircuitBreaker(**self.options)
+                while len(self.breakers) >= self.max_keys:
+                    self.breakers.popitem(last=False)
+            self.breakers[key] = breaker
+            return breaker
+
+    def states(self):
+        """Return the state of each breaker, by key."""
+        with self.lock:
+            return dict(
+                (key, breaker.state) for key, breaker in self.breakers.items()
+            )
+
+    def before_send(self, request, *args, **kwargs):
+        breaker = self.get(self.key(request))
+        now = compat.monotonic()
+        probe = breaker.acquire(now)
+        with self.lock:
+            self.sent[request] = (breaker, now, probe)
+
+    def pop(self, request):
+        with self.lock:
+            return self.sent.pop(request, None)
+
+    def after_build_response(self, req, resp, response):
+        sent = self.pop(req)
+        if sent is not None:
+            breaker, began, probe = sent
+            now = compat.monotonic()
+            slow = self.slow_call_duration is not None
+            slow = slow and now - began > self.slow_call_duration
+            failed = slow or response.status_code in self.failure_statuses
+            breaker.record(began, probe, failed, now)
+        return response
+
+    def on_local_response(self, req, response):
+        sent = self.pop(req)
+        if sent is not None:
+            sent[0].release(sent[2])
+        return response
+
+    def on_send_error(self, request, error):
+        sent = self.pop(request)
+        if sent is None:
+            return
+        breaker, began, probe = sent
+        if isinstance(error, (ConnectionError, Timeout)):
+            breaker.record(began, probe, True, compat.monotonic())
+        else:
+            breaker.release(probe)
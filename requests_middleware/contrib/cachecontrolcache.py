@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Cache backends for :class:`cachecontrolware.CacheMiddleware
+<requests_middleware.contrib.cachecontrolware.CacheMiddleware>`.
+"""
+
+import io
+import os
+import mmap
+import time
+import sqlite3
+import datetime
+import threading
+import collections
+
+from cachecontrol.cache import BaseCache, SeparateBodyBaseCache
+
+
+def expiry_deadline(expires):
+    """Convert a cachecontrol `expires` value (seconds from now or a UTC
+    `datetime`) to a wall-clock deadline, or `None` if it never expires.
+    """
+    if not expires:
+        return None
+    if isinstance(expires, datetime.datetime):
+        expires = (expires - datetime.datetime.utcnow()).total_seconds()
+    return time.time() + expires
+
+
+class LRUCache(BaseCache):
+    """Thread-safe in-memory cache bounded by the total size of its stored
+    values, evicting the least recently used entries first. Values larger
+    than `max_bytes` are not stored. Entries are dropped once their
+    cachecontrol expiry passes.
+
+    :param int max_bytes: Maximum total size of stored values, in bytes
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return None
+            value, deadline = entry
+            if deadline is not None and deadline <= time.time():
+                self.size -= len(value)
+                return None
+            self.data[key] = entry
+            return value
+
+    def set(self, key, value, expires=None):
+        with self.lock:
+            self._discard(key)
+            if len(value) > self.max_bytes:
+                return
+            self.data[key] = (value, expiry_deadline(expires))
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def delete(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class SliceReader(io.RawIOBase):
+    """Read-only file object over a `memoryview`, closing itself once fully
+    read as `http.client.HTTPResponse` does.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.closed:
+            return 0
+        count = min(len(buffer), len(self.view) - self.position)
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        if self.position >= len(self.view):
+            self.close()
+        return count
+
+    def close(self):
+        self.view = memoryview(b'')
+        super(SliceReader, self).close()
+
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS entries ('
+    ' key TEXT PRIMARY KEY, value BLOB, expires REAL,'
+    ' segment INTEGER, offset INTEGER, length INTEGER)',
+    'CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment)',
+    'CREATE TABLE IF NOT EXISTS segments ('
+    ' id INTEGER PRIMARY KEY, size INTEGER NOT NULL DEFAULT 0)',
+)
+
+
+class MmapCache(SeparateBodyBaseCache):
+    """File-backed cache shared by all processes using the same `directory`.
+    Response bodies are appended to segment files and served through `mmap`,
+    so cached bodies are read from the page cache rather than held on the
+    Python heap. Metadata lives in an SQLite index, whose write lock also
+    serializes appends across processes.
+
+    Segments are rotated once they reach `segment_bytes`; when the segments
+    together exceed `max_bytes`, the oldest segment and its entries are
+    dropped.
+
+    cachecontrol stores a response with `set` then `set_body`, so that a
+    concurrent reader may see the new metadata with the previous body in
+    between. The `StaleCacheController` of
+    :mod:`~requests_middleware.contrib.cachecontrolware` calls
+    :meth:`set_entry` instead, writing both at once.
+
+    :param str directory: Directory holding the index and segment files
+    :param int max_bytes: Maximum total size of segment files, in bytes
+    :param int segment_bytes: Size at which a new segment is started
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024,
+                 segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.local = threading.local()
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+        self.pid = os.getpid()
+        connection = self.connection
+        for statement in SCHEMA:
+            connection.execute(statement)
+
+    @property
+    def connection(self):
+        """SQLite connection for the current thread and process."""
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.connection = sqlite3.connect(
+                os.path.join(self.directory, 'index.sqlite'),
+                timeout=30,
+                isolation_level=None,
+            )
+            self.local.pid = pid
+        return self.local.connection
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-{0:08d}'.format(segment))
+
+    def get(self, key):
+        """Return the entry's metadata. Its body is opened at the same time
+        and handed to the following `get_body` call, so that the body cannot
+        be evicted in between.
+        """
+        self.local.pending = None
+        row = self.connection.execute(
+            'SELECT value, expires, segment, offset, length FROM entries '
+            'WHERE key = ?', (key, )
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, segment, offset, length = row
+        if length is None:
+            # Metadata written but body not yet stored
+            return None
+        if expires is not None and expires <= time.time():
+            self.delete(key)
+            return None
+        body = self._open(segment, offset, length)
+        if body is None:
+            return None
+        self.local.pending = (key, body)
+        return bytes(value)
+
+    def set(self, key, value, expires=None):
+        self.connection.execute(
+            'INSERT INTO entries (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'value = excluded.value, expires = excluded.expires',
+            (key, sqlite3.Binary(value), expiry_deadline(expires)),
+        )
+
+    def delete(self, key):
+        self.connection.execute('DELETE FROM entries WHERE key = ?', (key, ))
+
+    def set_body(self, key, body):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._append(connection, key, body)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def set_entry(self, key, value, body, expires=None):
+        """Store metadata `value` and `body` in one transaction, so that
+        readers see either the previous entry or the new one.
+        """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.set(key, value, expires)
+            self._append(connection, key, body)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _append(self, connection, key, body):
+        """Append `body` to the current segment and point the entry at it.
+        Called within a write transaction.
+        """
+        segment = self._current_segment(connection)
+        with open(self.segment_path(segment), 'ab') as fp:
+            offset = fp.tell()
+            fp.write(body)
+        size = offset + len(body)
+        connection.execute(
+            'UPDATE segments SET size = ? WHERE id = ?', (size, segment)
+        )
+        connection.execute(
+            'UPDATE entries SET segment = ?, offset = ?, length = ? '
+            'WHERE key = ?',
+            (segment, offset, len(body), key),
+        )
+        if size >= self.segment_bytes:
+            connection.execute(
+                'INSERT INTO segments (id) VALUES (?)', (segment + 1, )
+            )
+        self._evict(connection)
+
+    def get_body(self, key):
+        pending = getattr(self.local, 'pending', None)
+        self.local.pending = None
+        if pending is not None and pending[0] == key:
+            return pending[1]
+        row = self.connection.execute(
+            'SELECT segment, offset, length FROM entries WHERE key = ?', (key, )
+        ).fetchone()
+        if row is None or row[2] is None:
+            return None
+        return self._open(*row)
+
+    def _open(self, segment, offset, length):
+        if length == 0:
+            return SliceReader(memoryview(b''))
+        mapped = self._map(segment, offset + length)
+        if mapped is None:
+            return None
+        return SliceReader(memoryview(mapped)[offset:offset + length])
+
+    def _current_segment(self, connection):
+        row = connection.execute('SELECT MAX(id) FROM segments').fetchone()
+        if row[0] is not None:
+            return row[0]
+        connection.execute('INSERT INTO segments (id) VALUES (0)')
+        return 0
+
+    def _evict(self, connection):
+        segments = connection.execute(
+            'SELECT id, size FROM segments ORDER BY id'
+        ).fetchall()
+        total = sum(size for _, size in segments)
+        for segment, size in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            connection.execute(
+                'DELETE FROM entries WHERE segment = ?', (segment, )
+            )
+            connection.execute('DELETE FROM segments WHERE id = ?', (segment, ))
+            try:
+                os.remove(self.segment_path(segment))
+            except OSError:
+                pass
+            total -= size
+
+    def _map(self, segment, min_size):
+        """Return a read-only mapping of `segment` covering at least
+        `min_size` bytes, remapping if the segment has grown, or `None` if
+        the segment has been evicted.
+        """
+        with self.maps_lock:
+            if self.pid != os.getpid():
+                self.maps = {}
+                self.pid = os.getpid()
+            mapped = self.maps.get(segment)
+            if mapped is not None and len(mapped) >= min_size:
+                return mapped
+            try:
+                with open(self.segment_path(segment), 'rb') as fp:
+                    mapped = mmap.mmap(
+                        fp.fileno(), 0, access=mmap.ACCESS_READ
+                    )
+            except (IOError, OSError, ValueError):
+                self.maps.pop(segment, None)
+                return None
+            if len(mapped) < min_size:
+                return None
+            # Forget mappings of evicted segments; mappings still referenced
+            # by readers are closed once released
+            for old in [old for old in self.maps if old < segment]:
+                if not os.path.exists(self.segment_path(old)):
+                    del self.maps[old]
+            self.maps[segment] = mapped
+            return mapped
+
+    def close(self):
+        with self.maps_lock:
+            self.maps = {}
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.pid = None
@@ -1,46 +1,348 @@
 # -*- coding: utf-8 -*-
+"""Response caching with `cachecontrol`, which is imported when the first
+:class:`CacheMiddleware` is created.
+"""
 
+import mmap
+import time
+import weakref
+import calendar
+import tempfile
 import functools
+import threading
+from email.utils import parsedate_tz
 
-from cachecontrol.cache import DictCache
-from cachecontrol.controller import CacheController
-from cachecontrol.filewrapper import CallbackFileWrapper
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
-from requests_middleware import BaseMiddleware
+from requests_middleware import BaseMiddleware, MiddlewareHTTPAdapter
+from requests_middleware.middleware import mark_local
+from requests_middleware.utils import (
+    ERROR_STATUSES, Revalidator, lazy_subclass, stale_windows,
+)
 
 
 INVALIDATING_METHODS = set(['PUT', 'DELETE'])
 
 
+def parse_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return calendar.timegm(parsed[:6]) if parsed else None
+
+
+def staleness(controller, response):
+    """Return the number of seconds for which cached `response` has been
+    stale, negative while it is fresh, computed as `cachecontrol` does from
+    its `Date`, `max-age` and `Expires` headers; or `None` if it has no
+    valid `Date`.
+    """
+    headers = CaseInsensitiveDict(response.headers)
+    date = parse_date(headers.get('date'))
+    if date is None:
+        return None
+    lifetime = controller.parse_cache_control(headers).get('max-age')
+    if lifetime is None:
+        expires = parse_date(headers.get('expires'))
+        lifetime = max(0, expires - date) if expires is not None else 0
+    return max(0, time.time() - date) - lifetime
+
+
+class StaleCacheControllerMixin(object):
+    """`CacheController` supporting RFC 5861. Entries are kept in backends
+    that expire them for as long as their `stale-while-revalidate` or
+    `stale-if-error` window lasts, and the entry loaded by the current
+    thread's last `cached_request` is available from `last_loaded`, so that
+    a stale entry can be served after `cached_request` has declined it.
+    Backends with a
+    `set_entry` method, such as :class:`MmapCache
+    <requests_middleware.contrib.cachecontrolcache.MmapCache>`, store
+    metadata and body in one call. The class, `StaleCacheController`, is
+    returned by :func:`stale_cache_controller_class`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(StaleCacheControllerMixin, self).__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    def cached_request(self, request):
+        # Forget entries loaded by earlier requests, which `cached_request`
+        # may return before loading anything
+        self.local.loaded = None
+        return super(StaleCacheControllerMixin, self).cached_request(request)
+
+    def _load_from_cache(self, request):
+        response = super(StaleCacheControllerMixin, self)._load_from_cache(request)
+        self.local.loaded = (self.cache_url(request.url), response)
+        return response
+
+    def last_loaded(self, url):
+        """Return and forget the response last loaded by this thread, if it
+        was loaded for `url`.
+        """
+        loaded = getattr(self.local, 'loaded', None)
+        self.local.loaded = None
+        if loaded is None or loaded[0] != self.cache_url(url):
+            return None
+        return loaded[1]
+
+    def _cache_set(self, cache_url, request, response, body=None,
+                   expires_time=None):
+        if expires_time:
+            expires_time += max(
+                window or 0 for window in stale_windows(response.headers)
+            )
+        if body is not None and hasattr(self.cache, 'set_entry'):
+            # Store metadata and body together rather than in two steps
+            self.cache.set_entry(
+                cache_url,
+                self.serializer.dumps(request, response, b''),
+                body,
+                expires=expires_time,
+            )
+            return
+        super(StaleCacheControllerMixin, self)._cache_set(
+            cache_url, request, response, body, expires_time,
+        )
+
+
+def stale_cache_controller_class():
+    """Return :class:`StaleCacheController`, importing `cachecontrol` on
+    first use.
+    """
+    return lazy_subclass(
+        StaleCacheControllerMixin, 'cachecontrol.controller', 'CacheController',
+    )
+
+
+def content_length(response):
+    """Return the declared `Content-Length` of `response`, or `None`."""
+    value = response.headers.get('Content-Length', '')
+    return int(value) if value.isdigit() else None
+
+
+class SpoolingFileWrapper(object):
+    """Wrap the file object of an `HTTPResponse`, copying the body into an
+    anonymous temporary file chunk by chunk as the consumer reads it. Once
+    the underlying file is exhausted, `callback` is called with a read-only
+    `mmap` view of the whole body, so the body is never held on the heap.
+
+    Spooling is abandoned, and `callback` never called, once more than
+    `max_size` bytes have been read or if the response is closed before its
+    end; partial bodies are therefore never cached. Other attributes are
+    proxied to the wrapped file.
+
+    :param fp: File object to wrap
+    :param callback: Called with the complete body
+    :param int max_size: Largest body to spool, in bytes, or `None` for no
+        limit
+    :param str directory: Directory for the temporary file; see `tempfile`
+    """
+    def __init__(self, fp, callback, max_size=None, directory=None):
+        self._wrapped = fp
+        self._callback = callback
+        self._max_size = max_size
+        self._directory = directory
+        self._spool = None
+        self._size = 0
+
+    def __getattr__(self, name):
+        # Look up `_wrapped` directly so that a partially constructed
+        # wrapper raises `AttributeError` instead of recursing
+        return getattr(self.__getattribute__('_wrapped'), name)
+
+    def _exhausted(self):
+        fp = self._wrapped
+        if getattr(fp, 'fp', False) is None:
+            return True
+        return getattr(fp, 'closed', False)
+
+    def _write(self, data):
+        if self._callback is None or not data:
+            return
+        self._size += len(data)
+        if self._max_size is not None and self._size > self._max_size:
+            self._discard()
+            return
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile(dir=self._directory)
+        self._spool.write(data)
+
+    def _discard(self):
+        self._callback = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def _finish(self):
+        callback, spool = self._callback, self._spool
+        self._callback = self._spool = None
+        if callback is None:
+            return
+        try:
+            if spool is None:
+                callback(b'')
+            else:
+                spool.flush()
+                callback(memoryview(
+                    mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+                ))
+        finally:
+            # The mapping outlives the file; closing the file releases the
+            # disk space once the mapping is dropped
+            if spool is not None:
+                spool.close()
+
+    def _tee(self, data):
+        self._write(data)
+        if self._exhausted():
+            self._finish()
+        return data
+
+    def read(self, *args):
+        return self._tee(self._wrapped.read(*args))
+
+    def read1(self, *args):
+        return self._tee(self._wrapped.read1(*args))
+
+    def _safe_read(self, amt):
+        data = self._wrapped._safe_read(amt)
+        if amt == 2 and data == b'\r\n':
+            # Trailing CRLF of a chunk in chunked transfer encoding
+            return data
+        return self._tee(data)
+
+    def close(self):
+        if self._exhausted():
+            self._finish()
+        else:
+            self._discard()
+        self._wrapped.close()
+
+
 class CacheMiddleware(BaseMiddleware):
+    """Cache responses with `cachecontrol`. Response bodies are spooled to a
+    temporary file as they are read, and stored once fully read; responses
+    larger than `max_body_size` are passed through without being cached.
 
+    Stale responses are served as RFC 5861 allows. Within their
+    `stale-while-revalidate` window they are returned at once while a
+    background thread revalidates them through `adapter`. Within their
+    `stale-if-error` window they replace a connection error or a 5xx
+    response. Both require a controller with `last_loaded`, such as the
+    default :class:`StaleCacheController`. cachecontrol purges stale
+    responses without an `ETag`, so those are served stale only once before
+    being fetched again in full.
+
+    :param int max_body_size: Largest body to cache, in bytes, or `None` for
+        no limit
+    :param str spool_dir: Directory for spooled bodies; defaults to the
+        system temporary directory
+    :param adapter: Adapter sending background revalidations; defaults to a
+        `MiddlewareHTTPAdapter` holding only this middleware. A stack
+        including this middleware may be passed so that e.g. throttling
+        applies to revalidations.
+    :param int revalidate_workers: Number of background revalidation threads
+    """
     def __init__(self, cache=None, cache_etags=True, controller_class=None,
-                 serializer=None, heuristic=None):
-        self.cache = cache or DictCache()
+                 serializer=None, heuristic=None, max_body_size=None,
+                 spool_dir=None, adapter=None, revalidate_workers=4):
+        if cache is None:
+            from cachecontrol.cache import DictCache
+            cache = DictCache()
+        self.cache = cache
         self.heuristic = heuristic
-        controller_factory = controller_class or CacheController
+        self.max_body_size = max_body_size
+        self.spool_dir = spool_dir
+        controller_factory = controller_class or stale_cache_controller_class()
         self.controller = controller_factory(
             self.cache,
             cache_etags=cache_etags,
             serializer=serializer,
         )
+        self.adapter = adapter
+        self.revalidator = Revalidator(revalidate_workers)
+        self.revalidating = weakref.WeakSet()
+        self.fallbacks = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
 
     def before_send(self, request, *args, **kwargs):
         """Adapted from `CacheControlAdapter::send`. Check for cached response
-        and update request with conditional headers.
+        and update request with conditional headers. Serve stale responses
+        within their `stale-while-revalidate` window, and keep those within
+        their `stale-if-error` window in case sending fails.
         """
         if request.method == 'GET':
-            cached_resp = self.controller.cached_request(request)
-            if cached_resp:
-                return cached_resp
+            with self.lock:
+                revalidating = request in self.revalidating
+            if not revalidating:
+                cached_resp = self.controller.cached_request(request)
+                if cached_resp:
+                    cached_resp.from_cache = True
+                    return mark_local(cached_resp)
+                stale = self.serve_stale(request, kwargs)
+                if stale is not None:
+                    return stale
             request.headers.update(self.controller.conditional_headers(request))
 
+    def serve_stale(self, request, kwargs):
+        """Return the stale cached response for `request` if it may be
+        served while revalidating, scheduling the revalidation; if it may
+        only be served on error, keep it as the request's fallback.
+        """
+        last_loaded = getattr(self.controller, 'last_loaded', None)
+        cached = last_loaded(request.url) if last_loaded else None
+        if cached is None:
+            return None
+        age = staleness(self.controller, cached)
+        if age is None or age <= 0:
+            return None
+        cc = self.controller.parse_cache_control(request.headers)
+        if 'no-cache' in cc or 'max-age' in cc or 'min-fresh' in cc:
+            return None
+        while_revalidate, if_error = stale_windows(cached.headers)
+        if while_revalidate is not None and age <= while_revalidate:
+            self.revalidator.submit(
+                self.controller.cache_url(request.url),
+                self.revalidate, request, kwargs,
+            )
+            cached.from_cache = True
+            return mark_local(cached)
+        if if_error is not None and age <= if_error:
+            cached.from_cache = True
+            with self.lock:
+                self.fallbacks[request] = cached
+        return None
+
+    def get_adapter(self):
+        with self.lock:
+            if self.adapter is None:
+                self.adapter = MiddlewareHTTPAdapter([self])
+            return self.adapter
+
+    def revalidate(self, request, kwargs):
+        """Send a conditional copy of `request`, updating the cache."""
+        request = request.copy()
+        with self.lock:
+            self.revalidating.add(request)
+        kwargs = dict(kwargs, stream=False)
+        response = self.get_adapter().send(request, **kwargs)
+        response.content
+        response.close()
+
+    def fallback(self, request):
+        with self.lock:
+            return self.fallbacks.pop(request, None)
+
     def before_build_response(self, request, response):
         """Adapted from `CacheControlAdapter::build_response`. Fetch cached
         response if appropriate and mark with `from_cache`.
         """
         from_cache = getattr(response, 'from_cache', False)
 
+        fallback = self.fallback(request)
+        if fallback is not None and response.status in ERROR_STATUSES:
+            response.close()
+            return request, fallback
+
         if request.method == 'GET' and not from_cache:
             if response.status == 304:
                 cached_response = self.controller.update_cached_response(
@@ -52,14 +354,7 @@ class CacheMiddleware(BaseMiddleware):
             else:
                 if self.heuristic:
                     response = self.heuristic.apply(response)
-                response._fp = CallbackFileWrapper(
-                    response._fp,
-                    functools.partial(
-                        self.controller.cache_response,
-                        request,
-                        response,
-                    )
-                )
+                self.spool(request, response)
 
         if request.method in INVALIDATING_METHODS and response.ok:
             cache_url = self.controller.cache_url(request.url)
@@ -68,3 +363,29 @@ class CacheMiddleware(BaseMiddleware):
         response.from_cache = from_cache
 
         return request, response
+
+    def on_send_error(self, request, error):
+        """Serve the stale response kept for `request`, if any."""
+        fallback = self.fallback(request)
+        if fallback is None:
+            return None
+        return HTTPAdapter.build_response(self.get_adapter(), request, fallback)
+
+    def spool(self, request, response):
+        """Wrap the body of `response` so that it is cached once read,
+        unless its declared length already exceeds `max_body_size`.
+        """
+        length = content_length(response)
+        if self.max_body_size is not None and length is not None:
+            if length > self.max_body_size:
+                return
+        response._fp = SpoolingFileWrapper(
+            response._fp,
+            functools.partial(
+                self.controller.cache_response,
+                request,
+                response,
+            ),
+            max_size=self.max_body_size,
+            directory=self.spool_dir,
+        )
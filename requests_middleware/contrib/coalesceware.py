@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from requests_middleware import BaseMiddleware
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD'])
+
+KEY_HEADERS = (
+    'Authorization',
+    'Cookie',
+    'Accept',
+    'Accept-Encoding',
+    'Accept-Language',
+)
+
+
+def copy_response(response, request):
+    """Copy a `Response` whose content has been read, attaching `request`.
+    Headers, cookies and history are copied so that waiters cannot modify
+    each other's responses.
+    """
+    clone = Response()
+    clone._content = response.content
+    clone._content_consumed = True
+    clone.status_code = response.status_code
+    clone.headers = CaseInsensitiveDict(response.headers)
+    clone.raw = response.raw
+    clone.url = response.url
+    clone.encoding = response.encoding
+    clone.history = list(response.history)
+    clone.reason = response.reason
+    clone.cookies = response.cookies.copy()
+    clone.elapsed = response.elapsed
+    clone.request = request
+    clone.connection = getattr(response, 'connection', None)
+    clone.coalesced = True
+    return clone
+
+
+def vary_matches(leader, follower, response):
+    """Check whether `response`, fetched for `leader`, may be served for
+    `follower` according to its `Vary` header.
+    """
+    vary = response.headers.get('Vary')
+    if not vary:
+        return True
+    for name in vary.split(','):
+        name = name.strip()
+        if name == '*':
+            return False
+        if leader.headers.get(name) != follower.headers.get(name):
+            return False
+    return True
+
+
+class Flight(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.response = None
+        self.done = threading.Event()
+
+
+class CoalesceMiddleware(BaseMiddleware):
+    """Collapse concurrent identical idempotent requests into one upstream
+    fetch. The first request for a key is sent normally; requests for the
+    same key that arrive while it is in flight wait for it and receive their
+    own copy of its buffered `Response`. Followers that time out, or whose
+    leader fails, are sent normally. Streaming requests and requests with a
+    body are never coalesced.
+
+    Requests are keyed by method, URL and the values of `headers`; a
+    response whose `Vary` header names other differing headers is not
+    shared. Register after any cache middleware, so that cache hits are
+    served before coalescing. Followers block their thread while waiting, so
+    this middleware is meant for the threaded `MiddlewareHTTPAdapter`.
+
+    :param methods: Methods eligible for coalescing
+    :param headers: Request headers included in the coalescing key
+    :param float timeout: Seconds a follower waits for the leader, or `None`
+        to wait indefinitely
+    """
+    def __init__(self, methods=IDEMPOTENT_METHODS, headers=KEY_HEADERS,
+                 timeout=30.0):
+        self.methods = frozenset(methods)
+        self.headers = tuple(headers)
+        self.timeout = timeout
+        self.flights = {}
+        self.leaders = {}
+        self.lock = threading.Lock()
+
+    def key(self, request):
+        return (request.method, request.url) + tuple(
+            request.headers.get(name) for name in self.headers
+        )
+
+    def before_send(self, request, *args, **kwargs):
+        if request.method not in self.methods or request.body is not None:
+            return
+        if kwargs.get('stream'):
+            return
+        key = self.key(request)
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = Flight(request)
+                self.flights[key] = flight
+                self.leaders[id(request)] = key
+                return
+        if not flight.done.wait(self.timeout):
+            return
+        response = flight.response
+        if response is None:
+            return
+        if not vary_matches(flight.request, request, response):
+            return
+        return copy_response(response, request)
+
+    def land(self, request):
+        """Remove and return the flight led by `request`, if any."""
+        with self.lock:
+            key = self.leaders.pop(id(request), None)
+            if key is None:
+                return None
+            return self.flights.pop(key, None)
+
+    def after_build_response(self, req, resp, response):
+        flight = self.land(req)
+        if flight is None:
+            return response
+        try:
+            response.content
+            flight.response = response
+        finally:
+            flight.done.set()
+        return response
+
+    def on_local_response(self, req, response):
+        return self.after_build_response(req, None, response)
+
+    def on_send_error(self, request, error):
+        flight = self.land(request)
+        if flight is not None:
+            flight.done.set()
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""`Accept-Encoding` negotiation and streaming, bounded decoding of
+compressed response bodies, optionally on a pool of worker threads.
+"""
+
+import io
+import zlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from six.moves import queue
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from requests.packages.urllib3.exceptions import DecodeError
+from requests.packages.urllib3.response import HTTPResponse
+
+from requests_middleware import BaseMiddleware
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ZlibDecoder(object):
+    """Decoder for `gzip` (`wbits=16 + MAX_WBITS`) and `deflate` bodies.
+    Output is produced `limit` bytes at a time (0 for no limit), keeping
+    unconsumed input compressed. `deflate` bodies sent without a zlib
+    header, as some servers do, are decoded as raw deflate streams.
+    """
+    def __init__(self, wbits):
+        self.wbits = wbits
+        self.obj = zlib.decompressobj(wbits)
+        self.started = False
+
+    def decode(self, data, limit):
+        while data:
+            try:
+                chunk = self.obj.decompress(data, limit)
+            except zlib.error:
+                if self.started or self.wbits != zlib.MAX_WBITS:
+                    raise
+                self.wbits = -zlib.MAX_WBITS
+                self.obj = zlib.decompressobj(self.wbits)
+                continue
+            self.started = True
+            data = self.obj.unconsumed_tail
+            if self.obj.eof and self.obj.unused_data:
+                if self.wbits != 16 + zlib.MAX_WBITS:
+                    return
+                # Concatenated gzip members
+                data = self.obj.unused_data
+                self.obj = zlib.decompressobj(self.wbits)
+            if chunk:
+                yield chunk
+
+    def flush(self):
+        return self.obj.flush()
+
+
+def brotli_bounded():
+    """Check whether `brotli` can limit the output of a decoding step, as
+    `brotli` 1.1 does with `output_buffer_limit`.
+    """
+    try:
+        brotli.Decompressor().process(b'', output_buffer_limit=1)
+    except (AttributeError, TypeError):
+        return False
+    return True
+
+
+class BrotliDecoder(object):
+    """Decoder for `br` bodies. Output is produced `limit` bytes at a time
+    if `brotli` supports it; see :func:`brotli_bounded`.
+    """
+    def __init__(self):
+        self.obj = brotli.Decompressor()
+
+    def decode(self, data, limit):
+        if not limit or not BROTLI_BOUNDED:
+            process = getattr(self.obj, 'process', None) or self.obj.decompress
+            chunk = process(data)
+            if chunk:
+                yield chunk
+            return
+        while True:
+            chunk = self.obj.process(data, output_buffer_limit=limit)
+            data = b''
+            if chunk:
+                yield chunk
+            if not chunk or self.obj.can_accept_more_data():
+                return
+
+    def flush(self):
+        return b''
+
+
+class ZstdDecoder(object):
+    """Decoder for `zstd` bodies. `zstandard` cannot limit the output of a
+    decoding step, so a frame is decoded whole.
+    """
+
+    def __init__(self):
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data, limit):
+        while data:
+            chunk = self.obj.decompress(data)
+            data = b''
+            if self.obj.eof and self.obj.unused_data:
+                # Concatenated frames
+                data = self.obj.unused_data
+                self.obj = zstandard.ZstdDecompressor().decompressobj()
+            if chunk:
+                yield chunk
+
+    def flush(self):
+        return b''
+
+
+class MultiDecoder(object):
+    """Decoder applying `decoders` in turn, for bodies encoded several
+    times. Pass them in the reverse order of the `Content-Encoding` list.
+    """
+    def __init__(self, decoders):
+        self.decoders = decoders
+
+    def decode(self, data, limit):
+        return self._decode(0, data, limit)
+
+    def _decode(self, index, data, limit):
+        if index == len(self.decoders):
+            yield data
+            return
+        for chunk in self.decoders[index].decode(data, limit):
+            for decoded in self._decode(index + 1, chunk, limit):
+                yield decoded
+
+    def flush(self):
+        tail = b''
+        for decoder in self.decoders:
+            tail = b''.join(decoder.decode(tail, 0)) + decoder.flush()
+        return tail
+
+
+# Decoder factories by content coding, most preferred first
+DECODERS = [
+    ('gzip', lambda: ZlibDecoder(16 + zlib.MAX_WBITS)),
+    ('deflate', lambda: ZlibDecoder(zlib.MAX_WBITS)),
+]
+if brotli is not None:
+    DECODERS.insert(0, ('br', BrotliDecoder))
+if zstandard is not None:
+    DECODERS.insert(0, ('zstd', ZstdDecoder))
+
+AVAILABLE_ENCODINGS = tuple(name for name, _ in DECODERS)
+
+BROTLI_BOUNDED = brotli is not None and brotli_bounded()
+
+# Codings whose decoders produce output `limit` bytes at a time, so that
+# `max_size` is enforced before a large body is held in memory
+BOUNDED_ENCODINGS = frozenset(
+    ['gzip', 'deflate'] + (['br'] if BROTLI_BOUNDED else [])
+)
+
+DECODE_ERRORS = (zlib.error, )
+if brotli is not None:
+    DECODE_ERRORS += (brotli.error, )
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError, )
+
+
+def content_codings(headers):
+    """List the content codings of a response, outermost last, leaving out
+    `identity`.
+    """
+    return [
+        coding.strip().lower()
+        for coding in headers.get('Content-Encoding', '').split(',')
+        if coding.strip() and coding.strip().lower() != 'identity'
+    ]
+
+
+class DecodingReader(io.RawIOBase):
+    """File object reading urllib3 response `raw` without urllib3's content
+    decoding and decoding it with `decoder`, `chunk_size` bytes at a time.
+    Decoding errors and bodies decoding to more than `max_size` bytes raise
+    urllib3's `DecodeError`, reported by `requests` as
+    `ContentDecodingError`. `done` is called with the compressed and decoded
+    sizes once the body has been read.
+    """
+    def __init__(self, raw, decoder, chunk_size, max_size=None, done=None):
+        self.raw = raw
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.done = done
+        self.chunks = self.decode()
+        self.buffer = b''
+        self.offset = 0
+
+    def decode(self):
+        received = decoded = 0
+        try:
+            chunks = self.raw.stream(self.chunk_size, decode_content=False)
+            for data in chunks:
+                received += len(data)
+                for chunk in self.decoder.decode(data, self.chunk_size):
+                    decoded += len(chunk)
+                    self.check_size(decoded)
+                    yield chunk
+            chunk = self.decoder.flush()
+        except DECODE_ERRORS as error:
+            raise DecodeError('Failed to decode response body', error)
+        if chunk:
+            decoded += len(chunk)
+            self.check_size(decoded)
+            yield chunk
+        if self.done is not None:
+            self.done(received, decoded)
+
+    def check_size(self, decoded):
+        if self.max_size is not None and decoded > self.max_size:
+            raise DecodeError(
+                'Decoded body exceeds {0} bytes'.format(self.max_size)
+            )
+
+    def next_chunk(self):
+        return next(self.chunks, None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.buffer):
+            chunk = self.next_chunk()
+            if chunk is None:
+                # Close at the end of the body, as `http.client` does, so
+                # that urllib3 stops reading
+                self.close()
+                return 0
+            self.buffer, self.offset = chunk, 0
+        size = min(len(buffer), len(self.buffer) - self.offset)
+        buffer[:size] = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            super(DecodingReader, self).close()
+            self.raw.close()
+            self.raw.release_conn()
+
+
+# Marks the end of the chunks queued by a worker
+END = object()
+
+
+class OffloadedReader(DecodingReader):
+    """:class:`DecodingReader` reading and decoding the body on a worker
+    thread, at most `buffer_chunks` decoded chunks ahead of the caller. The
+    worker is requested on the first read. If none picks the body up within
+    `start_timeout` seconds, e.g. because every worker is held by another
+    response that is not being read, the body is decoded on the calling
+    thread instead.
+    """
+    def __init__(self, raw, decoder, chunk_size, max_size=None, done=None,
+                 pool=None, buffer_chunks=4, start_timeout=0.1):
+        super(OffloadedReader, self).__init__(
+            raw, decoder, chunk_size, max_size, done,
+        )
+        self.pool = pool
+        self.start_timeout = start_timeout
+        self.queue = queue.Queue(buffer_chunks)
+        self.stopped = threading.Event()
+        self.submitted = False
+        self.claimed = False
+        self.inline = False
+        self.lock = threading.Lock()
+
+    def claim(self):
+        """Take the decoding of the body, for a worker or for the caller;
+        return whether it was still free.
+        """
+        with self.lock:
+            if self.claimed:
+                return False
+            self.claimed = True
+            return True
+
+    def produce(self):
+        if not self.claim():
+            return
+        try:
+            for chunk in self.chunks:
+                if not self.put(chunk):
+                    return
+        except Exception as error:
+            self.put(error)
+        else:
+            self.put(END)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next_chunk(self):
+        if self.inline:
+            return super(OffloadedReader, self).next_chunk()
+        if not self.submitted:
+            self.submitted = True
+            self.pool.apply_async(self.produce)
+            try:
+                item = self.queue.get(timeout=self.start_timeout)
+            except queue.Empty:
+                if self.claim():
+                    self.inline = True
+                    return super(OffloadedReader, self).next_chunk()
+                item = self.queue.get()
+        else:
+            item = self.queue.get()
+        if item is END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        super(OffloadedReader, self).close()
+
+
+class CompressionMiddleware(BaseMiddleware):
+    """Ask for compressed responses and decode them in bounded chunks.
+
+    `Accept-Encoding` is set to `encodings`, by default all the codings
+    available: `zstd` and `br` when `zstandard` and `brotli` (or
+    `brotlicffi`) are installed, `gzip` and `deflate`. Requests setting
+    their own `Accept-Encoding` keep it. With `max_size`, only codings
+    whose output can be bounded (see :data:`BOUNDED_ENCODINGS`) are
+    accepted.
+
+    Responses encoded with supported codings are decoded as they are read,
+    `chunk_size` bytes of compressed input at a time; output of bounded
+    codings is also produced `chunk_size` bytes at a time. Bodies decoding
+    to more than `max_size` bytes fail with `ContentDecodingError`. With
+    `workers`, bodies of at least `offload_size` compressed bytes are read
+    and decoded on a pool of that many threads, from their first read, up
+    to `buffer_chunks` chunks ahead of the caller, so that reading the
+    network and inflating (which releases the GIL for `zlib`) overlap with
+    the caller's processing. Bodies no worker is free for are decoded on
+    the reading thread. Decoded responses lose their `Content-Encoding` and
+    `Content-Length` headers, which describe the encoded body.
+
+    :param list encodings: Codings to accept, most preferred first
+    :param int chunk_size: Bytes read and decoded at a time
+    :param int max_size: Largest decoded body, in bytes, or `None`
+    :param int workers: Number of decoding threads; 0 to decode inline
+    :param int offload_size: Smallest compressed `Content-Length`, in bytes,
+        decoded on the workers
+    :param int buffer_chunks: Decoded chunks buffered by the workers
+    """
+    def __init__(self, encodings=None, chunk_size=64 * 1024, max_size=None,
+                 workers=0, offload_size=1024 * 1024, buffer_chunks=4):
+        if encodings is None:
+            encodings = [
+                name for name in AVAILABLE_ENCODINGS
+                if max_size is None or name in BOUNDED_ENCODINGS
+            ]
+        unknown = set(encodings) - set(AVAILABLE_ENCODINGS)
+        if unknown:
+            raise ValueError('Unavailable encodings: {0}'.format(
+                ', '.join(sorted(unknown))
+            ))
+        unbounded = set(encodings) - BOUNDED_ENCODINGS
+        if max_size is not None and unbounded:
+            raise ValueError('Encodings without bounded decoding: {0}'.format(
+                ', '.join(sorted(unbounded))
+            ))
+        self.encodings = tuple(encodings)
+        self.accept_encoding = ', '.join(self.encodings)
+        self.decoders = dict(DECODERS)
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.workers = workers
+        self.offload_size = offload_size
+        self.buffer_chunks = buffer_chunks
+        self.pool = None
+        self.counts = {
+            'responses': 0, 'offloaded': 0, 'received': 0, 'decoded': 0,
+        }
+        self.lock = threading.Lock()
+
+    def before_send(self, request, *args, **kwargs):
+        current = request.headers.get('Accept-Encoding')
+        if current is None or current == DEFAULT_ACCEPT_ENCODING:
+            request.headers['Accept-Encoding'] = self.accept_encoding
+
+    def before_build_response(self, req, resp):
+        codings = content_codings(resp.headers)
+        if not codings or req.method == 'HEAD' or resp.status in (204, 304):
+            return req, resp
+        if not all(coding in self.decoders for coding in codings):
+            return req, resp
+        decoder = MultiDecoder([
+            self.decoders[coding]() for coding in reversed(codings)
+        ])
+        if self.offload(resp):
+            body = OffloadedReader(
+                resp, decoder, self.chunk_size, self.max_size, self.done,
+                self.get_pool(), self.buffer_chunks,
+            )
+            with self.lock:
+                self.counts['offloaded'] += 1
+        else:
+            body = DecodingReader(
+                resp, decoder, self.chunk_size, self.max_size, self.done,
+            )
+        headers = resp.headers.copy()
+        headers.pop('Content-Encoding', None)
+        headers.pop('Content-Length', None)
+        decoded = HTTPResponse(
+            body=body,
+            headers=headers,
+            status=resp.status,
+            version=resp.version,
+            reason=resp.reason,
+            preload_content=False,
+            decode_content=False,
+            original_response=getattr(resp, '_original_response', None),
+            request_method=getattr(resp, '_request_method', None),
+            request_url=getattr(resp, '_request_url', None),
+            retries=getattr(resp, 'retries', None),
+        )
+        return req, decoded
+
+    def offload(self, resp):
+        if not self.workers:
+            return False
+        try:
+            length = int(resp.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return False
+        return length >= self.offload_size
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def done(self, received, decoded):
+        with self.lock:
+            self.counts['responses'] += 1
+            self.counts['received'] += received
+            self.counts['decoded'] += decoded
+
+    def stats(self):
+        """Return the number of decoded and offloaded responses and the
+        compressed and decoded bytes read.
+        """
+        with self.lock:
+            return dict(self.counts)
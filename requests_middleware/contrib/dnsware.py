@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Caching DNS resolution for the connections of
+:class:`MiddlewareHTTPAdapter
+<requests_middleware.middleware.MiddlewareHTTPAdapter>`.
+"""
+
+import socket
+import functools
+import itertools
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from requests.packages.urllib3 import exceptions
+from requests.packages.urllib3.util.connection import allowed_gai_family
+
+from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+
+
+def system_resolver(host):
+    """Resolve `host` with `getaddrinfo`, which does not report TTLs.
+
+    :returns: Tuple of (list of addresses, `None`)
+    :raises: `socket.gaierror`
+    """
+    infos = socket.getaddrinfo(
+        host, None, allowed_gai_family(), socket.SOCK_STREAM,
+    )
+    addresses = []
+    for info in infos:
+        address = info[4][0]
+        if address not in addresses:
+            addresses.append(address)
+    return addresses, None
+
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class Entry(object):
+    """Cached resolution of a host: its addresses, or the error raised."""
+
+    def __init__(self, addresses, error, expires):
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+        self.counter = itertools.count()
+
+
+class DNSCache(object):
+    """Bounded cache of host name resolutions. Addresses are kept for the
+    TTL reported by `resolver`, clamped to `min_ttl` and `max_ttl`, or for
+    `ttl` if it reports none; failures are kept for `negative_ttl`.
+    Concurrent lookups of a host missing from the cache share a single
+    resolution. Each lookup returns the addresses rotated by one, so that
+    connections to a host are spread across its addresses.
+
+    :param resolver: Callable taking a host name and returning a tuple of
+        (list of addresses, TTL in seconds or `None`), raising
+        `socket.gaierror` on failure; defaults to :func:`system_resolver`
+    :param float ttl: Seconds to keep addresses without a reported TTL
+    :param float min_ttl: Least seconds to keep addresses
+    :param float max_ttl: Most seconds to keep addresses
+    :param float negative_ttl: Seconds to keep failures
+    :param int max_entries: Number of hosts kept
+    """
+    def __init__(self, resolver=None, ttl=60.0, min_ttl=0.0, max_ttl=3600.0,
+                 negative_ttl=10.0, max_entries=10000):
+        self.resolver = resolver or system_resolver
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.counts = {'hits': 0, 'misses': 0, 'failures': 0}
+        self.lock = threading.Lock()
+
+    def resolve(self, host):
+        """Return the addresses of `host`, the next one first.
+
+        :raises: `socket.gaierror` if `host` does not resolve
+        """
+        if is_ip_address(host):
+            return [host]
+        entry = self.lookup(host.lower())
+        if entry.error is not None:
+            raise socket.gaierror(*entry.error.args)
+        addresses = entry.addresses
+        start = next(entry.counter) % len(addresses)
+        return addresses[start:] + addresses[:start]
+
+    def lookup(self, host):
+        now = compat.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and entry.expires > now:
+                self.entries.pop(host)
+                self.entries[host] = entry
+                self.counts['hits'] += 1
+                return entry
+            self.counts['misses'] += 1
+            stale = entry
+            done = self.pending.get(host)
+            owner = done is None
+            if owner:
+                done = self.pending[host] = threading.Event()
+        if not owner:
+            done.wait()
+            with self.lock:
+                entry = self.entries.get(host)
+            if entry is not None and entry is not stale:
+                return entry
+        try:
+            entry = self.fetch(host)
+            with self.lock:
+                self.entries.pop(host, None)
+                self.entries[host] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return entry
+        finally:
+            if owner:
+                with self.lock:
+                    self.pending.pop(host, None)
+                done.set()
+
+    def fetch(self, host):
+        try:
+            addresses, ttl = self.resolver(host)
+            if not addresses:
+                raise socket.gaierror(
+                    socket.EAI_NONAME, 'No addresses for {0}'.format(host),
+                )
+        except socket.gaierror as error:
+            with self.lock:
+                self.counts['failures'] += 1
+            expires = compat.monotonic() + self.negative_ttl
+            return Entry(None, error, expires)
+        if ttl is None:
+            ttl = self.ttl
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        return Entry(list(addresses), None, compat.monotonic() + ttl)
+
+    def prefetch(self, hosts, workers=16):
+        """Resolve `hosts` concurrently, so that later connections to them
+        do not block on resolution. Failures are cached, not raised.
+
+        :param hosts: Iterable of host names
+        :param int workers: Number of resolving threads
+        :returns: List of address lists, empty for hosts that failed
+        """
+        hosts = list(hosts)
+        if not hosts:
+            return []
+        pool = ThreadPool(max(1, min(workers, len(hosts))))
+        try:
+            return pool.map(self._prefetch, hosts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _prefetch(self, host):
+        try:
+            return self.resolve(host)
+        except socket.gaierror:
+            return []
+
+    def stats(self):
+        """Return the number of cache hits, misses and failed resolutions."""
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries))
+
+
+def name_resolution_error(conn, error):
+    if hasattr(exceptions, 'NameResolutionError'):
+        return exceptions.NameResolutionError(conn.host, conn, error)
+    return exceptions.NewConnectionError(
+        conn, 'Failed to resolve {0}: {1}'.format(conn.host, error),
+    )
+
+
+class ResolvingConnectionMixin(object):
+    """Mixin for urllib3 connection classes resolving their host through
+    `dns_cache` and trying each of its addresses in turn.
+    """
+    dns_cache = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = self.dns_cache.resolve(host)
+        except socket.gaierror as error:
+            raise name_resolution_error(self, error)
+        failure = None
+        for address in addresses:
+            # urllib3 connects to `_dns_host`; `host` is used again for
+            # TLS once it is restored
+            self._dns_host = address
+            try:
+                return super(ResolvingConnectionMixin, self)._new_conn()
+            except (exceptions.NewConnectionError,
+                    exceptions.ConnectTimeoutError) as error:
+                failure = error
+            finally:
+                self._dns_host = host
+        raise failure
+
+
+class DNSCacheMiddleware(BaseMiddleware):
+    """Resolve the hosts of new connections through a :class:`DNSCache`
+    rather than calling `getaddrinfo` for each connection. A connection
+    tries the addresses of its host in turn, starting from a different one
+    each time. Call :meth:`prefetch` with the hosts of a crawl to resolve
+    them ahead of time. Like other hooks called during adapter
+    initialization, the middleware must be passed to the adapter's
+    `__init__`. Proxy connections are not affected.
+
+    :param cache: :class:`DNSCache` to use, e.g. to share one between
+        adapters; other keyword arguments are passed to a new one otherwise
+    """
+    def __init__(self, cache=None, **kwargs):
+        self.cache = cache or DNSCache(**kwargs)
+        self.classes = {}
+        self.lock = threading.Lock()
+
+    def after_init_poolmanager(self, poolmanager):
+        poolmanager.connection_from_host = functools.partial(
+            self.connection_from_host, poolmanager.connection_from_host,
+        )
+
+    def connection_from_host(self, connection_from_host, host, port=None,
+                             scheme='http', pool_kwargs=None):
+        """Return the pool to `host`, resolving through the cache."""
+        pool = connection_from_host(
+            host, port, scheme, pool_kwargs=pool_kwargs,
+        )
+        if getattr(pool.ConnectionCls, 'dns_cache', None) is not self.cache:
+            pool.ConnectionCls = self.connection_class(pool.ConnectionCls)
+        return pool
+
+    def connection_class(self, cls):
+        with self.lock:
+            if cls not in self.classes:
+                self.classes[cls] = type(
+                    'Resolving' + cls.__name__,
+                    (ResolvingConnectionMixin, cls),
+                    {'dns_cache': self.cache},
+                )
+            return self.classes[cls]
+
+    def prefetch(self, hosts, workers=16):
+        """Resolve `hosts` ahead of time; see :meth:`DNSCache.prefetch`."""
+        return self.cache.prefetch(hosts, workers=workers)
@@ -1,31 +1,285 @@
 # -*- coding: utf-8 -*-
+"""Response caching with `httpcache`, which is imported when the first
+:class:`CacheMiddleware` is created.
+"""
+
+import weakref
+import datetime
+import threading
+import collections
 
-from httpcache.cache import HTTPCache
 import six.moves.http_client as httplib
+from six.moves import collections_abc
+
+from requests_middleware import BaseMiddleware, MiddlewareHTTPAdapter
+from requests_middleware.utils import (
+    ERROR_STATUSES, Revalidator, lazy_subclass, stale_windows,
+)
+
+
+class CacheStats(object):
+    """Counters describing cache effectiveness. `bytes_saved` is the total
+    size of response bodies served from the cache, whether fresh or after a
+    `304 Not Modified`.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes_saved': self.bytes_saved,
+            'hit_rate': self.hit_rate,
+        }
+
+
+def entry_size(entry):
+    """Size of a cache entry, taken as the length of its response body."""
+    return len(entry['response'].content or b'')
+
+
+class SizedLRU(collections_abc.MutableMapping):
+    """Mapping of cache entries bounded by the total body size of its values
+    and, optionally, by their number. Reads and writes mark an entry as most
+    recently used; the least recently used entries are evicted first, in
+    constant time. Entries larger than `max_bytes` are not stored.
+
+    :param int max_bytes: Maximum total size of stored bodies, in bytes
+    :param int capacity: Maximum number of entries, or `None` for no limit
+    :param CacheStats stats: Counters to record evictions in
+    """
+    def __init__(self, max_bytes, capacity=None, stats=None):
+        self.max_bytes = max_bytes
+        self.capacity = capacity
+        self.stats = stats or CacheStats()
+        self.size = 0
+        self._data = collections.OrderedDict()
+
+    def __setitem__(self, key, value):
+        self._discard(key)
+        size = entry_size(value)
+        if size > self.max_bytes:
+            return
+        self._data[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes or (
+            self.capacity is not None and len(self._data) > self.capacity
+        ):
+            _, (_, evicted) = self._data.popitem(last=False)
+            self.size -= evicted
+            self.stats.evictions += 1
+
+    def __getitem__(self, key):
+        item = self._data.pop(key)
+        self._data[key] = item
+        return item[0]
+
+    def __delitem__(self, key):
+        _, size = self._data.pop(key)
+        self.size -= size
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
 
-from requests_middleware import BaseMiddleware
+    def _discard(self, key):
+        if key in self._data:
+            del self[key]
+
+
+class BoundedHTTPCacheMixin(object):
+    """`HTTPCache` bounded by the total size of cached response bodies
+    rather than only by the number of entries. The class,
+    `BoundedHTTPCache`, is returned by :func:`bounded_http_cache_class`.
+
+    :param int max_bytes: Maximum total size of cached bodies, in bytes
+    :param int capacity: Maximum number of entries, or `None` for no limit
+    :param CacheStats stats: Counters to record evictions in
+    """
+    def __init__(self, max_bytes, capacity=None, stats=None):
+        # Limits are enforced by `SizedLRU`; an infinite capacity disables
+        # `HTTPCache`'s own linear-time eviction pass
+        super(BoundedHTTPCacheMixin, self).__init__(capacity=float('inf'))
+        self._cache = SizedLRU(max_bytes, capacity=capacity, stats=stats)
+
+    @property
+    def size(self):
+        return self._cache.size
+
+
+def bounded_http_cache_class():
+    """Return :class:`BoundedHTTPCache`, importing `httpcache` on first
+    use.
+    """
+    return lazy_subclass(BoundedHTTPCacheMixin, 'httpcache.cache', 'HTTPCache')
+
+
+def conditional_headers(response):
+    """Validators of cached `response` as conditional request headers."""
+    headers = {}
+    if 'ETag' in response.headers:
+        headers['If-None-Match'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        headers['If-Modified-Since'] = response.headers['Last-Modified']
+    return headers
 
 
 class CacheMiddleware(BaseMiddleware):
+    """Cache responses with `httpcache`. By default the cache holds up to
+    `capacity` responses; pass `max_bytes` to bound it by the total size of
+    cached bodies instead, evicting least recently used responses first.
+    Hit, miss, eviction and bytes-saved counts are kept in `stats`;
+    evictions are only counted for byte-bounded caches.
 
-    def __init__(self, capacity=50):
-        self.cache = HTTPCache(capacity=capacity)
+    Expired responses are served as RFC 5861 allows. Within their
+    `stale-while-revalidate` window they are returned at once (and counted
+    as hits) while a background thread revalidates them through `adapter`.
+    Within their `stale-if-error` window they replace a connection error or
+    a 5xx response.
+
+    :param int capacity: Maximum number of cached responses
+    :param int max_bytes: Maximum total size of cached bodies, in bytes
+    :param adapter: Adapter sending background revalidations; defaults to a
+        `MiddlewareHTTPAdapter` holding only this middleware
+    :param int revalidate_workers: Number of background revalidation threads
+    """
+    def __init__(self, capacity=50, max_bytes=None, adapter=None,
+                 revalidate_workers=4):
+        from httpcache.cache import HTTPCache, CACHEABLE_RCS, CACHEABLE_VERBS
+        self.stats = CacheStats()
+        if max_bytes is None:
+            self.cache = HTTPCache(capacity=capacity)
+        else:
+            self.cache = bounded_http_cache_class()(
+                max_bytes, capacity=capacity, stats=self.stats,
+            )
+        self.cacheable_statuses = CACHEABLE_RCS
+        self.cacheable_verbs = CACHEABLE_VERBS
+        self.adapter = adapter
+        self.revalidator = Revalidator(revalidate_workers)
+        self.revalidating = weakref.WeakSet()
+        self.fallbacks = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_adapter(self):
+        with self.lock:
+            if self.adapter is None:
+                self.adapter = MiddlewareHTTPAdapter([self])
+            return self.adapter
 
     def before_send(self, request, *args, **kwargs):
         """Adapted from `CachingHTTPAdapter::send`. Check for cached response
-        and update request with conditional headers.
+        and update request with conditional headers. Serve expired responses
+        within their `stale-while-revalidate` window, and keep those within
+        their `stale-if-error` window in case sending fails.
+        """
+        with self.lock:
+            if request in self.revalidating:
+                entry = self.cache._cache.get(request.url)
+                if entry is not None:
+                    request.headers.update(
+                        conditional_headers(entry['response'])
+                    )
+                return
+            stale = self.serve_stale(request, kwargs)
+            if stale is not None:
+                return stale
+            cached = self.cache.retrieve(request)
+            if cached is None:
+                self.stats.misses += 1
+                return
+            self.stats.hits += 1
+            self.stats.bytes_saved += len(cached.content or b'')
+        return cached
+
+    def serve_stale(self, request, kwargs):
+        """Return the expired response cached for `request` if it may be
+        served while revalidating, scheduling the revalidation; if it may
+        only be served on error, keep it as the request's fallback. Called
+        with `lock` held.
         """
-        cached = self.cache.retrieve(request)
-        if cached is not None:
+        if request.method not in self.cacheable_verbs:
+            return None
+        entry = self.cache._cache.get(request.url)
+        if entry is None or entry['expiry'] is None:
+            return None
+        age = (datetime.datetime.utcnow() - entry['expiry']).total_seconds()
+        if age <= 0:
+            return None
+        cached = entry['response']
+        while_revalidate, if_error = stale_windows(cached.headers)
+        if while_revalidate is not None and age <= while_revalidate:
+            self.revalidator.submit(
+                request.url, self.revalidate, request, kwargs,
+            )
+            self.stats.hits += 1
+            self.stats.bytes_saved += len(cached.content or b'')
             return cached
+        if if_error is not None and age <= if_error:
+            self.fallbacks[request] = cached
+        return None
+
+    def revalidate(self, request, kwargs):
+        """Send a conditional copy of `request`, updating the cache."""
+        request = request.copy()
+        with self.lock:
+            self.revalidating.add(request)
+        kwargs = dict(kwargs, stream=False)
+        response = self.get_adapter().send(request, **kwargs)
+        response.content
+        response.close()
+
+    def fallback(self, request):
+        with self.lock:
+            return self.fallbacks.pop(request, None)
+
+    def on_send_error(self, request, error):
+        """Serve the stale response kept for `request`, if any."""
+        return self.fallback(request)
 
     def after_build_response(self, req, resp, response):
         """Adapted from `CachingHTTPAdapter::build_response`. Fetch cached
-        response if appropriate and mark with `from_cache`.
+        response if appropriate and mark with `from_cache`. A `304 Not
+        Modified` refreshes the cached response's headers and expiry.
 
         """
-        if response.status_code == httplib.NOT_MODIFIED:
-            response = self.cache.handle_304(response)
-        else:
-            self.cache.store(response)
+        fallback = self.fallback(req)
+        if fallback is not None and response.status_code in ERROR_STATUSES:
+            response.close()
+            return fallback
+        cacheable = response.status_code in self.cacheable_statuses
+        cacheable = cacheable and req.method in self.cacheable_verbs
+        if cacheable and isinstance(self.cache, BoundedHTTPCacheMixin):
+            # Read the body before locking, so that sizing the entry does not
+            # serialize downloads
+            response.content
+        with self.lock:
+            if response.status_code == httplib.NOT_MODIFIED:
+                cached = self.cache.handle_304(response)
+                if cached is not None:
+                    self.stats.bytes_saved += len(cached.content or b'')
+                    cached.headers.update(
+                        (key, value)
+                        for key, value in response.headers.items()
+                        if key.lower() != 'content-length'
+                    )
+                    self.cache.store(cached)
+                    response = cached
+            else:
+                self.cache.store(response)
         return response
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""Per-host connection pool sizing, keep-alive limits and pool usage
+statistics for :class:`MiddlewareHTTPAdapter
+<requests_middleware.middleware.MiddlewareHTTPAdapter>`.
+"""
+
+import weakref
+import threading
+import functools
+import collections
+
+from requests.packages.urllib3.exceptions import EmptyPoolError
+
+from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+from requests_middleware.instrument import Histogram
+
+
+# Options applied when a pool is built; changing them replaces the pool
+POOL_OPTIONS = frozenset(['maxsize', 'block'])
+# Options applied to live pools on each connection checkout
+CONNECTION_OPTIONS = frozenset(['keepalive', 'max_requests'])
+OPTIONS = POOL_OPTIONS | CONNECTION_OPTIONS
+
+
+class PoolStats(object):
+    """Usage counters of the connection pools for one scheme, host and
+    port. `wait` holds the time spent checking connections out, which is
+    the time spent waiting for a free connection in blocking pools.
+    """
+    def __init__(self):
+        self.checkouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.expired = 0
+        self.wait = Histogram()
+        self.lock = threading.Lock()
+
+    def checked_out(self, seconds):
+        self.wait.record(seconds)
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            if self.in_use > self.max_in_use:
+                self.max_in_use = self.in_use
+
+    def checked_in(self, discarded):
+        with self.lock:
+            self.in_use -= 1
+            if discarded:
+                self.discarded += 1
+
+    def as_dict(self):
+        with self.lock:
+            counts = {
+                'checkouts': self.checkouts,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'created': self.created,
+                'discarded': self.discarded,
+                'expired': self.expired,
+            }
+        counts['wait'] = self.wait.summary()
+        return counts
+
+
+class TunedPoolMixin(object):
+    """Mixin for urllib3 connection pools recording checkouts in `stats`
+    and closing pooled connections that exceed their keep-alive limits
+    before reuse. Closed connections reconnect when next used.
+    """
+    stats = None
+    keepalive = None
+    max_requests = None
+
+    def _get_conn(self, timeout=None):
+        began = compat.perf_counter()
+        try:
+            conn = super(TunedPoolMixin, self)._get_conn(timeout)
+        except EmptyPoolError:
+            # Nothing is returned to the pool after a checkout times out
+            raise
+        except Exception:
+            # After other failures, e.g. `ClosedPoolError`, urllib3 returns
+            # `None` to the pool, which `_put_conn` counts as a checkin
+            self.stats.checked_out(compat.perf_counter() - began)
+            raise
+        self.stats.checked_out(compat.perf_counter() - began)
+        if self.expired(conn):
+            conn.close()
+            conn.pool_requests = 0
+            with self.stats.lock:
+                self.stats.expired += 1
+        conn.pool_requests = getattr(conn, 'pool_requests', 0) + 1
+        return conn
+
+    def expired(self, conn):
+        requests = getattr(conn, 'pool_requests', 0)
+        if self.max_requests is not None and requests >= self.max_requests:
+            return True
+        released = getattr(conn, 'pool_released', None)
+        if self.keepalive is None or released is None:
+            return False
+        return compat.monotonic() - released > self.keepalive
+
+    def _put_conn(self, conn):
+        discarded = False
+        if conn is not None:
+            conn.pool_released = compat.monotonic()
+            pool = self.pool
+            discarded = pool is None or pool.full()
+        try:
+            super(TunedPoolMixin, self)._put_conn(conn)
+        finally:
+            self.stats.checked_in(discarded)
+
+    def _new_conn(self):
+        with self.stats.lock:
+            self.stats.created += 1
+        return super(TunedPoolMixin, self)._new_conn()
+
+    @property
+    def idle(self):
+        """Number of open connections waiting in the pool."""
+        pool = self.pool
+        if pool is None:
+            return 0
+        return sum(1 for conn in list(pool.queue) if conn is not None)
+
+
+# Tuned subclasses of urllib3 pool classes, by base class
+tuned_classes = {}
+tuned_classes_lock = threading.Lock()
+
+
+def tuned_class(cls):
+    with tuned_classes_lock:
+        if cls not in tuned_classes:
+            tuned_classes[cls] = type(
+                'Tuned' + cls.__name__, (TunedPoolMixin, cls), {}
+            )
+        return tuned_classes[cls]
+
+
+class PoolMiddleware(BaseMiddleware):
+    """Size connection pools per host and limit keep-alive connection reuse.
+    Options are given for all hosts as keyword arguments and per host in
+    `hosts`, keyed by `host` or `host:port`; `host:port` options override
+    `host` options, which override the defaults. Unset `maxsize` and
+    `block` fall back to the adapter's `pool_maxsize` and `pool_block`.
+
+    Options can be changed at runtime with :meth:`configure`. New
+    `keepalive` and `max_requests` limits apply to live pools; new
+    `maxsize` or `block` values replace the host's pools, closing their
+    idle connections, while in-flight connections are closed once released.
+
+    Pool use is reported by :meth:`snapshot`. Like other hooks called
+    during adapter initialization, the middleware must be passed to the
+    adapter's `__init__`. Proxy pools are not tuned.
+
+    :param int maxsize: Number of connections kept per pool
+    :param bool block: Whether to wait for a free connection rather than
+        open one beyond `maxsize`
+    :param float keepalive: Seconds a connection may sit idle in the pool
+        and still be reused
+    :param int max_requests: Requests sent over a connection before it is
+        closed and reopened
+    :param dict hosts: Options by `host` or `host:port`
+    :param int max_stats: Number of pools for which statistics are kept;
+        those of the least recently used pools are dropped beyond it
+    """
+    def __init__(self, maxsize=None, block=None, keepalive=None,
+                 max_requests=None, hosts=None, max_stats=1000):
+        self.defaults = {}
+        self.hosts = {}
+        self.max_stats = max_stats
+        self.managers = weakref.WeakSet()
+        self.pools = weakref.WeakSet()
+        self.pool_stats = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.configure(
+            maxsize=maxsize, block=block, keepalive=keepalive,
+            max_requests=max_requests,
+        )
+        for host, options in (hosts or {}).items():
+            self.configure(host, **options)
+
+    def configure(self, host=None, **options):
+        """Set options for `host` (`host` or `host:port`), or the defaults
+        if `host` is `None`; options set to `None` are cleared. Pools whose
+        `maxsize` or `block` changes are replaced.
+        """
+        unknown = set(options) - OPTIONS
+        if unknown:
+            raise TypeError(
+                'Unknown pool options: {0}'.format(', '.join(sorted(unknown)))
+            )
+        with self.lock:
+            current = self.defaults if host is None else self.hosts.setdefault(
+                host.lower(), {}
+            )
+            for name, value in options.items():
+                if value is None:
+                    current.pop(name, None)
+                else:
+                    current[name] = value
+            pools = [
+                pool for pool in self.pools
+                if host is None or host.lower() in (pool.key[1],
+                                                    endpoint(pool.key))
+            ]
+        replace = set()
+        for pool in pools:
+            resolved = self.options_for(*pool.key)
+            pool.keepalive = resolved.get('keepalive')
+            pool.max_requests = resolved.get('max_requests')
+            maxsize = resolved.get('maxsize', pool.default_maxsize)
+            block = resolved.get('block', pool.default_block)
+            if (maxsize, block) != (pool.configured_maxsize,
+                                    pool.configured_block):
+                replace.add(pool.key)
+        for manager in list(self.managers):
+            for pool_key in manager.pools.keys():
+                key = (pool_key.key_scheme, pool_key.key_host, pool_key.key_port)
+                if key not in replace:
+                    continue
+                try:
+                    pool = manager.pools[pool_key]
+                    del manager.pools[pool_key]
+                except KeyError:
+                    continue
+                # Recent urllib3 versions do not close pools they drop
+                pool.close()
+
+    def options_for(self, scheme, host, port):
+        """Return the options in effect for pools to `host` and `port`."""
+        with self.lock:
+            options = dict(self.defaults)
+            options.update(self.hosts.get(host, {}))
+            options.update(self.hosts.get(endpoint((scheme, host, port)), {}))
+        return options
+
+    def stats_for(self, key):
+        with self.lock:
+            stats = self.pool_stats.pop(key, None) or PoolStats()
+            self.pool_stats[key] = stats
+            while len(self.pool_stats) > self.max_stats:
+                self.pool_stats.popitem(last=False)
+            return stats
+
+    def after_init_poolmanager(self, poolmanager):
+        poolmanager.pool_classes_by_scheme = dict(
+            (scheme, functools.partial(self.new_pool, scheme, cls))
+            for scheme, cls in poolmanager.pool_classes_by_scheme.items()
+        )
+        self.managers.add(poolmanager)
+
+    def new_pool(self, scheme, cls, host, port=None, **kwargs):
+        """Build a tuned pool of class `cls`, applying the options for
+        `host` and `port` over the `PoolManager` keyword arguments.
+        """
+        key = (scheme, host.lower(), port)
+        options = self.options_for(*key)
+        defaults = dict(
+            (name, kwargs[name]) for name in POOL_OPTIONS if name in kwargs
+        )
+        for name in POOL_OPTIONS:
+            if name in options:
+                kwargs[name] = options[name]
+        pool = tuned_class(cls)(host, port, **kwargs)
+        pool.default_maxsize = defaults.get('maxsize', 1)
+        pool.default_block = defaults.get('block', False)
+        pool.configured_maxsize = kwargs.get('maxsize', 1)
+        pool.configured_block = kwargs.get('block', False)
+        pool.keepalive = options.get('keepalive')
+        pool.max_requests = options.get('max_requests')
+        pool.key = key
+        pool.stats = self.stats_for(key)
+        with self.lock:
+            self.pools.add(pool)
+        return pool
+
+    def snapshot(self):
+        """Return a row per pool with its scheme, host, port, `maxsize`,
+        `block`, idle connection count, usage counters and checkout wait
+        time summary (see :class:`PoolStats`). Pools shared by several
+        adapters are reported together; pools no longer open report no
+        settings and no idle connections.
+        """
+        with self.lock:
+            items = list(self.pool_stats.items())
+            pools = collections.defaultdict(list)
+            for pool in self.pools:
+                if pool.pool is not None:
+                    pools[pool.key].append(pool)
+        rows = []
+        for key, stats in items:
+            live = pools.get(key)
+            row = stats.as_dict()
+            row.update({
+                'scheme': key[0],
+                'host': key[1],
+                'port': key[2],
+                'maxsize': live[-1].configured_maxsize if live else None,
+                'block': live[-1].configured_block if live else None,
+                'idle': sum(pool.idle for pool in live or ()),
+            })
+            rows.append(row)
+        return rows
+
+
+def endpoint(key):
+    scheme, host, port = key
+    return '{0}:{1}'.format(host, port)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Retries of idempotent requests, with exponential backoff, full jitter and
+a retry budget bounding the share of traffic spent on retries.
+"""
+
+import time
+import random
+import threading
+
+import six
+from requests.exceptions import ConnectionError, SSLError, Timeout
+
+from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+from requests_middleware.utils import RollingWindow, retry_after
+
+
+IDEMPOTENT_METHODS = frozenset([
+    'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE',
+])
+
+
+class RetryBudget(object):
+    """Sliding window of request and retry counts over the last `window`
+    seconds. A retry is allowed while retries stay below `ratio` times the
+    requests seen, plus `min_per_second` retries per second so that
+    low-traffic clients can still retry. Once a dependency fails, retries
+    thus add at most `ratio` to its load rather than multiplying it.
+
+    :param float ratio: Retries allowed per request
+    :param float min_per_second: Retries allowed per second regardless of
+        traffic
+    :param int window: Length of the window, in seconds
+    """
+    def __init__(self, ratio=0.1, min_per_second=1.0, window=10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self.counts = RollingWindow(window)
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    @property
+    def requests(self):
+        return self.counts.totals[0]
+
+    @property
+    def retries(self):
+        return self.counts.totals[1]
+
+    def request(self):
+        """Count a request."""
+        with self.lock:
+            self.counts.add(compat.monotonic(), 1, 0)
+
+    def withdraw(self):
+        """Count and return `True` if a retry is allowed, else count the
+        denial and return `False`.
+        """
+        with self.lock:
+            now = compat.monotonic()
+            self.counts.expire(now)
+            allowed = self.ratio * self.requests
+            allowed += self.min_per_second * self.window
+            if self.retries >= allowed:
+                self.denied += 1
+                return False
+            self.counts.add(now, 0, 1)
+            return True
+
+
+class RetryMiddleware(BaseMiddleware):
+    """Retry idempotent requests that fail with a connection error or
+    timeout, or whose response status is in `statuses`. Before attempt `n`,
+    wait a random time between 0 and `backoff * 2 ** n` seconds, capped at
+    `max_backoff`, or the response's `Retry-After` if longer; responses
+    asking to wait longer than `max_backoff` are returned as they are.
+    Retries are drawn from `budget`, shared by all requests through the
+    middleware unless given per instance.
+
+    Retries are sent through the middlewares registered after this one
+    (see `BaseMiddleware::around_send`), each attempt as a copy of the
+    request; middlewares registered before it see a single request and its
+    final response or error. Register caches before and throttlers after
+    it, e.g. ``[CacheMiddleware(), RetryMiddleware(),
+    ThrottleMiddleware(throttler)]``: cache hits are then never retried,
+    `stale-if-error` applies once retries are exhausted, and every attempt
+    is throttled, so that adaptive throttlers see each failure.
+
+    Requests with a streamed body (e.g. a file or generator) are not
+    retried, since their body cannot be replayed.
+
+    :param int retries: Retries per request
+    :param statuses: Response statuses to retry
+    :param methods: Methods to retry; defaults to the idempotent methods
+    :param float backoff: Base delay, in seconds
+    :param float max_backoff: Longest delay, in seconds
+    :param RetryBudget budget: Budget to draw retries from
+    """
+    def __init__(self, retries=3, statuses=(429, 502, 503, 504),
+                 methods=IDEMPOTENT_METHODS, backoff=0.1, max_backoff=10.0,
+                 budget=None):
+        self.retries = retries
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+
+    def retryable(self, request):
+        body = request.body
+        replayable = body is None or isinstance(
+            body, (six.binary_type, six.text_type)
+        )
+        return replayable and request.method.upper() in self.methods
+
+    def delay(self, attempt, response=None):
+        """Return the seconds to wait before retrying after `attempt`
+        attempts, or `None` if `response` asks to wait too long.
+        """
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt),
+        )
+        pause = retry_after(response.headers) if response is not None else None
+        if pause is not None:
+            if pause > self.max_backoff:
+                return None
+            delay = max(delay, pause)
+        return delay
+
+    def around_send(self, send, request, **kwargs):
+        self.budget.request()
+        if not self.retryable(request):
+            return send(request, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                response = send(request.copy(), **kwargs)
+            except SSLError:
+                raise
+            except (ConnectionError, Timeout):
+                delay = self.delay(attempt)
+                if not self.retry(attempt, delay):
+                    raise
+            else:
+                if response.status_code not in self.statuses:
+                    return response
+                delay = self.delay(attempt, response)
+                if not self.retry(attempt, delay):
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def retry(self, attempt, delay):
+        if attempt >= self.retries or delay is None:
+            return False
+        return self.budget.withdraw()
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+"""robots.txt rules and crawl delays. `reppy` is imported when the first
+robots.txt cache is created.
+"""
 
-import datetime
+import time
+import threading
 import collections
-from reppy.cache import RobotsCache
+from multiprocessing.pool import ThreadPool
 import six.moves.urllib_parse as urlparse
 from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+from requests_middleware.utils import StripedLock, lazy_subclass
 
 
 class RobotsError(Exception):
@@ -19,29 +25,224 @@ class RobotsThrottledError(RobotsError):
     pass
 
 
+class FetchFailure(object):
+    """Cached record of a failed robots.txt fetch, so that the failure is
+    re-raised without refetching until it expires.
+    """
+    def __init__(self, url, error, expires):
+        self.url = url
+        self.error = error
+        self.expires = expires
+
+    @property
+    def expired(self):
+        return self.expires <= time.time()
+
+
+class BoundedRobotsCacheMixin(object):
+    """Thread-safe `reppy` robots.txt cache holding at most `capacity` hosts,
+    evicting the least recently used. Rules expire according to the
+    robots.txt response's caching headers, as with `RobotsCache`; 4xx
+    responses are cached as unrestricted (or forbidden) rules. Fetch errors
+    and 5xx responses are cached for `error_ttl` seconds and re-raised. Only
+    one thread fetches a given host's robots.txt at a time.
+
+    Remaining arguments are passed to `RobotsCache`. The class,
+    `BoundedRobotsCache`, is returned by :func:`bounded_robots_cache_class`.
+
+    :param int capacity: Maximum number of hosts to cache
+    :param int error_ttl: Seconds to cache fetch failures
+    """
+    def __init__(self, *args, **kwargs):
+        self.capacity = kwargs.pop('capacity', 10000)
+        self.error_ttl = kwargs.pop('error_ttl', 300)
+        super(BoundedRobotsCacheMixin, self).__init__(*args, **kwargs)
+        self._cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.fetch_locks = StripedLock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def lookup(self, key, honor_ttl=True):
+        with self.lock:
+            cached = self._cache.pop(key, None)
+            if cached is None or (honor_ttl and cached.expired):
+                return None
+            self._cache[key] = cached
+            return cached
+
+    def find(self, url, fetch_if_missing=False, honor_ttl=True):
+        from reppy import Utility
+        key = Utility.hostname(url)
+        cached = self.lookup(key, honor_ttl)
+        if cached is None and fetch_if_missing:
+            with self.fetch_locks.get(key):
+                cached = self.lookup(key, honor_ttl)
+                if cached is None:
+                    cached = self.cache(url, *self.args, **self.kwargs)
+        if isinstance(cached, FetchFailure):
+            raise cached.error
+        return cached
+
+    def cache(self, url, *args, **kwargs):
+        from reppy import Utility
+        from reppy.exceptions import ReppyException
+        try:
+            fetched = self.fetch(url, *args, **kwargs)
+        except ReppyException as error:
+            fetched = FetchFailure(
+                Utility.roboturl(url), error, time.time() + self.error_ttl,
+            )
+        self.add(fetched)
+        return fetched
+
+    def add(self, rules):
+        from reppy import Utility
+        key = Utility.hostname(rules.url)
+        with self.lock:
+            self._cache.pop(key, None)
+            self._cache[key] = rules
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self._cache.clear()
+
+    def prefetch(self, urls, workers=16):
+        """Fetch robots.txt for each of `urls` concurrently, so that later
+        requests to those hosts do not block on the fetch. Hosts given without
+        a scheme are assumed to use HTTP. Failures are cached, not raised.
+
+        :param urls: Iterable of URLs or hostnames
+        :param int workers: Number of fetching threads
+        :returns: List of `Rules` or `FetchFailure` objects
+        """
+        urls = [
+            url if '://' in url else 'http://' + url
+            for url in urls
+        ]
+        pool = ThreadPool(max(1, min(workers, len(urls))))
+        try:
+            return pool.map(self._prefetch, urls)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _prefetch(self, url):
+        from reppy import Utility
+        from reppy.exceptions import ReppyException
+        try:
+            return self.find(url, fetch_if_missing=True)
+        except ReppyException:
+            return self.lookup(Utility.hostname(url))
+
+
+def bounded_robots_cache_class():
+    """Return :class:`BoundedRobotsCache`, importing `reppy` on first use."""
+    return lazy_subclass(BoundedRobotsCacheMixin, 'reppy.cache', 'RobotsCache')
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def shared_robots_cache():
+    """Return the process-wide :class:`BoundedRobotsCache`, creating it on
+    first use.
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = bounded_robots_cache_class()()
+        return _shared_cache
+
+
 class RobotsMiddleware(BaseMiddleware):
+    """Enforce robots.txt rules and crawl delays. Crawl delays are measured
+    with a monotonic clock at sub-second precision. By default a request
+    made within a host's crawl delay raises `RobotsThrottledError`; if
+    `schedule` is set, it instead sleeps until the host's next slot, raising
+    only if that would take longer than `max_wait` seconds. Scheduled
+    requests reserve their slots in order.
+
+    Positional and remaining keyword arguments build a private
+    :class:`BoundedRobotsCache`, as they built a `RobotsCache` before; with
+    none, the process-wide cache shared by all `RobotsMiddleware` instances
+    is used. The options below are keyword-only.
 
+    :param cache: :class:`BoundedRobotsCache` to use instead
+    :param bool schedule: Wait for the crawl delay instead of raising
+    :param float max_wait: Longest time to wait, in seconds, or `None` for no
+        limit
+    """
     def __init__(self, *args, **kwargs):
-        self.cache = RobotsCache(*args, **kwargs)
+        cache = kwargs.pop('cache', None)
+        self.schedule = kwargs.pop('schedule', False)
+        self.max_wait = kwargs.pop('max_wait', None)
+        if cache is None:
+            if args or kwargs:
+                cache = bounded_robots_cache_class()(*args, **kwargs)
+            else:
+                cache = shared_robots_cache()
+        self.cache = cache
         self.visited = collections.defaultdict(dict)
+        self.locks = StripedLock()
+
+    def prefetch(self, urls, workers=16):
+        """Fetch robots.txt for `urls` ahead of a crawl; see
+        :meth:`BoundedRobotsCache.prefetch`.
+        """
+        return self.cache.prefetch(urls, workers=workers)
+
+    def next_allowed(self, url, agent):
+        """Return the earliest time, on the `compat.monotonic` clock, at
+        which `agent` may next request `url` without waiting. External
+        schedulers can use this to order work across hosts.
+        """
+        now = compat.monotonic()
+        delay = self.cache.delay(url, agent)
+        if delay is None:
+            return now
+        host = urlparse.urlparse(url).hostname
+        last_visit = self.visited[agent].get(host)
+        if last_visit is None:
+            return now
+        return max(now, last_visit + delay)
 
     def check_disallow(self, url, agent):
         if not self.cache.allowed(url, agent):
             raise RobotsDisallowedError
 
-    def check_crawl_delay(self, url, agent):
+    def reserve_crawl_delay(self, url, agent):
+        """Record a visit by `agent` to the host of `url` and return the number
+        of seconds to wait before making it. Raise `RobotsThrottledError` if
+        the visit must wait but scheduling is disabled, or if the wait would
+        exceed `max_wait`.
+        """
         delay = self.cache.delay(url, agent)
         if delay is None:
-            return
-        now = datetime.datetime.utcnow()
+            return 0
         host = urlparse.urlparse(url).hostname
-        try:
-            last_visit = self.visited[agent][host]
-            if (now - last_visit).seconds < delay:
-                raise RobotsThrottledError
-        except KeyError:
-            pass
-        self.visited[agent][host] = now
+        with self.locks.get((agent, host)):
+            now = compat.monotonic()
+            visits = self.visited[agent]
+            last_visit = visits.get(host)
+            slot = now if last_visit is None else max(now, last_visit + delay)
+            wait = slot - now
+            if wait > 0:
+                if not self.schedule:
+                    raise RobotsThrottledError
+                if self.max_wait is not None and wait > self.max_wait:
+                    raise RobotsThrottledError
+            visits[host] = slot
+            return wait
+
+    def check_crawl_delay(self, url, agent):
+        wait = self.reserve_crawl_delay(url, agent)
+        if wait > 0:
+            time.sleep(wait)
 
     def before_send(self, request, *args, **kwargs):
         url = request.url
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import weakref
+import functools
+import itertools
+
+import six
+
 from requests_middleware import BaseMiddleware
 
 
+ROUND_ROBIN = 'round-robin'
+LEAST_LOADED = 'least-loaded'
+
+
 class SourceMiddleware(BaseMiddleware):
 
     def __init__(self, address, port):
@@ -11,3 +21,76 @@ class SourceMiddleware(BaseMiddleware):
 
     def before_init_poolmanager(self, connections, maxsize, block=False):
         return {'source_address': (self.address, self.port)}
+
+
+def busy(pool):
+    """Number of connections checked out of `pool`."""
+    queue = pool.pool
+    if queue is None:
+        return 0
+    return max(queue.maxsize - queue.qsize(), 0)
+
+
+class RotatingSourceMiddleware(BaseMiddleware):
+    """Spread connections across several local addresses, keeping separate
+    connection pools per source address. With `ROUND_ROBIN`, each request
+    takes the next address in turn; with `LEAST_LOADED`, it takes the
+    address whose pool to the destination has the fewest connections
+    checked out, breaking ties in turn. Only the chosen address's pool is
+    fetched from the `PoolManager`; the load of the others is read from the
+    pools last used for them. The `PoolManager` keeps `pool_connections`
+    pools per source address, so that the pools of several hosts and
+    addresses do not evict each other (closing their keep-alive
+    connections). Like other hooks called during adapter initialization,
+    the middleware must be passed to the adapter's `__init__`. Proxied
+    requests are not rotated.
+
+    :param list addresses: Local addresses, as host strings or
+        `(host, port)` tuples; port 0 picks an ephemeral port
+    :param str strategy: `ROUND_ROBIN` or `LEAST_LOADED`
+    """
+    def __init__(self, addresses, strategy=ROUND_ROBIN):
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError('Unknown strategy: {0}'.format(strategy))
+        self.addresses = [
+            (address, 0) if isinstance(address, six.string_types)
+            else tuple(address)
+            for address in addresses
+        ]
+        if not self.addresses:
+            raise ValueError('At least one source address is required')
+        self.strategy = strategy
+        self.counter = itertools.count()
+        # Pools last used, by scheme, host, port and source address
+        self.pools = weakref.WeakValueDictionary()
+
+    def before_init_poolmanager(self, connections, maxsize, block=False):
+        return {'num_pools': connections * len(self.addresses)}
+
+    def after_init_poolmanager(self, poolmanager):
+        poolmanager.connection_from_host = functools.partial(
+            self.connection_from_host, poolmanager.connection_from_host,
+        )
+
+    def connection_from_host(self, connection_from_host, host, port=None,
+                             scheme='http', pool_kwargs=None):
+        """Return the pool to `host` bound to the chosen source address."""
+        start = next(self.counter) % len(self.addresses)
+        rotated = self.addresses[start:] + self.addresses[:start]
+        address = rotated[0]
+        if self.strategy == LEAST_LOADED:
+            address = min(
+                rotated, key=lambda address: self.load(
+                    (scheme, host, port, address)
+                ),
+            )
+        pool = connection_from_host(
+            host, port, scheme,
+            pool_kwargs=dict(pool_kwargs or {}, source_address=address),
+        )
+        self.pools[(scheme, host, port, address)] = pool
+        return pool
+
+    def load(self, key):
+        pool = self.pools.get(key)
+        return 0 if pool is None else busy(pool)
@@ -1,12 +1,231 @@
 # -*- coding: utf-8 -*-
 
+import ssl
+import functools
+import threading
+import collections
+
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
 from requests_middleware import BaseMiddleware
 
 
+# Pool keyword arguments that select a distinct shared context
+CONTEXT_KEYS = ('cert_reqs', 'ca_certs', 'ca_cert_dir', 'cert_file',
+                'key_file')
+
+# Session resumption needs `SSLSocket.session` (Python 3.6+) and
+# `SSLContext.sslsocket_class` (Python 3.7+)
+HAS_SESSIONS = hasattr(ssl, 'SSLSession') and hasattr(
+    ssl.SSLContext, 'sslsocket_class'
+)
+
+
+def cert_none(cert_reqs):
+    return cert_reqs in (ssl.CERT_NONE, 'CERT_NONE', 'NONE')
+
+
+class ResumingSSLSocket(ssl.SSLSocket):
+    """`SSLSocket` handing its session back to its context when closed.
+    TLS 1.3 session tickets arrive after the handshake, so the session is
+    only worth resuming once the connection has been used.
+    """
+    def _real_close(self):
+        if self._sslobj is not None and not self.server_side:
+            self.context.save_session(self)
+        super(ResumingSSLSocket, self)._real_close()
+
+
+class SharedSSLContext(ssl.SSLContext):
+    """`SSLContext` shared by every connection of a set of pools. Its CA
+    certificates, ciphers and ALPN protocols are configured once; urllib3's
+    per-connection calls to `load_verify_locations` and
+    `set_alpn_protocols` are skipped once the context is :meth:`frozen
+    <freeze>`, and client certificates are loaded once per file.
+
+    With `max_sessions`, TLS sessions are cached per server address and
+    offered when reconnecting, so that servers supporting resumption skip
+    the full handshake. `handshakes` and `resumed` count handshakes and
+    resumed sessions.
+    """
+    def __init__(self, protocol, max_sessions=None):
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.cert_chains = set()
+        self.frozen = False
+        self.handshakes = 0
+        self.resumed = 0
+        self.session_lock = threading.Lock()
+
+    if HAS_SESSIONS:
+        sslsocket_class = ResumingSSLSocket
+
+    def freeze(self):
+        self.frozen = True
+
+    def load_verify_locations(self, *args, **kwargs):
+        if not self.frozen:
+            super(SharedSSLContext, self).load_verify_locations(
+                *args, **kwargs
+            )
+
+    def set_alpn_protocols(self, protocols):
+        if not self.frozen:
+            super(SharedSSLContext, self).set_alpn_protocols(protocols)
+
+    def load_cert_chain(self, certfile, keyfile=None, password=None):
+        key = (certfile, keyfile)
+        with self.session_lock:
+            if key in self.cert_chains:
+                return
+        super(SharedSSLContext, self).load_cert_chain(
+            certfile, keyfile, password,
+        )
+        with self.session_lock:
+            self.cert_chains.add(key)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        resume = self.max_sessions and HAS_SESSIONS
+        if resume:
+            key = session_key(sock, kwargs.get('server_hostname'))
+            if kwargs.get('session') is None:
+                with self.session_lock:
+                    kwargs['session'] = self.sessions.get(key)
+        sslsock = super(SharedSSLContext, self).wrap_socket(
+            sock, *args, **kwargs
+        )
+        with self.session_lock:
+            self.handshakes += 1
+            if getattr(sslsock, 'session_reused', False):
+                self.resumed += 1
+        if resume:
+            sslsock.session_key = key
+            self.save_session(sslsock)
+        return sslsock
+
+    def save_session(self, sslsock):
+        """Cache the session of client socket `sslsock` if resumable."""
+        key = getattr(sslsock, 'session_key', None)
+        if key is None or not self.max_sessions:
+            return
+        try:
+            session = sslsock.session
+            tls13 = sslsock.version() == 'TLSv1.3'
+        except (ValueError, OSError, AttributeError):
+            return
+        if session is None or (tls13 and not session.has_ticket):
+            return
+        with self.session_lock:
+            self.sessions.pop(key, None)
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+
+def session_key(sock, server_hostname):
+    try:
+        peer = sock.getpeername()[:2]
+    except (OSError, AttributeError):
+        peer = None
+    return (server_hostname, peer)
+
+
 class SSLMiddleware(BaseMiddleware):
+    """Share preconfigured `SSLContext` objects between connections instead
+    of building one per connection. A context is built once for each
+    combination of verification mode, CA bundle and client certificate
+    requested through the adapter, with `ciphers`, `alpn_protocols` and the
+    CA bundle applied when it is built: `ca_certs` or `ca_cert_dir` if
+    given, else a request's `verify` path, else the `requests` bundle.
 
-    def __init__(self, ssl_version):
+    Unless `max_sessions` is 0, TLS sessions are cached per server, so that
+    reconnecting (e.g. after a keep-alive timeout) resumes the session
+    rather than repeating the full handshake. :meth:`stats` reports
+    handshake counts. Like other hooks called during adapter
+    initialization, the middleware must be passed to the adapter's
+    `__init__`. Proxy connections do not use the shared contexts.
+
+    :param ssl_version: Protocol passed to `SSLContext`; also passed to
+        `PoolManager` as before. Defaults to `PROTOCOL_TLS_CLIENT`
+    :param str ciphers: OpenSSL cipher string
+    :param list alpn_protocols: ALPN protocols to offer
+    :param str ca_certs: Path of a CA bundle
+    :param str ca_cert_dir: Path of a directory of CA certificates
+    :param int max_sessions: Number of servers whose sessions are cached
+    """
+    def __init__(self, ssl_version=None, ciphers=None, alpn_protocols=None,
+                 ca_certs=None, ca_cert_dir=None, max_sessions=1000):
         self.ssl_version = ssl_version
+        self.ciphers = ciphers
+        self.alpn_protocols = alpn_protocols
+        self.ca_certs = ca_certs
+        self.ca_cert_dir = ca_cert_dir
+        self.max_sessions = max_sessions
+        self.contexts = {}
+        self.lock = threading.Lock()
 
     def before_init_poolmanager(self, connections, maxsize, block=False):
-        return {'ssl_version': self.ssl_version}
+        if self.ssl_version is not None:
+            return {'ssl_version': self.ssl_version}
+
+    def after_init_poolmanager(self, poolmanager):
+        poolmanager.connection_from_host = functools.partial(
+            self.connection_from_host, poolmanager.connection_from_host,
+        )
+
+    def connection_from_host(self, connection_from_host, host, port=None,
+                             scheme='http', pool_kwargs=None):
+        """Return the pool to `host`, using a shared context for HTTPS."""
+        if scheme == 'https':
+            pool_kwargs = dict(pool_kwargs or {})
+            pool_kwargs['ssl_context'] = self.context_for(pool_kwargs)
+        return connection_from_host(
+            host, port, scheme, pool_kwargs=pool_kwargs,
+        )
+
+    def context_for(self, pool_kwargs):
+        """Return the shared context for the TLS settings in `pool_kwargs`,
+        building it on first use.
+        """
+        key = tuple(pool_kwargs.get(name) for name in CONTEXT_KEYS)
+        with self.lock:
+            context = self.contexts.get(key)
+            if context is None:
+                context = self.build_context(**dict(zip(CONTEXT_KEYS, key)))
+                self.contexts[key] = context
+            return context
+
+    def build_context(self, cert_reqs=None, ca_certs=None, ca_cert_dir=None,
+                      cert_file=None, key_file=None):
+        protocol = self.ssl_version
+        if protocol is None:
+            protocol = ssl.PROTOCOL_TLS_CLIENT
+        context = SharedSSLContext(protocol, max_sessions=self.max_sessions)
+        if cert_none(cert_reqs):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            if self.ca_certs or self.ca_cert_dir:
+                context.load_verify_locations(self.ca_certs, self.ca_cert_dir)
+            elif ca_certs or ca_cert_dir:
+                context.load_verify_locations(ca_certs, ca_cert_dir)
+            else:
+                context.load_verify_locations(DEFAULT_CA_BUNDLE_PATH)
+        if cert_file:
+            context.load_cert_chain(cert_file, key_file)
+        if self.ciphers:
+            context.set_ciphers(self.ciphers)
+        context.set_alpn_protocols(self.alpn_protocols or ['http/1.1'])
+        context.freeze()
+        return context
+
+    def stats(self):
+        """Return the number of TLS handshakes and of resumed sessions."""
+        with self.lock:
+            contexts = list(self.contexts.values())
+        return {
+            'handshakes': sum(context.handshakes for context in contexts),
+            'resumed': sum(context.resumed for context in contexts),
+        }
@@ -2,9 +2,18 @@
 
 import abc
 import six
+import time
+import weakref
 import datetime
+import threading
+import collections
+import six.moves.urllib_parse as urlparse
+
+from requests.exceptions import ConnectionError, Timeout
 
 from requests_middleware import BaseMiddleware
+from requests_middleware import compat
+from requests_middleware.utils import retry_after
 
 
 class ThrottleError(Exception):
@@ -22,41 +31,57 @@ class BaseThrottler(object):
     def store(self, req, resp, response):
         pass
 
+    def error(self, request, error):
+        """Called when sending `request` raises `error`."""
+        pass
 
-class DelayThrottler(BaseThrottler):
 
+class DelayThrottler(BaseThrottler):
+    """Require `delay` seconds between requests. A passing `check` records
+    the visit immediately, so concurrent callers cannot slip through before
+    the first response is stored.
+    """
     def __init__(self, delay):
         self.delay = delay
         self.last_visit = None
+        self.lock = threading.Lock()
 
     def check(self, request):
-        if self.last_visit is None:
-            return
-        elapsed = datetime.datetime.utcnow() - self.last_visit
-        if elapsed.seconds < self.delay:
-            raise ThrottleError()
+        with self.lock:
+            now = datetime.datetime.utcnow()
+            if self.last_visit is not None:
+                elapsed = now - self.last_visit
+                if elapsed.seconds < self.delay:
+                    raise ThrottleError()
+            self.last_visit = now
 
     def store(self, req, resp, response):
-        self.last_visit = datetime.datetime.utcnow()
+        with self.lock:
+            self.last_visit = datetime.datetime.utcnow()
 
 
 class RequestPerTimeThrottler(BaseThrottler):
-
+    """Allow `count` requests until `resetter` reports that the window has
+    passed. A passing `check` reserves one of the `count` slots.
+    """
     def __init__(self, count, resetter):
         self.count = count
         self.resetter = resetter
         self.last_reset = datetime.datetime.utcnow()
         self.visit_count = 0
+        self.lock = threading.Lock()
 
     def check(self, request):
-        if self.resetter(self.last_reset):
-            self.last_reset = datetime.datetime.utcnow()
-            self.visit_count = 0
-        if self.visit_count >= self.count:
-            raise ThrottleError()
+        with self.lock:
+            if self.resetter(self.last_reset):
+                self.last_reset = datetime.datetime.utcnow()
+                self.visit_count = 0
+            if self.visit_count >= self.count:
+                raise ThrottleError()
+            self.visit_count += 1
 
     def store(self, req, resp, response):
-        self.visit_count += 1
+        pass
 
 
 def per_hour_resetter(when):
@@ -70,6 +95,228 @@ class RequestsPerHourThrottler(RequestPerTimeThrottler):
         super(RequestsPerHourThrottler, self).__init__(count, per_hour_resetter)
 
 
+class TokenBucketThrottler(BaseThrottler):
+    """Token bucket holding up to `burst` tokens, refilled at `rate` tokens
+    per second. Each request consumes one token. When the bucket is empty,
+    `check` raises `ThrottleError`; if `block` is set, it instead sleeps
+    until the caller's token is available, raising only if that would take
+    longer than `max_wait` seconds. Waiting callers reserve their tokens in
+    order, so concurrent threads are released at exactly `rate`.
+
+    :param float rate: Tokens added per second
+    :param int burst: Bucket capacity
+    :param bool block: Sleep until a token is available instead of raising
+    :param float max_wait: Longest time to sleep, in seconds, or `None` for
+        no limit
+    """
+    def __init__(self, rate, burst=1, block=False, max_wait=None):
+        if rate <= 0:
+            raise ValueError('Token bucket rate must be positive')
+        if burst < 1:
+            raise ValueError('Token bucket burst must be at least 1')
+        self.rate = float(rate)
+        self.burst = burst
+        self.block = block
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.last_refill = compat.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, going into debt if none is available, and return the
+        number of seconds until the token may be used. If the token cannot be
+        used within the configured wait, leave the bucket unchanged and raise
+        `ThrottleError`.
+        """
+        with self.lock:
+            self.refill(compat.monotonic())
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > 0:
+                if not self.block:
+                    raise ThrottleError()
+                if self.max_wait is not None and wait > self.max_wait:
+                    raise ThrottleError()
+            self.tokens -= 1
+            return wait
+
+    def refill(self, now):
+        """Add the tokens accrued up to `now`. Called with `lock` held."""
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.last_refill) * self.rate,
+        )
+        self.last_refill = now
+
+    def check(self, request):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def store(self, req, resp, response):
+        pass
+
+
+class AdaptiveThrottler(TokenBucketThrottler):
+    """Token bucket whose rate adapts to the responses it sees, by additive
+    increase and multiplicative decrease (AIMD). Each successful response
+    arriving within `latency_target` seconds of its request raises the rate
+    by `increase / rate`, i.e. by about `increase` requests per second for
+    each second of traffic. A response with a status in `backoff_statuses`
+    or a `Retry-After` header, a slower response, or a connection error or
+    timeout multiplies the rate by `decrease`. Signals from requests sent
+    before the last decrease are ignored, so a burst of failures from
+    requests already in flight cuts the rate only once. `Retry-After` also
+    holds back all requests for the given time.
+
+    Use one per host, e.g. ``KeyedThrottler(lambda: AdaptiveThrottler())``.
+
+    :param float rate: Initial requests per second
+    :param float min_rate: Lowest rate
+    :param float max_rate: Highest rate
+    :param float increase: Additive increase, in requests per second
+    :param float decrease: Multiplicative decrease factor
+    :param float latency_target: Response time, in seconds, above which to
+        back off, or `None` to ignore latency
+    :param backoff_statuses: Statuses to back off on
+    :param int burst: Bucket capacity
+    :param bool block: Sleep until a token is available instead of raising
+    :param float max_wait: Longest time to sleep, in seconds, or `None` for
+        no limit
+    """
+    def __init__(self, rate=1.0, min_rate=0.1, max_rate=100.0, increase=1.0,
+                 decrease=0.5, latency_target=None,
+                 backoff_statuses=(429, 503), burst=1, block=False,
+                 max_wait=None):
+        if not 0 < min_rate <= rate <= max_rate:
+            raise ValueError('Adaptive rates must satisfy '
+                             '0 < min_rate <= rate <= max_rate')
+        if not 0 < decrease < 1:
+            raise ValueError('Adaptive decrease must be between 0 and 1')
+        super(AdaptiveThrottler, self).__init__(
+            rate, burst=burst, block=block, max_wait=max_wait,
+        )
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.backoff_statuses = frozenset(backoff_statuses)
+        self.last_decrease = None
+        self.sent = weakref.WeakKeyDictionary()
+
+    def check(self, request):
+        super(AdaptiveThrottler, self).check(request)
+        if request is not None:
+            with self.lock:
+                self.sent[request] = compat.monotonic()
+
+    def store(self, req, resp, response):
+        now = compat.monotonic()
+        pause = retry_after(response.headers)
+        with self.lock:
+            sent = self.sent.pop(req, None) if req is not None else None
+            slow = self.latency_target is not None and sent is not None
+            slow = slow and now - sent > self.latency_target
+            self.refill(now)
+            if response.status_code in self.backoff_statuses or pause:
+                self.back_off(sent, now)
+                if pause:
+                    # Go into debt so the next token is `pause` seconds away
+                    self.tokens = min(self.tokens, 1 - pause * self.rate)
+            elif slow:
+                self.back_off(sent, now)
+            elif response.status_code < 400:
+                self.rate = min(
+                    self.max_rate, self.rate + self.increase / self.rate,
+                )
+
+    def error(self, request, error):
+        if not isinstance(error, (ConnectionError, Timeout)):
+            return
+        now = compat.monotonic()
+        with self.lock:
+            sent = self.sent.pop(request, None)
+            self.refill(now)
+            self.back_off(sent, now)
+
+    def back_off(self, sent, now):
+        """Decrease the rate unless `sent` does not follow the last
+        decrease.
+        Called with `lock` held.
+        """
+        stale = None not in (sent, self.last_decrease)
+        if stale and sent <= self.last_decrease:
+            return
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.last_decrease = now
+
+
+def host_key(request):
+    """Throttle key: the request's hostname."""
+    return urlparse.urlparse(request.url).hostname
+
+
+def scheme_host_key(request):
+    """Throttle key: the request's scheme and network location."""
+    parsed = urlparse.urlparse(request.url)
+    return '{0}://{1}'.format(parsed.scheme, parsed.netloc.lower())
+
+
+class KeyedThrottler(BaseThrottler):
+    """Keep an independent throttler per key, so a slow or rate-limited host
+    does not hold back requests to other hosts. Keys are spread across
+    `shards` independently locked maps, so threads working on different
+    keys rarely contend. Each map keeps its throttlers in LRU order and
+    holds at most `max_keys // shards` of them, so that at most `max_keys`
+    are held in all; as keys hash unevenly, a throttler may be dropped
+    before `max_keys` are held. There are never more shards than
+    `max_keys`.
+
+    Example: ``KeyedThrottler(lambda: DelayThrottler(5))``
+
+    :param factory: Callable returning a new :class:`BaseThrottler` for a key
+    :param key: Callable mapping a `PreparedRequest` to a hashable key;
+        defaults to :func:`host_key`
+    :param int max_keys: Maximum number of keys to track
+    :param int shards: Number of independently locked LRU maps
+    """
+    def __init__(self, factory, key=host_key, max_keys=10000, shards=16):
+        self.factory = factory
+        self.key = key
+        shards = max(1, min(shards, max_keys))
+        self.shards = tuple(
+            (threading.Lock(), collections.OrderedDict())
+            for _ in range(shards)
+        )
+        self.shard_size = max(1, max_keys // shards)
+
+    def __len__(self):
+        return sum(len(throttlers) for _, throttlers in self.shards)
+
+    def get(self, key):
+        """Return the throttler for `key`, creating it if necessary and
+        marking it most recently used.
+        """
+        lock, throttlers = self.shards[hash(key) % len(self.shards)]
+        with lock:
+            throttler = throttlers.pop(key, None)
+            if throttler is None:
+                throttler = self.factory()
+                while len(throttlers) >= self.shard_size:
+                    throttlers.popitem(last=False)
+            throttlers[key] = throttler
+            return throttler
+
+    def check(self, request):
+        self.get(self.key(request)).check(request)
+
+    def store(self, req, resp, response):
+        self.get(self.key(req)).store(req, resp, response)
+
+    def error(self, request, error):
+        self.get(self.key(request)).error(request, error)
+
+
 class ThrottleMiddleware(BaseMiddleware):
 
     def __init__(self, throttler):
@@ -81,3 +328,6 @@ class ThrottleMiddleware(BaseMiddleware):
     def after_build_response(self, req, resp, response):
         self.throttler.store(req, resp, response)
         return response
+
+    def on_send_error(self, request, error):
+        self.throttler.error(request, error)
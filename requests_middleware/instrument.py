@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Latency instrumentation for :class:`MiddlewareHTTPAdapter
+<requests_middleware.middleware.MiddlewareHTTPAdapter>`.
+"""
+
+import math
+import threading
+
+from requests_middleware import compat
+
+
+# Buckets per power of two; bucket bounds are at most 19% apart
+SUB_BUCKETS = 4
+# Smallest and largest bucketed latencies: 1 microsecond to ~38 hours
+MIN_EXPONENT = 0
+MAX_EXPONENT = 37
+BUCKETS = (MAX_EXPONENT - MIN_EXPONENT) * SUB_BUCKETS
+
+# Label under which `HTTPAdapter::send` is recorded
+SEND = 'HTTPAdapter'
+# Host label used once `max_keys` histograms exist
+OTHER_HOST = '*'
+
+
+def bucket_index(seconds):
+    """Return the histogram bucket holding a latency of `seconds`."""
+    mantissa, exponent = math.frexp(seconds * 1e6)
+    if exponent <= MIN_EXPONENT:
+        return 0
+    if exponent > MAX_EXPONENT:
+        return BUCKETS - 1
+    sub = int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+    return (exponent - MIN_EXPONENT - 1) * SUB_BUCKETS + sub
+
+
+def bucket_bound(index):
+    """Return the upper bound, in seconds, of bucket `index`."""
+    exponent, sub = divmod(index, SUB_BUCKETS)
+    return (2.0 ** (exponent + MIN_EXPONENT)) * (
+        1 + float(sub + 1) / SUB_BUCKETS
+    ) / 1e6
+
+
+def host_of(url):
+    """Return the `host[:port]` of `url` without a full parse."""
+    parts = url.split('/', 3)
+    return parts[2] if len(parts) > 2 else ''
+
+
+class Histogram(object):
+    """Fixed-size latency histogram with logarithmic buckets. Recording is
+    constant-time; quantiles are estimated from bucket upper bounds.
+    """
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        index = bucket_index(seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def merge(self, other):
+        """Add the observations of histogram `other` to this one."""
+        with other.lock:
+            counts = list(other.counts)
+            count, total = other.count, other.total
+            low, high = other.min, other.max
+        with self.lock:
+            for index, value in enumerate(counts):
+                self.counts[index] += value
+            self.count += count
+            self.total += total
+            if low is not None and (self.min is None or low < self.min):
+                self.min = low
+            if high is not None and (self.max is None or high > self.max):
+                self.max = high
+
+    def quantile(self, q):
+        """Estimate the `q` quantile (0 to 1), in seconds."""
+        with self.lock:
+            if not self.count:
+                return None
+            rank = max(1, int(math.ceil(q * self.count)))
+            seen = 0
+            for index, value in enumerate(self.counts):
+                seen += value
+                if seen >= rank:
+                    return min(bucket_bound(index), self.max)
+            return self.max
+
+    def summary(self):
+        """Return count, total, mean, min, max and p50/p90/p99 latencies."""
+        with self.lock:
+            count, total = self.count, self.total
+            low, high = self.min, self.max
+        return {
+            'count': count,
+            'total': total,
+            'mean': total / count if count else None,
+            'min': low,
+            'max': high,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Instrumentation(object):
+    """Per-hook latency histograms for a :class:`MiddlewareHTTPAdapter
+    <requests_middleware.middleware.MiddlewareHTTPAdapter>`, keyed by hook
+    name, middleware class name and request host. `HTTPAdapter::send` is
+    recorded under the hook `send` and the name `HTTPAdapter`; it runs
+    until response headers are received, and excludes the build hooks it
+    calls, which are recorded separately.
+
+    :param callback: Optional callable `callback(hook, name, host, seconds)`
+        called with each observation, e.g. to export it to a metrics system.
+        Exceptions it raises are ignored.
+    :param int max_keys: Maximum number of histograms; further hosts are
+        recorded under the host `'*'`
+    """
+    def __init__(self, callback=None, max_keys=10000):
+        self.callback = callback
+        self.max_keys = max_keys
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def histogram(self, key):
+        histogram = self.histograms.get(key)
+        if histogram is not None:
+            return histogram
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                if len(self.histograms) >= self.max_keys:
+                    key = key[:2] + (OTHER_HOST, )
+                    histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+            return histogram
+
+    def record(self, hook, name, url, seconds):
+        """Record that `hook` of middleware `name` took `seconds` for a
+        request to `url`.
+        """
+        host = host_of(url)
+        self.histogram((hook, name, host)).record(seconds)
+        if self.callback is not None:
+            try:
+                self.callback(hook, name, host, seconds)
+            except Exception:
+                pass
+
+    def wrap(self, hook, name, label):
+        """Return hook method `hook` timed, recording its calls under hook
+        `name` and middleware name `label`.
+        """
+        timer = compat.perf_counter
+        local = self.local
+        building = name in ('before_build_response', 'after_build_response')
+
+        def timed(request, *args, **kwargs):
+            start = timer()
+            try:
+                return hook(request, *args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                if building:
+                    local.building = getattr(local, 'building', 0) + elapsed
+                self.record(name, label, request.url, elapsed)
+        return timed
+
+    def time_send(self, send, request, *args, **kwargs):
+        """Call `send(request, ...)`, recording its duration less the time
+        spent in build hooks.
+        """
+        timer = compat.perf_counter
+        self.local.building = 0
+        start = timer()
+        try:
+            return send(request, *args, **kwargs)
+        finally:
+            elapsed = timer() - start - self.local.building
+            self.record('send', SEND, request.url, max(0.0, elapsed))
+
+    def snapshot(self):
+        """Return a summary of each histogram, as a list of dictionaries
+        with keys `hook`, `name` and `host` plus those of
+        :meth:`Histogram.summary`.
+        """
+        with self.lock:
+            items = list(self.histograms.items())
+        rows = []
+        for (hook, name, host), histogram in sorted(items):
+            row = histogram.summary()
+            row.update(hook=hook, name=name, host=host)
+            rows.append(row)
+        return rows
+
+    def aggregate(self, by=('hook', 'name')):
+        """Merge histograms over the key fields not in `by`.
+
+        :param by: Key fields to group by, from `hook`, `name` and `host`
+        :returns: Dictionary mapping tuples of the `by` fields to merged
+            :class:`Histogram` objects
+        """
+        fields = ('hook', 'name', 'host')
+        positions = [fields.index(field) for field in by]
+        with self.lock:
+            items = list(self.histograms.items())
+        merged = {}
+        for key, histogram in items:
+            group = tuple(key[position] for position in positions)
+            merged.setdefault(group, Histogram()).merge(histogram)
+        return merged
+
+    def reset(self):
+        """Discard all recorded observations."""
+        with self.lock:
+            self.histograms = {}
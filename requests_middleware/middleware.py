@@ -1,12 +1,57 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+import six
+
 from requests import Response
 from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
 from requests.packages.urllib3.response import HTTPResponse
 from requests.packages.urllib3.poolmanager import PoolManager
 
 
-class MiddlewareHTTPAdapter(HTTPAdapter):
+class MiddlewareStack(object):
+    """Mixin holding an ordered stack of middlewares and the
+    :class:`DispatchPlan <DispatchPlan>` built from it.
+    """
+    def register(self, middleware):
+        """Add a middleware to the middleware stack.
+
+        :param BaseMiddleware middleware: The middleware object
+        """
+        self.middlewares.append(middleware)
+        self._plan = self.build_plan()
+
+    def unregister(self, middleware):
+        """Remove a middleware from the middleware stack.
+
+        :param BaseMiddleware middleware: The middleware object
+        """
+        self.middlewares.remove(middleware)
+        self._plan = self.build_plan()
+
+    def build_plan(self):
+        return DispatchPlan(
+            self.middlewares, getattr(self, 'instrumentation', None),
+        )
+
+    @property
+    def plan(self):
+        """The :class:`DispatchPlan <DispatchPlan>` for the current stack.
+        Rebuilt if `middlewares` has been modified in place since the plan was
+        last built.
+        """
+        if self._plan.middlewares != self.middlewares:
+            self._plan = self.build_plan()
+        return self._plan
+
+
+class MiddlewareHTTPAdapter(MiddlewareStack, HTTPAdapter):
     """An HTTPAdapter onto which :class:`BaseMiddleware <BaseMiddleware>`
     can be registered. Middleware methods are called in the order of
     registration. Note: contrib that expose actions called during adapter
@@ -15,18 +60,27 @@ class MiddlewareHTTPAdapter(HTTPAdapter):
 
     :param list middlewares: List of :class:`BaseMiddleware <BaseMiddleware>`
         objects
+    :param instrumentation: Optional keyword argument; an
+        :class:`Instrumentation <requests_middleware.instrument.Instrumentation>`
+        recording the latency of each hook and of `HTTPAdapter::send`
 
     """
     def __init__(self, middlewares=None, *args, **kwargs):
         self.middlewares = middlewares or []
+        self.instrumentation = kwargs.pop('instrumentation', None)
+        self._plan = self.build_plan()
+        self._dispatching = threading.local()
         super(MiddlewareHTTPAdapter, self).__init__(*args, **kwargs)
 
-    def register(self, middleware):
-        """Add a middleware to the middleware stack.
+    def instrument(self, instrumentation):
+        """Start recording hook latencies with `instrumentation`, or stop if
+        it is `None`.
 
-        :param BaseMiddleware middleware: The middleware object
+        :param instrumentation: An :class:`Instrumentation
+            <requests_middleware.instrument.Instrumentation>` or `None`
         """
-        self.middlewares.append(middleware)
+        self.instrumentation = instrumentation
+        self._plan = self.build_plan()
 
     def init_poolmanager(self, connections, maxsize, block=False):
         """Assemble keyword arguments to be passed to `PoolManager`.
@@ -34,47 +88,215 @@ class MiddlewareHTTPAdapter(HTTPAdapter):
         define conflicting arguments, the higher-priority middleware will take
         precedence. Note: Arguments are passed directly to `PoolManager` and
         not to the superclass `init_poolmanager` because the superclass method
-        does not currently accept **kwargs.
+        does not currently accept **kwargs. Middlewares may also override
+        `num_pools`, `maxsize` and `block`. Once the `PoolManager` is built,
+        it is passed to the `after_init_poolmanager` method of each
+        middleware, in reverse order.
         """
         kwargs = {}
-        for middleware in self.middlewares[::-1]:
-            value = middleware.before_init_poolmanager(
-                connections, maxsize, block
-            )
+        for hook in self.plan.before_init_poolmanager:
+            value = hook(connections, maxsize, block)
             kwargs.update(value or {})
 
         self._pool_connections = connections
         self._pool_maxsize = maxsize
         self._pool_block = block
 
-        self.poolmanager = PoolManager(
-            num_pools=connections, maxsize=maxsize, block=block,
-            **kwargs
-        )
+        options = {'num_pools': connections, 'maxsize': maxsize, 'block': block}
+        options.update(kwargs)
+        self.poolmanager = PoolManager(**options)
+        for hook in self.plan.after_init_poolmanager:
+            hook(self.poolmanager)
 
     def send(self, request, *args, **kwargs):
         """Send the request. If any middleware in the stack returns a `Response`
         or `HTTPResponse` value from its `before_send` method, short-circuit;
-        else delegate to `HTTPAdapter::send`.
+        else delegate to `HTTPAdapter::send`. A `Response` is passed to the
+        `on_local_response` method of each middleware before the one
+        returning it, in reverse order. An `HTTPResponse` marked with
+        :func:`mark_local` is passed to :meth:`build_local_response`, others
+        to :meth:`build_response`. If sending raises, pass the
+        exception to the `on_send_error` method of each middleware in the
+        stack, in reverse order, then re-raise it unless a middleware
+        returned a `Response` to use instead.
+
+        If a middleware overrides `around_send`, the middlewares registered
+        after it are sent through by its `around_send` method rather than
+        directly; see :class:`DispatchPlan <DispatchPlan>`.
 
         :param request: The :class:`PreparedRequest <PreparedRequest>`
             being sent.
         :returns: The :class:`Response <Response>` object.
         """
-        for middleware in self.middlewares:
-            value = middleware.before_send(request, **kwargs)
+        return self.dispatch(self.plan, request, *args, **kwargs)
+
+    def dispatch(self, plan, request, *args, **kwargs):
+        """Send the request through the middlewares of `plan`, as described
+        in :meth:`send`.
+        """
+        try:
+            response = self.run_before_send(plan, request, kwargs)
+            if response is not None:
+                return response
+            return self.forward(plan, request, args, kwargs)
+        except Exception as error:
+            recovered = self.recover(plan, request, error)
+            if recovered is not None:
+                return recovered
+            raise
+
+    def run_before_send(self, plan, request, kwargs):
+        """Call the `before_send` hooks of `plan`, returning the response
+        built from the first value returned, or `None`. A `Response` is
+        passed to the `on_local_response` hooks of the middlewares before
+        the one returning it, so that they can release what their
+        `before_send` held.
+        """
+        for index, hook in enumerate(plan.before_send):
+            value = hook(request, **kwargs)
             if isinstance(value, Response):
+                for exit_hook in plan.before_send_exits[index]:
+                    value = exit_hook(request, value)
                 return value
             if isinstance(value, HTTPResponse):
-                return self.build_response(request, value)
+                if is_local(value):
+                    return self.build_local_response(request, value, plan)
+                return self.build_response(request, value, plan)
             if value:
-                raise ValueError('Middleware "before_send" methods must return '
-                                 '`Response`, `HTTPResponse`, or `None`')
-        return super(MiddlewareHTTPAdapter, self).send(
-            request, *args, **kwargs
-        )
+                raise ValueError('Middleware "before_send" methods must '
+                                 'return `Response`, `HTTPResponse`, or '
+                                 '`None`')
+        return None
+
+    def forward(self, plan, request, args, kwargs):
+        """Send the request on once the `before_send` hooks have passed."""
+        if plan.around_send is not None:
+            kwargs.update(zip(SEND_ARGS, args))
+            send = functools.partial(self.dispatch, plan.inner)
+            response = plan.around_send(send, request, **kwargs)
+            return self.finish_response(plan, request, response)
+        return self.transport(plan, request, *args, **kwargs)
+
+    def recover(self, plan, request, error):
+        """Pass `error` to the `on_send_error` hooks of `plan`, returning
+        the first `Response` returned, or `None`.
+        """
+        recovered = None
+        for hook in plan.on_send_error:
+            value = hook(request, error)
+            if recovered is None and isinstance(value, Response):
+                recovered = value
+        return recovered
+
+    def send_many(self, requests, workers=None, return_exceptions=False,
+                  **kwargs):
+        """Send a batch of requests concurrently, yielding each response as
+        it completes. Requests are grouped by the connection pool their URL
+        maps to and sent over up to `maxsize` connections per pool, on at
+        most `workers` threads. Each goes through the whole middleware stack
+        as with :meth:`send`, on the thread sending it, so that `before_send`
+        hooks which wait (throttles, robots.txt schedules, coalescing) run
+        just before their request is sent. Unless `stream` is set, bodies
+        are read on the sending thread.
+
+        Unlike `Session::send`, redirects are not followed and session
+        cookies are not updated; prepare requests with
+        `Session::prepare_request` to apply session settings.
+
+        :param requests: Iterable of :class:`PreparedRequest
+            <PreparedRequest>` objects
+        :param int workers: Most threads to send on; defaults to the total
+            concurrency of the pools involved
+        :param bool return_exceptions: Yield the exception raised for a
+            request instead of raising it
+        :param kwargs: Keyword arguments of `HTTPAdapter::send`
+        :returns: Generator of :class:`Response <Response>` objects
+        """
+        plan = self.plan
+        groups = collections.OrderedDict()
+        for request in requests:
+            pool = self.pool_for(request, kwargs)
+            groups.setdefault(pool, collections.deque()).append(request)
+
+        # One draining loop per connection, taking turns between pools
+        drains = []
+        for pool, jobs in groups.items():
+            maxsize = getattr(pool.pool, 'maxsize', 0) or self._pool_maxsize
+            drains.append([jobs] * min(maxsize, len(jobs)))
+        drains = [
+            jobs for turn in six.moves.zip_longest(*drains)
+            for jobs in turn if jobs is not None
+        ]
+        count = sum(len(jobs) for jobs in groups.values())
+        results = six.moves.queue.Queue()
+        threads = None
+        if drains:
+            threads = ThreadPool(min(workers or len(drains), len(drains)))
+        try:
+            for jobs in drains:
+                threads.apply_async(
+                    self.drain, (plan, jobs, kwargs, results),
+                )
+            for _ in range(count):
+                response, error = results.get()
+                if error is not None:
+                    if not return_exceptions:
+                        raise error
+                    response = error
+                yield response
+        finally:
+            for jobs in groups.values():
+                jobs.clear()
+            if threads is not None:
+                threads.close()
 
-    def build_response(self, req, resp):
+    def pool_for(self, request, kwargs):
+        """Return the connection pool `request` is sent over."""
+        verify = kwargs.get('verify', True)
+        proxies = kwargs.get('proxies')
+        if hasattr(self, 'get_connection_with_tls_context'):
+            return self.get_connection_with_tls_context(
+                request, verify, proxies, kwargs.get('cert'),
+            )
+        return self.get_connection(request.url, proxies)
+
+    def drain(self, plan, jobs, kwargs, results):
+        """Send requests taken from `jobs` until it is empty, putting
+        `(response, error)` pairs on `results`.
+        """
+        while True:
+            try:
+                request = jobs.popleft()
+            except IndexError:
+                return
+            try:
+                response = self.dispatch(plan, request, **kwargs)
+                if not kwargs.get('stream'):
+                    response.content
+            except Exception as error:
+                results.put((None, error))
+            else:
+                results.put((response, None))
+
+    def transport(self, plan, request, *args, **kwargs):
+        # `HTTPAdapter::send` calls `build_response` without the plan, so
+        # hand it over through the thread
+        previous = getattr(self._dispatching, 'plan', None)
+        self._dispatching.plan = plan
+        try:
+            send = super(MiddlewareHTTPAdapter, self).send
+            if plan.instrumentation is not None:
+                return plan.instrumentation.time_send(
+                    send, request, *args, **kwargs
+                )
+            return send(request, *args, **kwargs)
+        finally:
+            self._dispatching.plan = previous
+
+    def current_plan(self):
+        return getattr(self._dispatching, 'plan', None) or self.plan
+
+    def build_response(self, req, resp, plan=None):
         """Build the response. Call `HTTPAdapter::build_response`, then pass
         the response object to the `after_build_response` method of each
         middleware in the stack, in reverse order.
@@ -84,13 +306,179 @@ class MiddlewareHTTPAdapter(HTTPAdapter):
         :param resp: The urllib3 response object.
         :returns: The :class:`Response <Response>` object.
         """
-        for middleware in reversed(self.middlewares):
-            req, resp = middleware.before_build_response(req, resp)
+        plan = plan or self.current_plan()
+        for hook in plan.before_build_response:
+            req, resp = hook(req, resp)
         response = super(MiddlewareHTTPAdapter, self).build_response(req, resp)
-        for middleware in reversed(self.middlewares):
-            response = middleware.after_build_response(req, resp, response)
+        for hook in plan.after_build_response:
+            response = hook(req, resp, response)
+        return response
+
+    def build_local_response(self, req, resp, plan=None):
+        """Build the response for an `HTTPResponse` served locally by a
+        middleware, such as a cache hit. Response-building hooks are skipped,
+        so that e.g. caches and throttlers do not store a response that
+        never left the process; only the `on_local_response` method of each
+        middleware in the stack is called, in reverse order. Cookies are not
+        extracted into `Response.cookies`.
+
+        :param req: The :class:`PreparedRequest <PreparedRequest>` used to
+            generate the response.
+        :param resp: The urllib3 response object.
+        :returns: The :class:`Response <Response>` object.
+        """
+        response = local_response(self, req, resp)
+        for hook in (plan or self.current_plan()).on_local_response:
+            response = hook(req, response)
         return response
 
+    def finish_response(self, plan, req, response):
+        """Pass a `Response` returned by `around_send` to the response hooks
+        of the middlewares up to the one wrapping the send.
+        """
+        resp = response.raw
+        if is_local(resp):
+            for hook in plan.on_local_response:
+                response = hook(req, response)
+            return response
+        if plan.before_build_response:
+            raw = resp
+            for hook in plan.before_build_response:
+                req, resp = hook(req, resp)
+            if resp is not raw:
+                response = super(MiddlewareHTTPAdapter, self).build_response(
+                    req, resp,
+                )
+        for hook in plan.after_build_response:
+            response = hook(req, resp, response)
+        return response
+
+
+# Positional arguments of `HTTPAdapter::send` after the request
+SEND_ARGS = ('stream', 'timeout', 'verify', 'cert', 'proxies')
+
+
+def mark_local(resp):
+    """Mark urllib3 response `resp`, to be returned from `before_send`, as
+    served locally, so that adapters skip response-building hooks for it.
+
+    :returns: `resp`
+    """
+    resp.local = True
+    return resp
+
+
+def is_local(resp):
+    return getattr(resp, 'local', False) is True
+
+
+def local_response(connection, req, resp):
+    """Build a `Response` from locally served `resp` with only the state set
+    by `HTTPAdapter::build_response`, less cookies.
+    """
+    response = Response()
+    response.status_code = resp.status
+    response.headers = CaseInsensitiveDict(resp.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.raw = resp
+    response.reason = resp.reason
+    url = req.url
+    response.url = url.decode('utf-8') if isinstance(url, bytes) else url
+    response.request = req
+    response.connection = connection
+    return response
+
+
+def overrides(middleware, name):
+    """Check whether `middleware` provides its own implementation of the hook
+    `name` rather than inheriting the no-op from :class:`BaseMiddleware`.
+    """
+    if name in getattr(middleware, '__dict__', {}):
+        return True
+    method = getattr(type(middleware), name, None)
+    if method is None:
+        return False
+    return (
+        six.get_unbound_function(method) is not
+        six.get_unbound_function(getattr(BaseMiddleware, name))
+    )
+
+
+class DispatchPlan(object):
+    """Bound hook methods of a middleware stack, in the order in which
+    :class:`MiddlewareHTTPAdapter <MiddlewareHTTPAdapter>` calls them. Only
+    middlewares that override a hook are included in that hook's list, so
+    no-op hooks cost nothing per request. With `instrumentation`, the
+    `before_send` and response-building hooks are bound timed.
+
+    The first middleware overriding `around_send` splits the stack: the
+    request hooks of the plan cover only the middlewares up to and including
+    it, while those registered after it make up the `inner` plan, which
+    `around_send` sends through. Pool manager hooks cover the whole stack.
+
+    :param list middlewares: List of :class:`BaseMiddleware <BaseMiddleware>`
+        objects
+    :param instrumentation: Optional :class:`Instrumentation
+        <requests_middleware.instrument.Instrumentation>`
+    """
+    def __init__(self, middlewares, instrumentation=None):
+        self.middlewares = list(middlewares)
+        self.instrumentation = instrumentation
+        backward = self.middlewares[::-1]
+        self.before_init_poolmanager = self._bind(
+            backward, 'before_init_poolmanager'
+        )
+        self.after_init_poolmanager = self._bind(
+            backward, 'after_init_poolmanager'
+        )
+        self.around_send = None
+        self.inner = None
+        forward = self.middlewares
+        for index, middleware in enumerate(self.middlewares):
+            if overrides(middleware, 'around_send'):
+                self.around_send = middleware.around_send
+                self.inner = DispatchPlan(
+                    self.middlewares[index + 1:], instrumentation,
+                )
+                forward = self.middlewares[:index + 1]
+                break
+        backward = forward[::-1]
+        self.before_send = self._bind(forward, 'before_send')
+        # For each `before_send` hook, the `on_local_response` hooks of the
+        # middlewares before it, called if it returns a `Response`
+        self.before_send_exits = tuple(
+            self._bind(forward[:index][::-1], 'on_local_response')
+            for index, middleware in enumerate(forward)
+            if overrides(middleware, 'before_send')
+        )
+        self.before_build_response = self._bind(
+            backward, 'before_build_response'
+        )
+        self.after_build_response = self._bind(backward, 'after_build_response')
+        self.on_send_error = self._bind(backward, 'on_send_error')
+        self.on_local_response = self._bind(backward, 'on_local_response')
+
+    def _bind(self, middlewares, name):
+        middlewares = [
+            middleware for middleware in middlewares
+            if overrides(middleware, name)
+        ]
+        if self.instrumentation is not None and name in TIMED_HOOKS:
+            return tuple(
+                self.instrumentation.wrap(
+                    getattr(middleware, name), name, type(middleware).__name__,
+                )
+                for middleware in middlewares
+            )
+        return tuple(getattr(middleware, name) for middleware in middlewares)
+
+
+# Hooks whose latency is recorded by `Instrumentation`
+TIMED_HOOKS = frozenset([
+    'before_send', 'before_build_response', 'after_build_response',
+    'on_local_response',
+])
+
 
 class BaseMiddleware(object):
 
@@ -102,6 +490,27 @@ class BaseMiddleware(object):
         """
         pass
 
+    def after_init_poolmanager(self, poolmanager):
+        """Called after `HTTPAdapter::init_poolmanager` with the new
+        `PoolManager`, e.g. to customize how its connection pools are built.
+        """
+        pass
+
+    def around_send(self, send, request, **kwargs):
+        """Wrap the sending of a request through the middlewares registered
+        after this one. Only the first middleware in the stack overriding
+        this hook is used; the middlewares after it are sent through by
+        `send`. Called after the `before_send` methods of the middlewares up
+        to this one; the `Response` returned is passed to their response
+        hooks. `send` may be called several times, e.g. to retry.
+
+        :param send: Callable taking a `PreparedRequest` and the keyword
+            arguments of `HTTPAdapter::send`, and returning a `Response`
+        :param request: The `PreparedRequest` being sent.
+        :returns: The `Response` object.
+        """
+        return send(request, **kwargs)
+
     def before_send(self, request, *args, **kwargs):
         """Called before `HTTPAdapter::send`. If a truthy value is returned,
         :class:`MiddlewareHTTPAdapter <MiddlewareHTTPAdapter>` will short-
@@ -133,3 +542,28 @@ class BaseMiddleware(object):
         :returns: The potentially modified `Response` object.
         """
         return response
+
+    def on_local_response(self, req, response):
+        """Called instead of the response-building hooks when a middleware's
+        `before_send` returns an `HTTPResponse` marked with
+        :func:`mark_local`, or, on the middlewares before it, a `Response`.
+        Optionally modify the returned `Response` object.
+
+        :param req: The `PreparedRequest` used to generate the response.
+        :param response: The `Response` object.
+        :returns: The potentially modified `Response` object.
+        """
+        return response
+
+    def on_send_error(self, request, error):
+        """Called if sending raises an exception, whether from a middleware,
+        `HTTPAdapter::send` or response building. After all middlewares have
+        been notified, the exception is re-raised, unless a middleware
+        returned a `Response`; the first such response is then returned
+        instead.
+
+        :param request: The `PreparedRequest` being sent.
+        :param error: The exception raised.
+        :returns: A `Response` to recover with, or `None`.
+        """
+        pass
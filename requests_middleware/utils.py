@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import importlib
+import calendar
+import threading
+import collections
+from email.utils import parsedate_tz
+from multiprocessing.pool import ThreadPool
+
+from requests_middleware import compat
+
+
+class StripedLock(object):
+    """Fixed pool of locks selected by key hash. Threads working on different
+    keys (e.g. hosts) rarely share a lock, and memory stays bounded no matter
+    how many distinct keys are seen.
+
+    :param int stripes: Number of locks in the pool
+    """
+    def __init__(self, stripes=64):
+        self.locks = tuple(threading.Lock() for _ in range(stripes))
+
+    def get(self, key):
+        """Return the lock guarding `key`."""
+        return self.locks[hash(key) % len(self.locks)]
+
+
+_lazy_classes = {}
+_lazy_classes_lock = threading.Lock()
+
+
+def lazy_subclass(mixin, module, name):
+    """Return the class deriving from `mixin` and from class `name` of
+    `module`, importing `module` and creating the class on the first call.
+    This lets contrib modules extend classes of optional dependencies
+    without importing them until a middleware is created. The class is
+    named after `mixin`, less its `Mixin` suffix.
+    """
+    with _lazy_classes_lock:
+        cls = _lazy_classes.get(mixin)
+        if cls is None:
+            base = getattr(importlib.import_module(module), name)
+            cls = _lazy_classes[mixin] = type(
+                mixin.__name__[:-len('Mixin')],
+                (mixin, base),
+                {'__module__': mixin.__module__, '__doc__': mixin.__doc__},
+            )
+        return cls
+
+
+class BufferedBody(io.BytesIO):
+    """In-memory response body that closes itself once fully read, as
+    `http.client.HTTPResponse` does, so that readers such as cachecontrol's
+    `CallbackFileWrapper` can detect the end of the body.
+    """
+    def __init__(self, body):
+        super(BufferedBody, self).__init__(body)
+        self.length = len(body)
+
+    def _check_eof(self, data):
+        if self.tell() >= self.length:
+            self.close()
+        return data
+
+    def read(self, amt=-1):
+        if self.closed:
+            return b''
+        return self._check_eof(super(BufferedBody, self).read(amt))
+
+    def read1(self, amt=-1):
+        if self.closed:
+            return b''
+        return self._check_eof(super(BufferedBody, self).read1(amt))
+
+
+# Statuses treated as errors by `stale-if-error`; see RFC 5861, section 4
+ERROR_STATUSES = frozenset([500, 502, 503, 504])
+
+
+def stale_windows(headers):
+    """Parse the RFC 5861 `stale-while-revalidate` and `stale-if-error`
+    directives of a `Cache-Control` header.
+
+    :param headers: Response headers
+    :returns: Tuple of (stale-while-revalidate, stale-if-error) seconds, each
+        `None` if absent or invalid
+    """
+    windows = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.partition('=')
+        name = name.strip().lower()
+        if name in ('stale-while-revalidate', 'stale-if-error'):
+            try:
+                windows[name] = max(0, int(value.strip().strip('"')))
+            except ValueError:
+                pass
+    return (
+        windows.get('stale-while-revalidate'),
+        windows.get('stale-if-error'),
+    )
+
+
+def retry_after(headers):
+    """Parse a `Retry-After` header given in seconds or as an HTTP date.
+
+    :param headers: Response headers
+    :returns: Seconds to wait, or `None` if absent or invalid
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, calendar.timegm(parsed[:6]) - (parsed[9] or 0) - time.time())
+
+
+class RollingWindow(object):
+    """Totals of `size` counters over the last `window` seconds, kept in
+    one-second slots. Not thread-safe; callers hold their own lock.
+
+    :param int window: Length of the window, in seconds
+    :param int size: Number of counters
+    """
+    def __init__(self, window, size=2):
+        self.window = window
+        self.slots = collections.deque()
+        self.totals = [0] * size
+
+    def expire(self, now):
+        """Drop the counts that have left the window at `now`."""
+        second = int(now)
+        while self.slots and self.slots[0][0] <= second - self.window:
+            _, counts = self.slots.popleft()
+            for index, count in enumerate(counts):
+                self.totals[index] -= count
+
+    def add(self, now, *counts):
+        """Add `counts`, one per counter, at `now`."""
+        self.expire(now)
+        second = int(now)
+        if not self.slots or self.slots[-1][0] != second:
+            self.slots.append((second, [0] * len(self.totals)))
+        _, slot = self.slots[-1]
+        for index, count in enumerate(counts):
+            slot[index] += count
+            self.totals[index] += count
+
+    def clear(self):
+        self.slots.clear()
+        self.totals = [0] * len(self.totals)
+
+
+class Revalidator(object):
+    """Run refreshes of cache entries on a pool of background threads, at
+    most one at a time per key. Exceptions raised by refreshes are ignored;
+    the entry is simply refreshed again on a later request.
+
+    :param int workers: Number of background threads, started on first use
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.pool = None
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def submit(self, key, func, *args):
+        """Schedule `func(*args)` unless a refresh of `key` is pending.
+
+        :returns: `True` if scheduled
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            self.pending.add(key)
+        self.pool.apply_async(self._run, (key, func, args))
+        return True
+
+    def _run(self, key, func, args):
+        try:
+            func(*args)
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+                self.idle.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until no refreshes are pending.
+
+        :returns: `True` unless `timeout` expired first
+        """
+        with self.lock:
+            if timeout is None:
+                while self.pending:
+                    self.idle.wait()
+                return True
+            deadline = compat.monotonic() + timeout
+            while self.pending:
+                remaining = deadline - compat.monotonic()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+            return True
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import io
+import gzip
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+from requests_middleware.middleware import BaseMiddleware, mark_local
+from requests_middleware.contrib import breakerware, retryware, throttleware
+
+try:
+    import asyncio
+    from aiohttp import web
+    from requests_middleware import aio
+    has_aiohttp = True
+except (ImportError, SyntaxError):
+    has_aiohttp = False
+
+from requests_middleware import contrib
+from requests_middleware.contrib import cachecontrolware
+
+has_cachecontrol = contrib.available('cachecontrol')
+
+pytestmark = pytest.mark.skipif(
+    not has_aiohttp,
+    reason='aiohttp is not installed; skipping asyncio tests.'
+)
+
+
+class AsyncHeaderMiddleware(BaseMiddleware):
+
+    async def before_send(self, request, *args, **kwargs):
+        request.headers['X-Async'] = 'yes'
+
+    async def after_build_response(self, req, resp, response):
+        response.hooked = True
+        return response
+
+
+class LocalMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        return mark_local(HTTPResponse(
+            body=io.BytesIO(b'local'), status=200, preload_content=False,
+        ))
+
+
+class ShortCircuitMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 299
+        return response
+
+
+def make_echo(hits):
+    async def echo(request):
+        hits.append(request.path)
+        return web.Response(
+            text='content',
+            headers={
+                'X-Async': request.headers.get('X-Async', ''),
+                'Cache-Control': 'max-age=60',
+            },
+        )
+    return echo
+
+
+async def compressed(request):
+    return web.Response(
+        body=gzip.compress(b'compressed content'),
+        headers={'Content-Encoding': 'gzip'},
+    )
+
+
+def run(coroutine):
+    """Start a local server, run `coroutine(url, hits)` and return its
+    result. `hits` lists the paths requested from the echo handler.
+    """
+    async def main():
+        hits = []
+        app = web.Application()
+        app.router.add_get('/page', make_echo(hits))
+        app.router.add_get('/gzip', compressed)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await coroutine('http://127.0.0.1:{0}'.format(port), hits)
+        finally:
+            await runner.cleanup()
+    return asyncio.run(main())
+
+
+def test_async_hooks():
+    async def fetch(url, hits):
+        middleware = AsyncHeaderMiddleware()
+        async with aio.AsyncMiddlewareHTTPAdapter([middleware]) as adapter:
+            return await adapter.request('GET', url + '/page')
+    response = run(fetch)
+    assert response.status_code == 200
+    assert response.text == 'content'
+    assert response.headers['X-Async'] == 'yes'
+    assert response.hooked
+
+
+def test_content_decoding():
+    async def fetch(url, hits):
+        async with aio.AsyncMiddlewareHTTPAdapter() as adapter:
+            return await adapter.request('GET', url + '/gzip')
+    assert run(fetch).content == b'compressed content'
+
+
+def test_short_circuit():
+    async def fetch(url, hits):
+        middleware = ShortCircuitMiddleware()
+        async with aio.AsyncMiddlewareHTTPAdapter([middleware]) as adapter:
+            return await adapter.request('GET', url + '/page')
+    assert run(fetch).status_code == 299
+
+
+def test_short_circuit_releases_probe():
+    async def fetch(url, hits):
+        breaker = breakerware.CircuitBreakerMiddleware(probes=1)
+        request = requests.Request('GET', url + '/page').prepare()
+        circuit = breaker.get(breaker.key(request))
+        circuit.change(breakerware.OPEN, circuit.changed - circuit.cooldown)
+        middlewares = [breaker, ShortCircuitMiddleware()]
+        async with aio.AsyncMiddlewareHTTPAdapter(middlewares) as adapter:
+            for _ in range(2):
+                response = await adapter.request('GET', url + '/page')
+                assert response.status_code == 299
+        return circuit
+    circuit = run(fetch)
+    assert circuit.state == breakerware.HALF_OPEN
+    assert circuit.in_flight == 0
+
+
+def test_local_response():
+    async def fetch(url, hits):
+        middlewares = [AsyncHeaderMiddleware(), LocalMiddleware()]
+        async with aio.AsyncMiddlewareHTTPAdapter(middlewares) as adapter:
+            return await adapter.request('GET', url + '/page')
+    response = run(fetch)
+    assert response.text == 'local'
+    assert not hasattr(response, 'hooked')
+
+
+def test_around_send_unsupported():
+    async def fetch(url, hits):
+        middleware = retryware.RetryMiddleware()
+        async with aio.AsyncMiddlewareHTTPAdapter([middleware]) as adapter:
+            with pytest.raises(TypeError):
+                await adapter.request('GET', url + '/page')
+    run(fetch)
+
+
+def test_sync_throttle_middleware():
+    async def fetch(url, hits):
+        throttler = throttleware.DelayThrottler(5)
+        middleware = throttleware.ThrottleMiddleware(throttler)
+        async with aio.AsyncMiddlewareHTTPAdapter([middleware]) as adapter:
+            await adapter.request('GET', url + '/page')
+            with pytest.raises(throttleware.ThrottleError):
+                await adapter.request('GET', url + '/page')
+    run(fetch)
+
+
+def test_concurrent_requests():
+    async def fetch(url, hits):
+        async with aio.AsyncMiddlewareHTTPAdapter() as adapter:
+            return await asyncio.gather(*[
+                adapter.request('GET', url + '/page') for _ in range(50)
+            ])
+    responses = run(fetch)
+    assert [response.text for response in responses] == ['content'] * 50
+
+
+def test_connection_error():
+    async def fetch(url, hits):
+        async with aio.AsyncMiddlewareHTTPAdapter() as adapter:
+            with pytest.raises(requests.ConnectionError):
+                await adapter.request('GET', 'http://127.0.0.1:1/')
+    run(fetch)
+
+
+@pytest.mark.skipif(not has_cachecontrol, reason='cachecontrol is not installed')
+def test_sync_cache_middleware():
+    async def fetch(url, hits):
+        middleware = cachecontrolware.CacheMiddleware()
+        async with aio.AsyncMiddlewareHTTPAdapter([middleware]) as adapter:
+            first = await adapter.request('GET', url + '/page')
+            first.content
+            second = await adapter.request('GET', url + '/page')
+            return first, second, len(hits)
+    first, second, hits = run(fetch)
+    assert first.text == second.text == 'content'
+    assert hits == 1
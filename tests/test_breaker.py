@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import requests
+
+from requests_middleware.middleware import MiddlewareHTTPAdapter, BaseMiddleware
+from requests_middleware.contrib import breakerware, retryware
+
+from .utils import make_session
+
+
+class FailingMiddleware(BaseMiddleware):
+
+    def __init__(self):
+        self.failing = True
+
+    def before_send(self, request, *args, **kwargs):
+        if self.failing:
+            raise requests.ConnectionError('failed')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breakerware.compat, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def breaker(clock):
+    return breakerware.CircuitBreaker(
+        failure_ratio=0.5, min_requests=4, window=10, cooldown=30, probes=2,
+    )
+
+
+@pytest.fixture
+def middleware(clock):
+    return breakerware.CircuitBreakerMiddleware(
+        min_requests=4, cooldown=30, probes=1,
+    )
+
+
+def outcome(breaker, failed, now):
+    probe = breaker.acquire(now)
+    breaker.record(now, probe, failed, now)
+
+
+def trip(breaker, now):
+    for failed in (False, True, False, True):
+        outcome(breaker, failed, now)
+
+
+# Unit tests
+
+def test_trip(breaker, clock):
+    for failed in (False, True, False):
+        outcome(breaker, failed, clock[0])
+    assert breaker.state == breakerware.CLOSED
+    outcome(breaker, True, clock[0])
+    assert breaker.state == breakerware.OPEN
+    with pytest.raises(breakerware.CircuitOpenError):
+        breaker.acquire(clock[0] + 29)
+
+
+def test_failures_leave_window(breaker, clock):
+    for failed in (True, True, False):
+        outcome(breaker, failed, clock[0])
+    outcome(breaker, False, clock[0] + 11)
+    assert breaker.state == breakerware.CLOSED
+
+
+def test_half_open_closes(breaker, clock):
+    trip(breaker, clock[0])
+    now = clock[0] + 30
+    assert breaker.acquire(now) and breaker.acquire(now)
+    assert breaker.state == breakerware.HALF_OPEN
+    with pytest.raises(breakerware.CircuitOpenError):
+        breaker.acquire(now)
+    breaker.record(now, True, False, now)
+    assert breaker.state == breakerware.HALF_OPEN
+    breaker.record(now, True, False, now)
+    assert breaker.state == breakerware.CLOSED
+    assert breaker.acquire(now) is False
+
+
+def test_half_open_reopens(breaker, clock):
+    trip(breaker, clock[0])
+    now = clock[0] + 30
+    assert breaker.acquire(now)
+    breaker.record(now, True, True, now)
+    assert breaker.state == breakerware.OPEN
+    with pytest.raises(breakerware.CircuitOpenError):
+        breaker.acquire(now + 1)
+
+
+def test_in_flight_outcomes_ignored(breaker, clock):
+    sent = clock[0]
+    probe = breaker.acquire(sent)
+    trip(breaker, sent + 1)
+    now = sent + 31
+    breaker.acquire(now)
+    breaker.record(sent, probe, True, now)
+    assert breaker.state == breakerware.HALF_OPEN
+
+
+def test_release_probe(breaker, clock):
+    trip(breaker, clock[0])
+    now = clock[0] + 30
+    breaker.acquire(now)
+    breaker.acquire(now)
+    breaker.release(True)
+    assert breaker.acquire(now)
+
+
+def test_breakers_bounded():
+    middleware = breakerware.CircuitBreakerMiddleware(max_keys=1)
+    middleware.get('http://a.com')
+    middleware.get('http://b.com')
+    assert list(middleware.states()) == ['http://b.com']
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_fail_fast(middleware, clock):
+    httpretty.register_uri(
+        httpretty.GET, 'http://test.com/page', body='error', status=503,
+    )
+    httpretty.register_uri(
+        httpretty.GET, 'http://other.com/page', body='content',
+    )
+    session = make_session(middleware)
+    for _ in range(4):
+        assert session.get('http://test.com/page').status_code == 503
+    with pytest.raises(breakerware.CircuitOpenError):
+        session.get('http://test.com/page')
+    assert len(httpretty.latest_requests()) == 4
+    assert session.get('http://other.com/page').status_code == 200
+    assert middleware.states() == {
+        'http://test.com': breakerware.OPEN,
+        'http://other.com': breakerware.CLOSED,
+    }
+
+
+@pytest.mark.httpretty
+def test_probe_closes(middleware, clock, page_fixture):
+    failing = FailingMiddleware()
+    session = make_session(middleware, failing)
+    for _ in range(4):
+        with pytest.raises(requests.ConnectionError):
+            session.get('http://test.com/page')
+    assert middleware.states()['http://test.com'] == breakerware.OPEN
+    failing.failing = False
+    clock[0] += 30
+    assert session.get('http://test.com/page').status_code == 200
+    assert middleware.states()['http://test.com'] == breakerware.CLOSED
+
+
+@pytest.mark.httpretty
+def test_probe_released_by_short_circuit(middleware, clock, page_fixture):
+    failing = FailingMiddleware()
+    session = make_session(middleware, failing)
+    for _ in range(4):
+        with pytest.raises(requests.ConnectionError):
+            session.get('http://test.com/page')
+
+    class CachedMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'cached'
+            return response
+
+    clock[0] += 30
+    adapter = MiddlewareHTTPAdapter([middleware, CachedMiddleware()])
+    request = requests.Request('GET', 'http://test.com/page').prepare()
+    assert adapter.send(request).text == 'cached'
+    assert middleware.get('http://test.com').in_flight == 0
+    failing.failing = False
+    assert session.get('http://test.com/page').status_code == 200
+    assert middleware.states()['http://test.com'] == breakerware.CLOSED
+
+
+@pytest.mark.httpretty
+def test_slow_call(clock, page_fixture):
+    middleware = breakerware.CircuitBreakerMiddleware(
+        min_requests=1, slow_call_duration=1,
+    )
+
+    class SlowMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            clock[0] += 2
+
+    session = make_session(middleware, SlowMiddleware())
+    session.get('http://test.com/page')
+    assert middleware.states()['http://test.com'] == breakerware.OPEN
+
+
+@pytest.mark.httpretty
+def test_open_circuit_not_retried(middleware, clock, monkeypatch):
+    monkeypatch.setattr(retryware.time, 'sleep', lambda seconds: None)
+    httpretty.register_uri(
+        httpretty.GET, 'http://test.com/page', body='error', status=503,
+    )
+    retry = retryware.RetryMiddleware(retries=10)
+    session = make_session(retry, middleware)
+    with pytest.raises(breakerware.CircuitOpenError):
+        session.get('http://test.com/page')
+    assert len(httpretty.latest_requests()) == 4
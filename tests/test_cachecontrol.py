@@ -1,32 +1,31 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import httpretty
+
+import io
+import time
+import tracemalloc
+from email.utils import formatdate
 
 import requests
 
-from requests_middleware.middleware import MiddlewareHTTPAdapter
+from requests_middleware.middleware import BaseMiddleware
+
+from requests_middleware import contrib
+from requests_middleware.contrib import cachecontrolware
 
-try:
-    from requests_middleware.contrib import cachecontrolware
-    has_cachecontrol = True
-except ImportError:
-    has_cachecontrol = False
+from .utils import make_session
 
 pytestmark = pytest.mark.skipif(
-    not has_cachecontrol,
+    not contrib.available('cachecontrol'),
     reason='cachecontrol is not installed; skipping caching tests.'
 )
 
 
 @pytest.fixture
 def session():
-    session = requests.Session()
-    adapter = MiddlewareHTTPAdapter()
-    cache_middleware = cachecontrolware.CacheMiddleware()
-    adapter.register(cache_middleware)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+    return make_session(cachecontrolware.CacheMiddleware())
 
 
 # Integration tests
@@ -45,3 +44,283 @@ def test_cache_respect_no_cache(session, non_cached_page):
     resp2 = session.get('http://test.com/cache')
     assert not getattr(resp1.raw, 'from_cache', False)
     assert not getattr(resp2.raw, 'from_cache', False)
+
+
+@pytest.fixture
+def large_page():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/large',
+        body='x' * 1000,
+        adding_headers={
+            'Cache-Control': 'max-age=3600',
+            'Date': 'Mon, 01 Jan 2035 00:00:00 GMT',
+        },
+    )
+
+
+def stale_headers(directives):
+    return {
+        'Cache-Control': 'max-age=10, ' + directives,
+        'Date': formatdate(time.time() - 20, usegmt=True),
+        'ETag': '"v1"',
+    }
+
+
+@pytest.fixture
+def stale_page():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        responses=[
+            httpretty.Response(
+                body='stale',
+                adding_headers=stale_headers('stale-while-revalidate=60'),
+            ),
+            httpretty.Response(
+                body='',
+                status=304,
+                adding_headers={
+                    'Cache-Control': 'max-age=10',
+                    'Date': formatdate(usegmt=True),
+                },
+            ),
+        ],
+    )
+
+
+@pytest.fixture
+def failing_page():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        responses=[
+            httpretty.Response(
+                body='stale',
+                adding_headers=stale_headers('stale-if-error=60'),
+            ),
+            httpretty.Response(body='error', status=503),
+        ],
+    )
+
+
+class FailMiddleware(BaseMiddleware):
+
+    def __init__(self):
+        self.fail = False
+
+    def before_send(self, request, *args, **kwargs):
+        if self.fail:
+            raise requests.ConnectionError('failed')
+
+
+class ZeroReader(io.RawIOBase):
+    """Yield `size` zero bytes, closing at EOF like `http.client`."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.remaining)
+        buffer[:count] = b'\0' * count
+        self.remaining -= count
+        if not self.remaining:
+            self.close()
+        return count
+
+
+def read_all(fp, chunk_size=65536):
+    while fp.read(chunk_size):
+        pass
+
+
+# Unit tests
+
+def test_spool_calls_back_with_body():
+    bodies = []
+    fp = cachecontrolware.SpoolingFileWrapper(ZeroReader(10), bodies.append)
+    assert fp.read(4) == b'\0' * 4
+    assert bodies == []
+    read_all(fp)
+    assert len(bodies) == 1
+    assert bytes(bodies[0]) == b'\0' * 10
+
+
+def test_spool_empty_body():
+    bodies = []
+    fp = cachecontrolware.SpoolingFileWrapper(ZeroReader(0), bodies.append)
+    fp.read()
+    assert bodies == [b'']
+
+
+def test_spool_over_limit():
+    bodies = []
+    fp = cachecontrolware.SpoolingFileWrapper(
+        ZeroReader(10), bodies.append, max_size=9,
+    )
+    read_all(fp, 4)
+    assert bodies == []
+
+
+def test_spool_closed_early():
+    bodies = []
+    fp = cachecontrolware.SpoolingFileWrapper(ZeroReader(10), bodies.append)
+    fp.read(4)
+    fp.close()
+    assert bodies == []
+
+
+def test_spool_memory_flat():
+    size = 64 * 1024 * 1024
+    sizes = []
+    fp = cachecontrolware.SpoolingFileWrapper(
+        ZeroReader(size), lambda body: sizes.append(len(body)),
+    )
+    tracemalloc.start()
+    try:
+        read_all(fp)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert sizes == [size]
+    assert peak < 1024 * 1024
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_cache_streamed(session, large_page):
+    resp1 = session.get('http://test.com/large', stream=True)
+    assert b''.join(resp1.iter_content(100)) == b'x' * 1000
+    resp2 = session.get('http://test.com/large')
+    assert getattr(resp2.raw, 'from_cache', False)
+    assert resp2.content == b'x' * 1000
+
+
+@pytest.mark.httpretty
+def test_cache_streamed_closed_early(session, large_page):
+    resp1 = session.get('http://test.com/large', stream=True)
+    next(resp1.iter_content(100))
+    resp1.close()
+    resp2 = session.get('http://test.com/large')
+    assert not getattr(resp2.raw, 'from_cache', False)
+
+
+@pytest.mark.httpretty
+def test_cache_over_limit(large_page):
+    session = make_session(cachecontrolware.CacheMiddleware(max_body_size=999))
+    session.get('http://test.com/large')
+    resp2 = session.get('http://test.com/large')
+    assert not getattr(resp2.raw, 'from_cache', False)
+    assert resp2.content == b'x' * 1000
+
+
+@pytest.mark.httpretty
+def test_stale_while_revalidate(stale_page):
+    middleware = cachecontrolware.CacheMiddleware()
+    session = make_session(middleware)
+    session.get('http://test.com/stale')
+    resp2 = session.get('http://test.com/stale')
+    assert resp2.raw.from_cache
+    assert resp2.text == 'stale'
+    assert middleware.revalidator.wait(5)
+    requests_ = httpretty.latest_requests()
+    assert len(requests_) == 2
+    assert requests_[1].headers['If-None-Match'] == '"v1"'
+    resp3 = session.get('http://test.com/stale')
+    assert resp3.raw.from_cache
+    assert resp3.text == 'stale'
+    assert len(httpretty.latest_requests()) == 2
+
+
+@pytest.mark.httpretty
+def test_stale_while_revalidate_no_cache(stale_page):
+    session = make_session(cachecontrolware.CacheMiddleware())
+    session.get('http://test.com/stale')
+    session.get('http://test.com/stale', headers={'Cache-Control': 'no-cache'})
+    assert len(httpretty.latest_requests()) == 2
+
+
+@pytest.mark.httpretty
+def test_stale_not_served_for_other_url(monkeypatch):
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/a',
+        body='a',
+        adding_headers={
+            'Cache-Control': 'max-age=10, stale-while-revalidate=60',
+            'Date': formatdate(usegmt=True),
+        },
+    )
+    httpretty.register_uri(httpretty.GET, 'http://test.com/b', body='b')
+    session = make_session(cachecontrolware.CacheMiddleware())
+    session.get('http://test.com/a')
+    assert session.get('http://test.com/a').raw.from_cache
+    # The entry loaded for /a is stale by the time /b is requested
+    now = time.time() + 20
+    monkeypatch.setattr(cachecontrolware.time, 'time', lambda: now)
+    resp = session.get(
+        'http://test.com/b', headers={'Cache-Control': 'no-cache'},
+    )
+    assert not getattr(resp.raw, 'from_cache', False)
+    assert resp.text == 'b'
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_status(failing_page):
+    session = make_session(cachecontrolware.CacheMiddleware())
+    session.get('http://test.com/stale')
+    resp2 = session.get('http://test.com/stale')
+    assert resp2.status_code == 200
+    assert resp2.text == 'stale'
+    assert resp2.raw.from_cache
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_exception(failing_page):
+    fail = FailMiddleware()
+    session = make_session(cachecontrolware.CacheMiddleware())
+    session.get_adapter('http://').register(fail)
+    session.get('http://test.com/stale')
+    fail.fail = True
+    resp2 = session.get('http://test.com/stale')
+    assert resp2.text == 'stale'
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_expired(failing_page):
+    session = make_session(cachecontrolware.CacheMiddleware())
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        responses=[
+            httpretty.Response(
+                body='stale',
+                adding_headers=stale_headers('stale-if-error=5'),
+            ),
+            httpretty.Response(body='error', status=503),
+        ],
+    )
+    session.get('http://test.com/stale')
+    assert session.get('http://test.com/stale').status_code == 503
+
+
+@pytest.mark.httpretty
+def test_cache_hit_skips_build_hooks(large_page):
+    stored = []
+
+    class StoreMiddleware(BaseMiddleware):
+        def after_build_response(self, req, resp, response):
+            stored.append(response)
+            return response
+
+    session = make_session(cachecontrolware.CacheMiddleware())
+    session.get_adapter('http://').register(StoreMiddleware())
+    session.get('http://test.com/large')
+    resp2 = session.get('http://test.com/large')
+    assert resp2.raw.from_cache
+    assert resp2.content == b'x' * 1000
+    assert len(stored) == 1
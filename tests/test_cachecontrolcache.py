@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import os
+import multiprocessing
+
+from .utils import make_session
+
+try:
+    from requests_middleware.contrib import cachecontrolware
+    from requests_middleware.contrib import cachecontrolcache
+    has_cachecontrol = True
+except ImportError:
+    has_cachecontrol = False
+
+pytestmark = pytest.mark.skipif(
+    not has_cachecontrol,
+    reason='cachecontrol is not installed; skipping cache backend tests.'
+)
+
+
+@pytest.fixture
+def mmap_cache(tmpdir):
+    return cachecontrolcache.MmapCache(str(tmpdir.join('cache')))
+
+
+def read_body(cache, key):
+    assert cache.get(key) is not None
+    return cache.get_body(key).read()
+
+
+def write_entry(directory, key, body):
+    cache = cachecontrolcache.MmapCache(directory)
+    cache.set(key, b'meta')
+    cache.set_body(key, body)
+
+
+# Unit tests
+
+def test_lru_cache_evicts_by_size():
+    cache = cachecontrolcache.LRUCache(max_bytes=10)
+    cache.set('first', b'12345')
+    cache.set('second', b'12345')
+    cache.get('first')
+    cache.set('third', b'12345')
+    assert cache.size == 10
+    assert cache.get('first') == b'12345'
+    assert cache.get('second') is None
+    assert cache.get('third') == b'12345'
+
+
+def test_lru_cache_replace_and_delete():
+    cache = cachecontrolcache.LRUCache(max_bytes=10)
+    cache.set('key', b'12345')
+    cache.set('key', b'123')
+    assert cache.size == 3
+    cache.delete('key')
+    assert cache.size == 0
+    assert len(cache) == 0
+
+
+def test_lru_cache_skips_oversize():
+    cache = cachecontrolcache.LRUCache(max_bytes=4)
+    cache.set('key', b'12345')
+    assert cache.get('key') is None
+    assert cache.size == 0
+
+
+def test_lru_cache_expires(monkeypatch):
+    cache = cachecontrolcache.LRUCache()
+    cache.set('key', b'value', expires=10)
+    later = cachecontrolcache.time.time() + 20
+    monkeypatch.setattr(cachecontrolcache.time, 'time', lambda: later)
+    assert cache.get('key') is None
+    assert cache.size == 0
+
+
+def test_mmap_cache_roundtrip(mmap_cache):
+    mmap_cache.set('key', b'meta')
+    assert mmap_cache.get('key') is None
+    mmap_cache.set_body('key', b'body')
+    assert mmap_cache.get('key') == b'meta'
+    assert mmap_cache.get_body('key').read() == b'body'
+    mmap_cache.set('key', b'updated')
+    assert read_body(mmap_cache, 'key') == b'body'
+    mmap_cache.delete('key')
+    assert mmap_cache.get('key') is None
+
+
+def test_mmap_cache_set_entry(mmap_cache):
+    mmap_cache.set_entry('key', b'meta', b'body')
+    assert read_body(mmap_cache, 'key') == b'body'
+    mmap_cache.set_entry('key', b'updated', b'new body')
+    assert mmap_cache.get('key') == b'updated'
+    assert read_body(mmap_cache, 'key') == b'new body'
+
+
+def test_mmap_cache_set_entry_rolls_back(mmap_cache, monkeypatch):
+    mmap_cache.set_entry('key', b'meta', b'body')
+
+    def fail(*args):
+        raise IOError
+
+    monkeypatch.setattr(mmap_cache, '_evict', fail)
+    with pytest.raises(IOError):
+        mmap_cache.set_entry('key', b'updated', b'new body')
+    assert mmap_cache.get('key') == b'meta'
+    assert read_body(mmap_cache, 'key') == b'body'
+
+
+def test_mmap_cache_reader_closes(mmap_cache):
+    mmap_cache.set('key', b'meta')
+    mmap_cache.set_body('key', b'body')
+    mmap_cache.get('key')
+    reader = mmap_cache.get_body('key')
+    assert reader.read(2) == b'bo'
+    assert not reader.closed
+    assert reader.read(2) == b'dy'
+    assert reader.closed
+
+
+def test_mmap_cache_persists(tmpdir):
+    directory = str(tmpdir.join('cache'))
+    write_entry(directory, 'key', b'body')
+    cache = cachecontrolcache.MmapCache(directory)
+    assert read_body(cache, 'key') == b'body'
+
+
+def test_mmap_cache_shared_between_processes(tmpdir):
+    directory = str(tmpdir.join('cache'))
+    cache = cachecontrolcache.MmapCache(directory)
+    processes = [
+        multiprocessing.Process(
+            target=write_entry,
+            args=(directory, 'key{0}'.format(idx), b'body' * idx),
+        )
+        for idx in range(1, 5)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    for idx in range(1, 5):
+        assert read_body(cache, 'key{0}'.format(idx)) == b'body' * idx
+
+
+def test_mmap_cache_evicts_segments(tmpdir):
+    directory = str(tmpdir.join('cache'))
+    cache = cachecontrolcache.MmapCache(
+        directory, max_bytes=20, segment_bytes=10,
+    )
+    for idx in range(4):
+        cache.set('key{0}'.format(idx), b'meta')
+        cache.set_body('key{0}'.format(idx), b'0123456789')
+    assert cache.get('key0') is None
+    assert read_body(cache, 'key3') == b'0123456789'
+    segments = [name for name in os.listdir(directory)
+                if name.startswith('segment-')]
+    assert len(segments) <= 3
+
+
+def test_mmap_cache_body_survives_eviction(tmpdir):
+    cache = cachecontrolcache.MmapCache(
+        str(tmpdir.join('cache')), max_bytes=10, segment_bytes=10,
+    )
+    cache.set('old', b'meta')
+    cache.set_body('old', b'0123456789')
+    assert cache.get('old') == b'meta'
+    cache.set('new', b'meta')
+    cache.set_body('new', b'0123456789')
+    cache.set('newer', b'meta')
+    cache.set_body('newer', b'0123456789')
+    assert cache.get_body('old').read() == b'0123456789'
+    assert cache.get('old') is None
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+@pytest.mark.parametrize('backend', ['lru', 'mmap'])
+def test_cache_middleware_backend(backend, tmpdir, cached_page):
+    if backend == 'lru':
+        cache = cachecontrolcache.LRUCache()
+    else:
+        cache = cachecontrolcache.MmapCache(str(tmpdir.join('cache')))
+    session = make_session(cachecontrolware.CacheMiddleware(cache=cache))
+    resp1 = session.get('http://test.com/cache')
+    resp2 = session.get('http://test.com/cache')
+    assert not getattr(resp1.raw, 'from_cache', False)
+    assert getattr(resp2.raw, 'from_cache', False)
+    assert resp2.text == 'content'
+
+
+@pytest.mark.httpretty
+def test_cache_middleware_fresh_hit(tmpdir):
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/fresh',
+        body='content',
+        adding_headers={
+            'Cache-Control': 'max-age=3600',
+            'Date': 'Mon, 01 Jan 2035 00:00:00 GMT',
+        },
+    )
+    cache = cachecontrolcache.MmapCache(str(tmpdir.join('cache')))
+    session = make_session(cachecontrolware.CacheMiddleware(cache=cache))
+    assert session.get('http://test.com/fresh').text == 'content'
+    for _ in range(3):
+        resp = session.get('http://test.com/fresh')
+        assert resp.raw.from_cache
+        assert resp.text == 'content'
+    assert len(httpretty.latest_requests()) == 1
+    segment = os.path.join(cache.directory, cache.segment_path(0))
+    assert os.path.getsize(segment) == len('content')
+
+
+@pytest.mark.httpretty
+def test_cache_middleware_writes_entry_once(tmpdir, monkeypatch):
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/entry',
+        body='content',
+        adding_headers={
+            'Cache-Control': 'max-age=3600',
+            'Date': 'Mon, 01 Jan 2035 00:00:00 GMT',
+        },
+    )
+    cache = cachecontrolcache.MmapCache(str(tmpdir.join('cache')))
+    calls = []
+
+    def record(name, method):
+        def wrapper(*args, **kwargs):
+            calls.append(name)
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in ('set_body', 'set_entry'):
+        monkeypatch.setattr(cache, name, record(name, getattr(cache, name)))
+    session = make_session(cachecontrolware.CacheMiddleware(cache=cache))
+    session.get('http://test.com/entry')
+    assert calls == ['set_entry']
+    assert session.get('http://test.com/entry').raw.from_cache
+
+
+@pytest.mark.httpretty
+def test_cache_middleware_keeps_stale():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        body='content',
+        adding_headers={
+            'Cache-Control': 'max-age=10, stale-while-revalidate=60',
+            'Date': 'Mon, 01 Jan 2035 00:00:00 GMT',
+        },
+    )
+    cache = cachecontrolcache.LRUCache()
+    session = make_session(cachecontrolware.CacheMiddleware(cache=cache))
+    session.get('http://test.com/stale')
+    (_, deadline), = cache.data.values()
+    assert deadline - cachecontrolcache.time.time() > 60
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import io
+import time
+import threading
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+from requests_middleware.middleware import (
+    MiddlewareHTTPAdapter, BaseMiddleware, mark_local,
+)
+from requests_middleware.contrib import coalesceware
+
+
+@pytest.fixture
+def middleware():
+    return coalesceware.CoalesceMiddleware(timeout=5)
+
+
+@pytest.fixture
+def session(middleware):
+    session = requests.Session()
+    adapter = MiddlewareHTTPAdapter([middleware])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@pytest.fixture
+def hits():
+    return []
+
+
+@pytest.fixture
+def slow_fixture(hits):
+    def callback(request, uri, headers):
+        hits.append(uri)
+        time.sleep(0.2)
+        headers['Vary'] = 'X-Variant'
+        return 200, headers, 'content'
+    httpretty.register_uri(httpretty.GET, 'http://test.com/slow', body=callback)
+
+
+class FailOnceMiddleware(BaseMiddleware):
+
+    def __init__(self):
+        self.failed = False
+
+    def before_send(self, request, *args, **kwargs):
+        if not self.failed:
+            self.failed = True
+            time.sleep(0.2)
+            raise requests.ConnectionError('boom')
+
+
+def fetch_concurrently(session, url, count=8, **kwargs):
+    responses, errors = [], []
+
+    def worker():
+        try:
+            responses.append(session.get(url, **kwargs))
+        except Exception as error:
+            errors.append(error)
+
+    workers = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in workers:
+        thread.start()
+        time.sleep(0.01)
+    for thread in workers:
+        thread.join()
+    return responses, errors
+
+
+def make_request(url, **headers):
+    return requests.Request('GET', url, headers=headers).prepare()
+
+
+# Unit tests
+
+def test_key_includes_headers(middleware):
+    plain = make_request('http://test.com/page')
+    authorized = make_request('http://test.com/page', Authorization='token')
+    assert middleware.key(plain) == middleware.key(make_request(plain.url))
+    assert middleware.key(plain) != middleware.key(authorized)
+
+
+def test_vary_matches():
+    leader = make_request('http://test.com/page', **{'X-Variant': 'a'})
+    response = requests.Response()
+    assert coalesceware.vary_matches(leader, make_request(leader.url), response)
+    response.headers['Vary'] = 'X-Variant'
+    assert coalesceware.vary_matches(leader, leader, response)
+    assert not coalesceware.vary_matches(
+        leader, make_request(leader.url), response,
+    )
+    response.headers['Vary'] = '*'
+    assert not coalesceware.vary_matches(leader, leader, response)
+
+
+def test_copy_response():
+    response = requests.Response()
+    response._content = b'content'
+    response.status_code = 200
+    response.headers['X-Header'] = 'value'
+    request = make_request('http://test.com/page')
+    clone = coalesceware.copy_response(response, request)
+    clone.headers['X-Header'] = 'changed'
+    assert clone.content == b'content'
+    assert clone.request is request
+    assert response.headers['X-Header'] == 'value'
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_coalesce(session, middleware, slow_fixture, hits):
+    responses, errors = fetch_concurrently(session, 'http://test.com/slow')
+    assert not errors
+    assert len(hits) == 1
+    assert [response.text for response in responses] == ['content'] * 8
+    assert sum(getattr(response, 'coalesced', False)
+               for response in responses) == 7
+    assert middleware.flights == {}
+    assert middleware.leaders == {}
+
+
+@pytest.mark.httpretty
+def test_coalesce_sequential(session, slow_fixture, hits):
+    session.get('http://test.com/slow')
+    session.get('http://test.com/slow')
+    assert len(hits) == 2
+
+
+@pytest.mark.httpretty
+def test_coalesce_vary_mismatch(session, slow_fixture, hits):
+    responses = []
+    workers = [
+        threading.Thread(target=lambda variant=variant: responses.append(
+            session.get('http://test.com/slow', headers={'X-Variant': variant})
+        ))
+        for variant in ['a', 'b']
+    ]
+    for thread in workers:
+        thread.start()
+        time.sleep(0.01)
+    for thread in workers:
+        thread.join()
+    assert len(hits) == 2
+    assert not any(getattr(response, 'coalesced', False)
+                   for response in responses)
+
+
+@pytest.mark.httpretty
+def test_coalesce_stream_not_coalesced(session, slow_fixture, hits):
+    fetch_concurrently(session, 'http://test.com/slow', count=3, stream=True)
+    assert len(hits) == 3
+
+
+@pytest.mark.httpretty
+def test_coalesce_leader_error(session, middleware, slow_fixture, hits):
+    session.adapters['http://'].register(FailOnceMiddleware())
+    responses, errors = fetch_concurrently(
+        session, 'http://test.com/slow', count=3,
+    )
+    assert len(errors) == 1
+    assert len(responses) == 2
+    assert middleware.flights == {}
+    assert middleware.leaders == {}
+
+
+@pytest.mark.httpretty
+def test_coalesce_local_response(middleware):
+    class LocalMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            return mark_local(HTTPResponse(
+                body=io.BytesIO(b'local'), status=200, preload_content=False,
+            ))
+
+    adapter = MiddlewareHTTPAdapter([middleware, LocalMiddleware()])
+    session = requests.Session()
+    session.mount('http://', adapter)
+    assert session.get('http://test.com/local').text == 'local'
+    assert middleware.flights == {}
+    assert middleware.leaders == {}
+
+
+def test_coalesce_short_circuit(middleware):
+    class CachedMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'cached'
+            return response
+
+    adapter = MiddlewareHTTPAdapter([middleware, CachedMiddleware()])
+    request = requests.Request('GET', 'http://test.com/cached').prepare()
+    start = time.time()
+    for _ in range(2):
+        assert adapter.send(request.copy()).text == 'cached'
+    assert time.time() - start < 1
+    assert middleware.flights == {}
+    assert middleware.leaders == {}
+
+
+def test_default_timeout():
+    assert coalesceware.CoalesceMiddleware().timeout is not None
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import gzip
+import zlib
+import threading
+
+import requests
+
+from requests_middleware.contrib import compressware
+
+from .utils import make_session
+
+
+BODY = b'compressible content ' * 1000
+
+
+def gzipped(data):
+    return gzip.compress(data)
+
+
+@pytest.fixture
+def middleware():
+    return compressware.CompressionMiddleware(chunk_size=1024)
+
+
+@pytest.fixture
+def session(middleware):
+    return make_session(middleware)
+
+
+def register_body(body, encoding):
+    httpretty.register_uri(
+        httpretty.GET, 'http://test.com/page', body=body,
+        adding_headers={'Content-Encoding': encoding},
+    )
+
+
+# Unit tests
+
+def test_zlib_decoder_limit():
+    decoder = compressware.ZlibDecoder(16 + zlib.MAX_WBITS)
+    chunks = list(decoder.decode(gzipped(BODY), 1000))
+    assert max(len(chunk) for chunk in chunks) <= 1000
+    assert b''.join(chunks) + decoder.flush() == BODY
+
+
+class FakeBrotli(object):
+    """Stands in for `brotli`, inflating zlib data with the `brotli` 1.1
+    `Decompressor` interface.
+    """
+    class Decompressor(object):
+
+        def __init__(self):
+            self.obj = zlib.decompressobj()
+            self.pending = b''
+
+        def process(self, data, output_buffer_limit=0):
+            self.pending += self.obj.decompress(data)
+            limit = output_buffer_limit or len(self.pending)
+            chunk, self.pending = (
+                self.pending[:limit], self.pending[limit:],
+            )
+            return chunk
+
+        def can_accept_more_data(self):
+            return not self.pending
+
+
+def test_brotli_decoder_limit(monkeypatch):
+    monkeypatch.setattr(compressware, 'brotli', FakeBrotli)
+    monkeypatch.setattr(compressware, 'BROTLI_BOUNDED', True)
+    decoder = compressware.BrotliDecoder()
+    chunks = list(decoder.decode(zlib.compress(BODY), 1000))
+    assert max(len(chunk) for chunk in chunks) <= 1000
+    assert b''.join(chunks) == BODY
+
+
+def test_multi_decoder():
+    data = gzipped(zlib.compress(BODY))
+    decoder = compressware.MultiDecoder([
+        compressware.ZlibDecoder(16 + zlib.MAX_WBITS),
+        compressware.ZlibDecoder(zlib.MAX_WBITS),
+    ])
+    assert b''.join(decoder.decode(data, 100)) + decoder.flush() == BODY
+
+
+def test_content_codings():
+    headers = {'Content-Encoding': 'deflate, identity, GZIP'}
+    assert compressware.content_codings(headers) == ['deflate', 'gzip']
+
+
+def test_unavailable_encoding():
+    with pytest.raises(ValueError):
+        compressware.CompressionMiddleware(encodings=['gzip', 'lzma'])
+
+
+def test_max_size_bounded_encodings(monkeypatch):
+    monkeypatch.setattr(
+        compressware, 'AVAILABLE_ENCODINGS', ('zstd', 'gzip', 'deflate'),
+    )
+    middleware = compressware.CompressionMiddleware(max_size=1000)
+    assert middleware.encodings == ('gzip', 'deflate')
+    with pytest.raises(ValueError):
+        compressware.CompressionMiddleware(encodings=['zstd'], max_size=1000)
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_accept_encoding(session, page_fixture):
+    session.get('http://test.com/page')
+    assert httpretty.last_request().headers['Accept-Encoding'] == ', '.join(
+        compressware.AVAILABLE_ENCODINGS
+    )
+    session.get('http://test.com/page', headers={'Accept-Encoding': 'gzip'})
+    assert httpretty.last_request().headers['Accept-Encoding'] == 'gzip'
+
+
+@pytest.mark.httpretty
+def test_gzip(session, middleware):
+    compressed = gzipped(BODY)
+    register_body(compressed, 'gzip')
+    response = session.get('http://test.com/page')
+    assert response.content == BODY
+    assert 'Content-Encoding' not in response.headers
+    assert middleware.stats() == {
+        'responses': 1, 'offloaded': 0,
+        'received': len(compressed), 'decoded': len(BODY),
+    }
+
+
+@pytest.mark.httpretty
+def test_gzip_members(session):
+    register_body(gzipped(BODY) + gzipped(BODY), 'gzip')
+    assert session.get('http://test.com/page').content == BODY * 2
+
+
+@pytest.mark.httpretty
+@pytest.mark.parametrize('compress', [
+    zlib.compress,
+    lambda data: zlib.compress(data)[2:-4],
+])
+def test_deflate(session, compress):
+    register_body(compress(BODY), 'deflate')
+    assert session.get('http://test.com/page').content == BODY
+
+
+@pytest.mark.httpretty
+def test_stream(session):
+    register_body(gzipped(BODY), 'gzip')
+    response = session.get('http://test.com/page', stream=True)
+    chunks = list(response.iter_content(4096))
+    assert b''.join(chunks) == BODY
+
+
+@pytest.mark.httpretty
+def test_max_size():
+    register_body(gzipped(BODY), 'gzip')
+    session = make_session(compressware.CompressionMiddleware(max_size=1000))
+    with pytest.raises(requests.exceptions.ContentDecodingError):
+        session.get('http://test.com/page')
+
+
+@pytest.mark.httpretty
+def test_corrupt_body(session):
+    register_body(b'not gzip', 'gzip')
+    with pytest.raises(requests.exceptions.ContentDecodingError):
+        session.get('http://test.com/page')
+
+
+@pytest.mark.httpretty
+def test_unsupported_coding_untouched(session):
+    register_body(b'packed', 'x-unknown')
+    response = session.get('http://test.com/page')
+    assert response.content == b'packed'
+    assert response.headers['Content-Encoding'] == 'x-unknown'
+
+
+@pytest.mark.httpretty
+def test_offloaded():
+    middleware = compressware.CompressionMiddleware(
+        chunk_size=1024, workers=2, offload_size=100, buffer_chunks=2,
+    )
+    session = make_session(middleware)
+    register_body(gzipped(BODY), 'gzip')
+    assert session.get('http://test.com/page').content == BODY
+    assert middleware.stats()['offloaded'] == 1
+
+
+@pytest.mark.httpretty
+def test_offloaded_error():
+    middleware = compressware.CompressionMiddleware(
+        workers=1, offload_size=0,
+    )
+    session = make_session(middleware)
+    register_body(b'not gzip', 'gzip')
+    with pytest.raises(requests.exceptions.ContentDecodingError):
+        session.get('http://test.com/page')
+
+
+@pytest.mark.httpretty
+def test_offloaded_out_of_order():
+    middleware = compressware.CompressionMiddleware(
+        chunk_size=1024, workers=1, offload_size=1, buffer_chunks=1,
+    )
+    session = make_session(middleware)
+    for name in ('first', 'second'):
+        httpretty.register_uri(
+            httpretty.GET, 'http://test.com/' + name, body=gzipped(BODY),
+            adding_headers={'Content-Encoding': 'gzip'},
+        )
+    first = session.get('http://test.com/first', stream=True)
+    second = session.get('http://test.com/second', stream=True)
+    # The worker decodes `first`, blocked until its buffer is read
+    chunks = first.iter_content(1024)
+    head = next(chunks)
+    contents = []
+    thread = threading.Thread(target=lambda: contents.append(second.content))
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert contents == [BODY]
+    assert head + b''.join(chunks) == BODY
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import os
+import sys
+import subprocess
+
+from requests_middleware import contrib
+from requests_middleware.contrib import robotware, throttleware
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Contrib modules whose third-party dependencies are imported lazily
+LAZY_MODULES = [
+    'requests_middleware.contrib.cachecontrolware',
+    'requests_middleware.contrib.httpcacheware',
+    'requests_middleware.contrib.robotware',
+]
+
+DEPENDENCIES = ['cachecontrol', 'httpcache', 'reppy']
+
+
+def import_times(modules):
+    """Import `modules` in a fresh interpreter, after `requests_middleware`,
+    and return the cumulative import time of each module imported, in
+    microseconds, from `python -X importtime`.
+    """
+    code = 'import requests_middleware; import {0}'.format(', '.join(modules))
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    _, output = process.communicate()
+    assert process.returncode == 0, output
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split(':', 1)[1].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+# Unit tests
+
+def test_load():
+    assert contrib.load('throttle') is throttleware.ThrottleMiddleware
+    assert contrib.load('robots') is robotware.RobotsMiddleware
+
+
+def test_create():
+    middleware = contrib.create('throttle', throttleware.DelayThrottler(1))
+    assert isinstance(middleware, throttleware.ThrottleMiddleware)
+
+
+def test_unknown():
+    with pytest.raises(ValueError):
+        contrib.load('missing')
+    with pytest.raises(ValueError):
+        contrib.available('missing')
+
+
+def test_register(monkeypatch):
+    monkeypatch.setattr(contrib, 'MIDDLEWARES', dict(contrib.MIDDLEWARES))
+    contrib.register(
+        'custom', 'requests_middleware.contrib.throttleware',
+        'ThrottleMiddleware', requires=['not_installed_module'],
+    )
+    assert contrib.load('custom') is throttleware.ThrottleMiddleware
+    assert not contrib.available('custom')
+
+
+def test_registered_classes():
+    for name in contrib.MIDDLEWARES:
+        assert callable(contrib.load(name))
+
+
+def test_lazy_class():
+    if not contrib.available('robots'):
+        pytest.skip('reppy is not installed')
+    from reppy.cache import RobotsCache
+    cls = robotware.bounded_robots_cache_class()
+    assert cls is robotware.bounded_robots_cache_class()
+    assert cls.__name__ == 'BoundedRobotsCache'
+    assert issubclass(cls, RobotsCache)
+
+
+# Integration tests
+
+def test_import_defers_dependencies():
+    times = import_times(LAZY_MODULES)
+    for dependency in DEPENDENCIES:
+        assert dependency not in times
+    # Generous bound: without their dependencies the modules load in a
+    # few milliseconds
+    assert sum(times[module] for module in LAZY_MODULES) < 500000
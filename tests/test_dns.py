@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import socket
+import threading
+
+import requests
+
+from requests_middleware.contrib import dnsware
+
+from .utils import Handler, make_session, serve
+
+
+class StubResolver(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def __call__(self, host):
+        self.calls.append(host)
+        record = self.records.get(host)
+        if record is None:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+        return record
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dnsware.compat, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def resolver():
+    return StubResolver({
+        'service.test': (['127.0.0.1'], None),
+        'spread.test': (['10.0.0.1', '10.0.0.2', '10.0.0.3'], 300),
+        'short.test': (['10.0.0.1'], 1),
+    })
+
+
+@pytest.fixture
+def cache(resolver):
+    return dnsware.DNSCache(
+        resolver, ttl=60, min_ttl=5, max_ttl=120, negative_ttl=10,
+    )
+
+
+class HostHandler(Handler):
+
+    def body(self):
+        return self.headers['Host'].encode('ascii')
+
+
+@pytest.fixture
+def server():
+    with serve(HostHandler) as server:
+        yield server.server_address[1]
+
+
+# Unit tests
+
+def test_default_ttl(cache, resolver, clock):
+    cache.resolve('service.test')
+    clock[0] += 59
+    cache.resolve('service.test')
+    assert resolver.calls == ['service.test']
+    clock[0] += 2
+    cache.resolve('service.test')
+    assert resolver.calls == ['service.test'] * 2
+
+
+def test_ttl_clamped(cache, resolver, clock):
+    cache.resolve('spread.test')
+    cache.resolve('short.test')
+    clock[0] += 4
+    cache.resolve('short.test')
+    clock[0] += 117
+    cache.resolve('spread.test')
+    assert resolver.calls == ['spread.test', 'short.test', 'spread.test']
+
+
+def test_negative_cache(cache, resolver, clock):
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve('missing.test')
+    assert resolver.calls == ['missing.test']
+    clock[0] += 11
+    with pytest.raises(socket.gaierror):
+        cache.resolve('missing.test')
+    assert len(resolver.calls) == 2
+    assert cache.stats()['failures'] == 2
+
+
+def test_spread(cache):
+    firsts = [cache.resolve('spread.test')[0] for _ in range(4)]
+    assert firsts == ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.1']
+    assert sorted(cache.resolve('spread.test')) == [
+        '10.0.0.1', '10.0.0.2', '10.0.0.3',
+    ]
+
+
+def test_ip_address_not_resolved(cache, resolver):
+    assert cache.resolve('127.0.0.1') == ['127.0.0.1']
+    assert cache.resolve('::1') == ['::1']
+    assert resolver.calls == []
+
+
+def test_bounded(resolver):
+    cache = dnsware.DNSCache(resolver, max_entries=1)
+    cache.resolve('service.test')
+    cache.resolve('spread.test')
+    assert list(cache.entries) == ['spread.test']
+
+
+def test_single_resolution(resolver):
+    release = threading.Event()
+
+    def slow_resolver(host):
+        release.wait(5)
+        return resolver(host)
+
+    cache = dnsware.DNSCache(slow_resolver)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.resolve('service.test')),
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [['127.0.0.1']] * 4
+    assert resolver.calls == ['service.test']
+
+
+def test_prefetch(cache, resolver):
+    assert cache.prefetch(['service.test', 'missing.test']) == [
+        ['127.0.0.1'], [],
+    ]
+    cache.resolve('service.test')
+    assert sorted(resolver.calls) == ['missing.test', 'service.test']
+
+
+# Integration tests
+
+def test_resolve_through_cache(cache, resolver, server):
+    middleware = dnsware.DNSCacheMiddleware(cache)
+    session = make_session(middleware)
+    url = 'http://service.test:{0}/'.format(server)
+    response = session.get(url)
+    assert response.text == 'service.test:{0}'.format(server)
+    session.get(url, headers={'Connection': 'close'})
+    session.get(url)
+    assert resolver.calls == ['service.test']
+    assert cache.stats()['hits'] == 1
+
+
+def test_failover(resolver, server):
+    resolver.records['service.test'] = (['127.0.0.2', '127.0.0.1'], None)
+    session = make_session(dnsware.DNSCacheMiddleware(resolver=resolver))
+    response = session.get('http://service.test:{0}/'.format(server))
+    assert response.status_code == 200
+
+
+def test_resolution_failure(cache, resolver):
+    session = make_session(dnsware.DNSCacheMiddleware(cache))
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            session.get('http://missing.test/')
+    assert resolver.calls == ['missing.test']
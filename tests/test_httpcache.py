@@ -1,32 +1,149 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import httpretty
+
+import datetime
 
 import requests
 
-from requests_middleware.middleware import MiddlewareHTTPAdapter
+from requests_middleware.middleware import BaseMiddleware
+
+from requests_middleware import contrib
+from requests_middleware.contrib import httpcacheware
 
-try:
-    from requests_middleware.contrib import httpcacheware
-    has_httpcache = True
-except ImportError:
-    has_httpcache = False
+from .utils import make_session
 
 pytestmark = pytest.mark.skipif(
-    not has_httpcache,
+    not contrib.available('httpcache'),
     reason='httpcache is not installed; skipping caching tests.'
 )
 
 
 @pytest.fixture
 def session():
-    session = requests.Session()
-    adapter = MiddlewareHTTPAdapter()
-    cache_middleware = httpcacheware.CacheMiddleware()
-    adapter.register(cache_middleware)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+    return make_session(httpcacheware.CacheMiddleware())
+
+
+@pytest.fixture
+def fresh_pages():
+    for size in (10, 20, 30):
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://test.com/fresh/{0}'.format(size),
+            body='x' * size,
+            adding_headers={'Cache-Control': 'max-age=3600'},
+        )
+
+
+@pytest.fixture
+def stale_page():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        responses=[
+            httpretty.Response(
+                body='stale',
+                adding_headers={
+                    'Cache-Control': 'max-age=10, stale-while-revalidate=60, '
+                                     'stale-if-error=60',
+                    'ETag': '"v1"',
+                },
+            ),
+            httpretty.Response(
+                body='',
+                status=304,
+                adding_headers={'Cache-Control': 'max-age=10'},
+            ),
+        ],
+    )
+
+
+@pytest.fixture
+def failing_page():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/stale',
+        responses=[
+            httpretty.Response(
+                body='stale',
+                adding_headers={
+                    'Cache-Control': 'max-age=10, stale-if-error=60',
+                },
+            ),
+            httpretty.Response(body='error', status=503),
+        ],
+    )
+
+
+def expire(middleware, url, seconds=20):
+    """Make the cached entry for `url` expire `seconds` ago."""
+    entry = middleware.cache._cache[url]
+    entry['expiry'] = (
+        datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+    )
+
+
+class FailMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        raise requests.ConnectionError('failed')
+
+
+class FakeResponse(object):
+
+    def __init__(self, content):
+        self.content = content
+
+
+def entry(content):
+    return {'response': FakeResponse(content)}
+
+
+# Unit tests
+
+def test_sized_lru_evicts_by_size():
+    stats = httpcacheware.CacheStats()
+    lru = httpcacheware.SizedLRU(10, stats=stats)
+    lru['first'] = entry(b'12345')
+    lru['second'] = entry(b'12345')
+    lru['first']
+    lru['third'] = entry(b'12345')
+    assert lru.size == 10
+    assert list(lru) == ['first', 'third']
+    assert stats.evictions == 1
+
+
+def test_sized_lru_capacity():
+    lru = httpcacheware.SizedLRU(100, capacity=2)
+    for key in ('first', 'second', 'third'):
+        lru[key] = entry(b'1')
+    assert list(lru) == ['second', 'third']
+    assert lru.size == 2
+
+
+def test_sized_lru_replace_and_delete():
+    lru = httpcacheware.SizedLRU(10)
+    lru['key'] = entry(b'12345')
+    lru['key'] = entry(b'123')
+    assert lru.size == 3
+    del lru['key']
+    assert lru.size == 0
+    assert 'key' not in lru
+
+
+def test_sized_lru_skips_oversize():
+    lru = httpcacheware.SizedLRU(4)
+    lru['key'] = entry(b'12345')
+    assert 'key' not in lru
+    assert lru.size == 0
+
+
+def test_stats_hit_rate():
+    stats = httpcacheware.CacheStats()
+    assert stats.hit_rate == 0
+    stats.hits, stats.misses = 3, 1
+    assert stats.as_dict()['hit_rate'] == 0.75
 
 
 # Integration tests
@@ -42,3 +159,83 @@ def test_cache_respect_no_cache(session, non_cached_page):
     resp1 = session.get('http://test.com/cache')
     resp2 = session.get('http://test.com/cache')
     assert resp1 is not resp2
+
+
+@pytest.mark.httpretty
+def test_cache_stats(session, cached_page):
+    middleware = session.get_adapter('http://').middlewares[0]
+    session.get('http://test.com/cache')
+    session.get('http://test.com/cache')
+    assert middleware.stats.misses == 2
+    assert middleware.stats.bytes_saved == len('content')
+
+
+@pytest.mark.httpretty
+def test_cache_bounded(fresh_pages):
+    middleware = httpcacheware.CacheMiddleware(max_bytes=50)
+    session = make_session(middleware)
+    for size in (10, 20, 30):
+        session.get('http://test.com/fresh/{0}'.format(size))
+    assert middleware.cache.size == 50
+    assert middleware.stats.evictions == 1
+    resp = session.get('http://test.com/fresh/30')
+    assert resp.text == 'x' * 30
+    session.get('http://test.com/fresh/10')
+    assert list(middleware.cache._cache) == [
+        'http://test.com/fresh/30',
+        'http://test.com/fresh/10',
+    ]
+    assert middleware.stats.as_dict() == {
+        'hits': 1,
+        'misses': 4,
+        'evictions': 2,
+        'bytes_saved': 30,
+        'hit_rate': 0.2,
+    }
+
+
+@pytest.mark.httpretty
+def test_stale_while_revalidate(stale_page):
+    middleware = httpcacheware.CacheMiddleware()
+    session = make_session(middleware)
+    resp1 = session.get('http://test.com/stale')
+    expire(middleware, 'http://test.com/stale')
+    resp2 = session.get('http://test.com/stale')
+    assert resp2 is resp1
+    assert middleware.revalidator.wait(5)
+    requests_ = httpretty.latest_requests()
+    assert len(requests_) == 2
+    assert requests_[1].headers['If-None-Match'] == '"v1"'
+    entry = middleware.cache._cache['http://test.com/stale']
+    assert entry['expiry'] > datetime.datetime.utcnow()
+    assert session.get('http://test.com/stale') is resp1
+    assert len(httpretty.latest_requests()) == 2
+    assert middleware.stats.hits == 2
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_status(failing_page):
+    middleware = httpcacheware.CacheMiddleware()
+    session = make_session(middleware)
+    resp1 = session.get('http://test.com/stale')
+    expire(middleware, 'http://test.com/stale')
+    assert session.get('http://test.com/stale') is resp1
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_exception(failing_page):
+    middleware = httpcacheware.CacheMiddleware()
+    session = make_session(middleware)
+    resp1 = session.get('http://test.com/stale')
+    expire(middleware, 'http://test.com/stale')
+    session.get_adapter('http://').register(FailMiddleware())
+    assert session.get('http://test.com/stale') is resp1
+
+
+@pytest.mark.httpretty
+def test_stale_if_error_expired(failing_page):
+    middleware = httpcacheware.CacheMiddleware()
+    session = make_session(middleware)
+    session.get('http://test.com/stale')
+    expire(middleware, 'http://test.com/stale', seconds=90)
+    assert session.get('http://test.com/stale').status_code == 503
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import time
+
+import requests
+
+from requests_middleware import instrument
+from requests_middleware.middleware import MiddlewareHTTPAdapter, BaseMiddleware
+
+
+class SendMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        pass
+
+
+class SlowResponseMiddleware(BaseMiddleware):
+
+    def after_build_response(self, req, resp, response):
+        time.sleep(0.05)
+        return response
+
+
+@pytest.fixture
+def observations():
+    return []
+
+
+@pytest.fixture
+def instrumentation(observations):
+    return instrument.Instrumentation(
+        callback=lambda *args: observations.append(args),
+    )
+
+
+@pytest.fixture
+def adapter(instrumentation):
+    return MiddlewareHTTPAdapter(
+        [SendMiddleware(), SlowResponseMiddleware()],
+        instrumentation=instrumentation,
+    )
+
+
+@pytest.fixture
+def session(adapter):
+    session = requests.Session()
+    session.mount('http://', adapter)
+    return session
+
+
+def find(rows, hook, name):
+    return [row for row in rows if row['hook'] == hook and row['name'] == name]
+
+
+# Unit tests
+
+@pytest.mark.parametrize('seconds', [1e-6, 3.7e-5, 0.002, 0.5, 12.0])
+def test_bucket_bounds(seconds):
+    index = instrument.bucket_index(seconds)
+    assert seconds <= instrument.bucket_bound(index)
+    assert instrument.bucket_bound(index) <= seconds * 1.25 + 1e-9
+    if index:
+        assert instrument.bucket_bound(index - 1) <= seconds
+
+
+def test_bucket_index_clamped():
+    assert instrument.bucket_index(0) == 0
+    assert instrument.bucket_index(1e9) == instrument.BUCKETS - 1
+
+
+def test_host_of():
+    assert instrument.host_of('http://test.com:8080/page?q') == 'test.com:8080'
+    assert instrument.host_of('https://test.com') == 'test.com'
+
+
+def test_histogram_summary():
+    histogram = instrument.Histogram()
+    for value in range(1, 101):
+        histogram.record(value / 1000.0)
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 0.001
+    assert summary['max'] == 0.1
+    assert summary['mean'] == pytest.approx(0.0505)
+    assert 0.05 <= summary['p50'] <= 0.05 * 1.25
+    assert 0.099 <= summary['p99'] <= 0.1
+
+
+def test_histogram_merge():
+    first, second = instrument.Histogram(), instrument.Histogram()
+    first.record(0.001)
+    second.record(0.1)
+    first.merge(second)
+    assert first.count == 2
+    assert (first.min, first.max) == (0.001, 0.1)
+
+
+def test_histogram_empty():
+    summary = instrument.Histogram().summary()
+    assert summary['count'] == 0
+    assert summary['p50'] is None
+
+
+def test_max_keys():
+    instrumentation = instrument.Instrumentation(max_keys=1)
+    instrumentation.record('send', 'HTTPAdapter', 'http://a.com/', 0.1)
+    instrumentation.record('send', 'HTTPAdapter', 'http://b.com/', 0.1)
+    instrumentation.record('send', 'HTTPAdapter', 'http://c.com/', 0.1)
+    hosts = [row['host'] for row in instrumentation.snapshot()]
+    assert hosts == ['*', 'a.com']
+
+
+def test_plan_unwrapped_when_disabled():
+    middleware = SendMiddleware()
+    adapter = MiddlewareHTTPAdapter([middleware])
+    assert adapter.plan.before_send == (middleware.before_send, )
+    adapter.instrument(instrument.Instrumentation())
+    assert adapter.plan.before_send != (middleware.before_send, )
+    adapter.instrument(None)
+    assert adapter.plan.before_send == (middleware.before_send, )
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_instrumented_hooks(session, instrumentation, page_fixture):
+    session.get('http://test.com/page')
+    session.get('http://test.com/page')
+    rows = instrumentation.snapshot()
+    assert set((row['hook'], row['name']) for row in rows) == set([
+        ('before_send', 'SendMiddleware'),
+        ('after_build_response', 'SlowResponseMiddleware'),
+        ('send', 'HTTPAdapter'),
+    ])
+    assert all(row['count'] == 2 for row in rows)
+    assert all(row['host'] == 'test.com' for row in rows)
+    slow, = find(rows, 'after_build_response', 'SlowResponseMiddleware')
+    send, = find(rows, 'send', 'HTTPAdapter')
+    assert slow['min'] >= 0.05
+    assert send['max'] < 0.05
+
+
+@pytest.mark.httpretty
+def test_instrumented_callback(session, observations, page_fixture):
+    session.get('http://test.com/page')
+    assert [args[:3] for args in observations] == [
+        ('before_send', 'SendMiddleware', 'test.com'),
+        ('after_build_response', 'SlowResponseMiddleware', 'test.com'),
+        ('send', 'HTTPAdapter', 'test.com'),
+    ]
+
+
+@pytest.mark.httpretty
+def test_instrumented_callback_errors_ignored(session, instrumentation,
+                                             page_fixture):
+    def callback(*args):
+        raise RuntimeError('failed')
+    instrumentation.callback = callback
+    assert session.get('http://test.com/page').text == 'content'
+
+
+@pytest.mark.httpretty
+def test_aggregate(session, instrumentation, page_fixture):
+    session.get('http://test.com/page')
+    merged = instrumentation.aggregate(by=('hook', ))
+    assert sorted(merged) == [
+        ('after_build_response', ), ('before_send', ), ('send', ),
+    ]
+    assert merged[('send', )].count == 1
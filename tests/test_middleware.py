@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import io
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+from requests_middleware.middleware import (
+    MiddlewareHTTPAdapter, BaseMiddleware, DispatchPlan, overrides, mark_local,
+)
+
+
+class SendMiddleware(BaseMiddleware):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def before_send(self, request, *args, **kwargs):
+        self.calls.append(('before_send', self))
+
+
+class ResponseMiddleware(BaseMiddleware):
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def after_build_response(self, req, resp, response):
+        self.calls.append(('after_build_response', self))
+        return response
+
+
+class LocalMiddleware(BaseMiddleware):
+
+    def __init__(self, local=True):
+        self.local = local
+
+    def before_send(self, request, *args, **kwargs):
+        resp = HTTPResponse(
+            body=io.BytesIO(b'local'),
+            headers={'Content-Type': 'text/plain; charset=utf-8'},
+            status=200,
+            reason='OK',
+            preload_content=False,
+        )
+        return mark_local(resp) if self.local else resp
+
+
+class CachedMiddleware(BaseMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'cached'
+        return response
+
+
+class LocalResponseMiddleware(ResponseMiddleware):
+
+    def on_local_response(self, req, response):
+        self.calls.append(('on_local_response', self))
+        response.seen = True
+        return response
+
+
+class AroundMiddleware(BaseMiddleware):
+
+    def __init__(self, calls, attempts=2):
+        self.calls = calls
+        self.attempts = attempts
+
+    def around_send(self, send, request, **kwargs):
+        for _ in range(self.attempts):
+            self.calls.append(('around_send', self))
+            response = send(request, **kwargs)
+        return response
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def adapter():
+    return MiddlewareHTTPAdapter()
+
+
+@pytest.fixture
+def session(adapter):
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Unit tests
+
+def test_overrides(calls):
+    middleware = SendMiddleware(calls)
+    assert overrides(middleware, 'before_send')
+    assert not overrides(middleware, 'after_build_response')
+    assert not overrides(BaseMiddleware(), 'before_send')
+
+
+def test_overrides_instance_attribute():
+    middleware = BaseMiddleware()
+    middleware.before_send = lambda request, *args, **kwargs: None
+    assert overrides(middleware, 'before_send')
+
+
+def test_plan_skips_noop_hooks(calls):
+    send = SendMiddleware(calls)
+    response = ResponseMiddleware(calls)
+    plan = DispatchPlan([BaseMiddleware(), send, response])
+    assert plan.before_init_poolmanager == ()
+    assert plan.after_init_poolmanager == ()
+    assert plan.before_send == (send.before_send, )
+    assert plan.before_build_response == ()
+    assert plan.after_build_response == (response.after_build_response, )
+    assert plan.on_send_error == ()
+    assert plan.on_local_response == ()
+    assert plan.around_send is None
+    assert plan.inner is None
+
+
+def test_plan_split(calls):
+    outer, inner = SendMiddleware(calls), SendMiddleware(calls)
+    around = AroundMiddleware(calls)
+    plan = DispatchPlan([outer, around, inner])
+    assert plan.around_send == around.around_send
+    assert plan.before_send == (outer.before_send, )
+    assert plan.inner.middlewares == [inner]
+    assert plan.inner.before_send == (inner.before_send, )
+
+
+def test_plan_order(calls):
+    first, second = ResponseMiddleware(calls), ResponseMiddleware(calls)
+    plan = DispatchPlan([first, second])
+    assert plan.after_build_response == (
+        second.after_build_response,
+        first.after_build_response,
+    )
+
+
+def test_register_rebuilds_plan(adapter, calls):
+    assert adapter.plan.before_send == ()
+    middleware = SendMiddleware(calls)
+    adapter.register(middleware)
+    assert adapter.plan.before_send == (middleware.before_send, )
+    adapter.unregister(middleware)
+    assert adapter.plan.before_send == ()
+
+
+def test_mutation_rebuilds_plan(adapter, calls):
+    middleware = SendMiddleware(calls)
+    adapter.middlewares.append(middleware)
+    assert adapter.plan.before_send == (middleware.before_send, )
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_hooks_called(adapter, session, calls, page_fixture):
+    send = SendMiddleware(calls)
+    response = ResponseMiddleware(calls)
+    adapter.register(send)
+    adapter.register(response)
+    session.get('http://test.com/page')
+    assert calls == [
+        ('before_send', send),
+        ('after_build_response', response),
+    ]
+
+
+@pytest.mark.httpretty
+def test_around_send(adapter, session, calls, page_fixture):
+    outer, inner = SendMiddleware(calls), ResponseMiddleware(calls)
+    around = AroundMiddleware(calls)
+    response = ResponseMiddleware(calls)
+    for middleware in (outer, response, around, inner):
+        adapter.register(middleware)
+    session.get('http://test.com/page')
+    assert calls == [
+        ('before_send', outer),
+        ('around_send', around),
+        ('after_build_response', inner),
+        ('around_send', around),
+        ('after_build_response', inner),
+        ('after_build_response', response),
+    ]
+
+
+@pytest.mark.httpretty
+def test_on_send_error(adapter, session, calls):
+    class ErrorMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            raise RuntimeError('failed')
+
+        def on_send_error(self, request, error):
+            calls.append(('on_send_error', error))
+
+    adapter.register(ErrorMiddleware())
+    with pytest.raises(RuntimeError):
+        session.get('http://test.com/page')
+    assert len(calls) == 1
+    assert isinstance(calls[0][1], RuntimeError)
+
+
+@pytest.mark.httpretty
+def test_on_send_error_recovers(adapter, session, calls):
+    recovered = requests.Response()
+    recovered.status_code = 200
+
+    class FailMiddleware(BaseMiddleware):
+        def before_send(self, request, *args, **kwargs):
+            raise RuntimeError('failed')
+
+    class RecoverMiddleware(BaseMiddleware):
+        def on_send_error(self, request, error):
+            calls.append('recover')
+            return recovered
+
+    adapter.register(RecoverMiddleware())
+    adapter.register(FailMiddleware())
+    adapter.register(RecoverMiddleware())
+    assert session.get('http://test.com/page') is recovered
+    assert calls == ['recover', 'recover']
+
+
+@pytest.mark.httpretty
+def test_local_response(adapter, session, calls):
+    response_middleware = LocalResponseMiddleware(calls)
+    adapter.register(response_middleware)
+    adapter.register(LocalMiddleware())
+    response = session.get('http://test.com/page')
+    assert calls == [('on_local_response', response_middleware)]
+    assert response.seen
+    assert response.status_code == 200
+    assert response.reason == 'OK'
+    assert response.encoding == 'utf-8'
+    assert response.headers['content-type'] == 'text/plain; charset=utf-8'
+    assert response.url == 'http://test.com/page'
+    assert response.request.url == 'http://test.com/page'
+    assert response.connection is adapter
+    assert response.text == 'local'
+
+
+@pytest.mark.httpretty
+def test_unmarked_response_built(adapter, session, calls):
+    response_middleware = LocalResponseMiddleware(calls)
+    adapter.register(response_middleware)
+    adapter.register(LocalMiddleware(local=False))
+    response = session.get('http://test.com/page')
+    assert calls == [('after_build_response', response_middleware)]
+    assert response.text == 'local'
+
+
+def test_short_circuit_response(adapter, calls):
+    before = LocalResponseMiddleware(calls)
+    after = LocalResponseMiddleware(calls)
+    adapter.register(before)
+    adapter.register(CachedMiddleware())
+    adapter.register(after)
+    request = requests.Request('GET', 'http://test.com/page').prepare()
+    response = adapter.send(request)
+    assert calls == [('on_local_response', before)]
+    assert response.seen
+    assert response.text == 'cached'
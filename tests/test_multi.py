@@ -8,14 +8,11 @@ import requests
 
 from requests_middleware.middleware import MiddlewareHTTPAdapter
 
-try:
-    from requests_middleware.contrib import robotware, sslware
-    has_reqs = True
-except ImportError:
-    has_reqs = False
+from requests_middleware import contrib
+from requests_middleware.contrib import robotware, sslware
 
 pytestmark = pytest.mark.skipif(
-    not has_reqs,
+    not contrib.available('robots'),
     reason='Requirements not installed; skipping multi-adapter tests.'
 )
 
@@ -23,7 +20,9 @@ pytestmark = pytest.mark.skipif(
 @pytest.fixture
 def session():
     session = requests.Session()
-    robots_middleware = robotware.RobotsMiddleware()
+    robots_middleware = robotware.RobotsMiddleware(
+        cache=robotware.bounded_robots_cache_class()()
+    )
     ssl_middleware = sslware.SSLMiddleware(ssl.PROTOCOL_TLSv1)
     middlewares = [robots_middleware, ssl_middleware]
     adapter = MiddlewareHTTPAdapter(middlewares=middlewares)
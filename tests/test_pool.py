@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import requests
+from requests.packages.urllib3.exceptions import (
+    ClosedPoolError, EmptyPoolError,
+)
+
+from requests_middleware.middleware import MiddlewareHTTPAdapter
+from requests_middleware.contrib import poolware
+
+
+@pytest.fixture
+def middleware():
+    return poolware.PoolMiddleware(
+        maxsize=2, hosts={'hot.com': {'maxsize': 8, 'block': True}},
+    )
+
+
+@pytest.fixture
+def adapter(middleware):
+    return MiddlewareHTTPAdapter([middleware], pool_maxsize=4)
+
+
+@pytest.fixture
+def session(adapter):
+    session = requests.Session()
+    session.mount('http://', adapter)
+    return session
+
+
+@pytest.fixture
+def pages():
+    for host in ('hot.com', 'cold.com'):
+        httpretty.register_uri(
+            httpretty.GET, 'http://{0}/page'.format(host), body='content',
+        )
+
+
+def pool_for(adapter, host):
+    return adapter.poolmanager.connection_from_host(host, 80, 'http')
+
+
+def row_for(middleware, host):
+    rows = [row for row in middleware.snapshot() if row['host'] == host]
+    assert len(rows) == 1
+    return rows[0]
+
+
+# Unit tests
+
+def test_options_for(middleware):
+    middleware.configure('hot.com:8080', maxsize=16)
+    assert middleware.options_for('http', 'cold.com', 80) == {'maxsize': 2}
+    assert middleware.options_for('http', 'hot.com', 80) == {
+        'maxsize': 8, 'block': True,
+    }
+    assert middleware.options_for('http', 'hot.com', 8080) == {
+        'maxsize': 16, 'block': True,
+    }
+
+
+def test_configure_unknown_option(middleware):
+    with pytest.raises(TypeError):
+        middleware.configure('hot.com', size=8)
+
+
+def test_pool_sizes(adapter):
+    hot, cold = pool_for(adapter, 'hot.com'), pool_for(adapter, 'cold.com')
+    assert (hot.pool.maxsize, hot.block) == (8, True)
+    assert (cold.pool.maxsize, cold.block) == (2, False)
+
+
+def test_pool_sizes_default_to_adapter():
+    adapter = MiddlewareHTTPAdapter(
+        [poolware.PoolMiddleware()], pool_maxsize=4,
+    )
+    assert pool_for(adapter, 'cold.com').pool.maxsize == 4
+
+
+def test_configure_replaces_pool(adapter, middleware):
+    hot, cold = pool_for(adapter, 'hot.com'), pool_for(adapter, 'cold.com')
+    middleware.configure('hot.com', maxsize=1, keepalive=30)
+    assert pool_for(adapter, 'cold.com') is cold
+    replaced = pool_for(adapter, 'hot.com')
+    assert replaced is not hot
+    assert hot.pool is None
+    assert replaced.pool.maxsize == 1
+    assert replaced.keepalive == 30
+
+
+def test_configure_clears_option(adapter, middleware):
+    pool_for(adapter, 'hot.com')
+    middleware.configure('hot.com', maxsize=None)
+    assert pool_for(adapter, 'hot.com').pool.maxsize == 2
+
+
+def test_configure_live_options(adapter, middleware):
+    cold = pool_for(adapter, 'cold.com')
+    middleware.configure(max_requests=10)
+    assert pool_for(adapter, 'cold.com') is cold
+    assert cold.max_requests == 10
+
+
+def test_pool_stats_exhausted(adapter, middleware):
+    middleware.configure('hot.com', maxsize=1)
+    pool = pool_for(adapter, 'hot.com')
+    conn = pool._get_conn()
+    for _ in range(3):
+        with pytest.raises(EmptyPoolError):
+            pool.urlopen('GET', '/page', pool_timeout=0.01)
+    assert row_for(middleware, 'hot.com')['in_use'] == 1
+    pool._put_conn(conn)
+    row = row_for(middleware, 'hot.com')
+    assert row['in_use'] == 0
+    assert row['checkouts'] == 1
+
+
+def test_pool_stats_closed(adapter, middleware):
+    pool = pool_for(adapter, 'hot.com')
+    pool.close()
+    with pytest.raises(ClosedPoolError):
+        pool.urlopen('GET', '/page')
+    assert row_for(middleware, 'hot.com')['in_use'] == 0
+
+
+def test_stats_bounded():
+    middleware = poolware.PoolMiddleware(max_stats=1)
+    adapter = MiddlewareHTTPAdapter([middleware])
+    pool_for(adapter, 'hot.com')
+    pool_for(adapter, 'cold.com')
+    assert [row['host'] for row in middleware.snapshot()] == ['cold.com']
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_pool_stats(session, middleware, pages):
+    for _ in range(3):
+        session.get('http://hot.com/page')
+    response = session.get('http://hot.com/page', stream=True)
+    row = row_for(middleware, 'hot.com')
+    assert row['checkouts'] == 4
+    assert row['in_use'] == 1
+    assert row['max_in_use'] == 1
+    assert row['created'] == 1
+    assert row['maxsize'] == 8
+    assert row['block'] is True
+    assert row['wait']['count'] == 4
+    response.close()
+    row = row_for(middleware, 'hot.com')
+    assert row['in_use'] == 0
+    assert row['idle'] == 1
+
+
+@pytest.mark.httpretty
+def test_pool_stats_discarded(session, middleware, pages):
+    responses = [
+        session.get('http://cold.com/page', stream=True) for _ in range(3)
+    ]
+    for response in responses:
+        response.content
+    row = row_for(middleware, 'cold.com')
+    assert row['max_in_use'] == 3
+    assert row['created'] == 3
+    assert row['discarded'] == 1
+    assert row['idle'] == 2
+
+
+@pytest.mark.httpretty
+def test_max_requests(session, middleware, pages):
+    middleware.configure('cold.com', max_requests=2)
+    for _ in range(5):
+        session.get('http://cold.com/page')
+    row = row_for(middleware, 'cold.com')
+    assert row['created'] == 1
+    assert row['expired'] == 2
+
+
+@pytest.mark.httpretty
+def test_keepalive(session, middleware, pages, monkeypatch):
+    middleware.configure('cold.com', keepalive=10)
+    now = [1000.0]
+    monkeypatch.setattr(poolware.compat, 'monotonic', lambda: now[0])
+    session.get('http://cold.com/page')
+    now[0] += 5
+    session.get('http://cold.com/page')
+    assert row_for(middleware, 'cold.com')['expired'] == 0
+    now[0] += 20
+    session.get('http://cold.com/page')
+    assert row_for(middleware, 'cold.com')['expired'] == 1
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import httpretty
+
+import requests
+
+from requests_middleware.middleware import BaseMiddleware
+from requests_middleware.contrib import retryware, throttleware
+
+from . import utils
+from .utils import make_session
+
+from requests_middleware import contrib
+from requests_middleware.contrib import cachecontrolware
+
+has_cachecontrol = contrib.available('cachecontrol')
+
+
+class CountingThrottler(throttleware.BaseThrottler):
+
+    def __init__(self):
+        self.checked = []
+        self.stored = []
+
+    def check(self, request):
+        self.checked.append(request)
+
+    def store(self, req, resp, response):
+        self.stored.append(response.status_code)
+
+
+class FailingMiddleware(BaseMiddleware):
+
+    def __init__(self, failures, error=requests.ConnectionError):
+        self.failures = failures
+        self.error = error
+
+    def before_send(self, request, *args, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise self.error('failed')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(retryware.random, 'uniform', lambda low, high: high)
+    return utils.mock_clock(monkeypatch, retryware)
+
+
+@pytest.fixture
+def throttler():
+    return CountingThrottler()
+
+
+def register_statuses(method, *statuses, **kwargs):
+    httpretty.register_uri(
+        method, 'http://test.com/page',
+        responses=[
+            httpretty.Response(body='content', status=status, **kwargs)
+            for status in statuses
+        ],
+    )
+
+
+# Unit tests
+
+def test_budget(clock):
+    budget = retryware.RetryBudget(ratio=0.1, min_per_second=0, window=10)
+    for _ in range(20):
+        budget.request()
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert budget.denied == 1
+    clock.now += 5
+    for _ in range(10):
+        budget.request()
+    assert budget.withdraw()
+    clock.now += 6
+    assert not budget.withdraw()
+    assert (budget.requests, budget.retries) == (10, 1)
+
+
+def test_budget_min_per_second(clock):
+    budget = retryware.RetryBudget(ratio=0.1, min_per_second=0.5, window=4)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_delay(clock):
+    middleware = retryware.RetryMiddleware(backoff=1, max_backoff=5)
+    assert [middleware.delay(attempt) for attempt in range(4)] == [1, 2, 4, 5]
+
+
+def test_retryable():
+    middleware = retryware.RetryMiddleware()
+    get = requests.Request('GET', 'http://test.com/page').prepare()
+    post = requests.Request('POST', 'http://test.com/page', data='a').prepare()
+    put = requests.Request('PUT', 'http://test.com/page', data='a').prepare()
+    stream = requests.Request(
+        'PUT', 'http://test.com/page', data=iter([b'a']),
+    ).prepare()
+    assert middleware.retryable(get)
+    assert middleware.retryable(put)
+    assert not middleware.retryable(post)
+    assert not middleware.retryable(stream)
+
+
+# Integration tests
+
+@pytest.mark.httpretty
+def test_retry_status(clock, throttler):
+    register_statuses(httpretty.GET, 503, 503, 200)
+    session = make_session(
+        retryware.RetryMiddleware(backoff=1),
+        throttleware.ThrottleMiddleware(throttler),
+    )
+    response = session.get('http://test.com/page')
+    assert response.status_code == 200
+    assert response.text == 'content'
+    assert clock.sleeps == [1, 2]
+    assert throttler.stored == [503, 503, 200]
+    assert len(set(map(id, throttler.checked))) == 3
+
+
+@pytest.mark.httpretty
+def test_retries_exhausted(clock):
+    register_statuses(httpretty.GET, 503, 503, 503)
+    session = make_session(retryware.RetryMiddleware(retries=2))
+    assert session.get('http://test.com/page').status_code == 503
+    assert len(httpretty.latest_requests()) == 3
+
+
+@pytest.mark.httpretty
+def test_retry_after(clock):
+    register_statuses(httpretty.GET, 503, 200, adding_headers={
+        'Retry-After': '3',
+    })
+    session = make_session(retryware.RetryMiddleware())
+    assert session.get('http://test.com/page').status_code == 200
+    assert clock.sleeps == [3]
+
+
+@pytest.mark.httpretty
+def test_retry_after_too_long(clock):
+    register_statuses(httpretty.GET, 503, 200, adding_headers={
+        'Retry-After': '60',
+    })
+    session = make_session(retryware.RetryMiddleware())
+    assert session.get('http://test.com/page').status_code == 503
+    assert clock.sleeps == []
+
+
+@pytest.mark.httpretty
+def test_not_idempotent(clock):
+    register_statuses(httpretty.POST, 503, 200)
+    session = make_session(retryware.RetryMiddleware())
+    assert session.post('http://test.com/page').status_code == 503
+    assert len(httpretty.latest_requests()) == 1
+
+
+@pytest.mark.httpretty
+def test_budget_exhausted(clock):
+    register_statuses(httpretty.GET, 503, 200)
+    budget = retryware.RetryBudget(ratio=0, min_per_second=0)
+    session = make_session(retryware.RetryMiddleware(budget=budget))
+    assert session.get('http://test.com/page').status_code == 503
+    assert budget.denied == 1
+
+
+@pytest.mark.httpretty
+def test_retry_connection_error(clock, page_fixture, throttler):
+    session = make_session(
+        retryware.RetryMiddleware(),
+        throttleware.ThrottleMiddleware(throttler),
+        FailingMiddleware(2),
+    )
+    assert session.get('http://test.com/page').status_code == 200
+    assert len(clock.sleeps) == 2
+    assert len(throttler.checked) == 3
+
+
+@pytest.mark.httpretty
+def test_other_errors_not_retried(clock, page_fixture):
+    session = make_session(
+        retryware.RetryMiddleware(), FailingMiddleware(1, RuntimeError),
+    )
+    with pytest.raises(RuntimeError):
+        session.get('http://test.com/page')
+    assert clock.sleeps == []
+
+
+@pytest.mark.httpretty
+@pytest.mark.skipif(not has_cachecontrol, reason='cachecontrol is not installed')
+def test_cache_outside_retries(clock, throttler):
+    register_statuses(httpretty.GET, 503, 200, adding_headers={
+        'Cache-Control': 'max-age=60',
+    })
+    session = make_session(
+        cachecontrolware.CacheMiddleware(),
+        retryware.RetryMiddleware(),
+        throttleware.ThrottleMiddleware(throttler),
+    )
+    assert session.get('http://test.com/page').status_code == 200
+    response = session.get('http://test.com/page')
+    assert response.status_code == 200
+    assert response.text == 'content'
+    assert len(throttler.checked) == 2
+    assert len(clock.sleeps) == 1
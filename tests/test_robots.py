@@ -4,18 +4,19 @@ import pytest
 import httpretty
 
 import time
-import datetime
+import threading
 import requests
 import six.moves.http_client as httplib
-from dateutil.relativedelta import relativedelta
 
 from requests_middleware.middleware import MiddlewareHTTPAdapter
 
 from . import utils
 
+from requests_middleware.contrib import robotware
+
 try:
-    from requests_middleware.contrib import robotware
     from reppy.parser import Rules
+    from reppy.exceptions import ReppyException
     has_reppy = True
 except ImportError:
     has_reppy = False
@@ -31,7 +32,9 @@ def session():
     session = requests.Session()
     session.headers['User-Agent'] = 'robot'
     adapter = MiddlewareHTTPAdapter()
-    robots_middleware = robotware.RobotsMiddleware()
+    robots_middleware = robotware.RobotsMiddleware(
+        cache=robotware.bounded_robots_cache_class()()
+    )
     adapter.register(robots_middleware)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
@@ -41,7 +44,9 @@ def session():
 def make_middleware_fixture(rules):
     @pytest.fixture
     def fixture():
-        middleware = robotware.RobotsMiddleware()
+        middleware = robotware.RobotsMiddleware(
+            cache=robotware.bounded_robots_cache_class()()
+        )
         middleware.cache.add(
             Rules(
                 'http://test.com/robots.txt',
@@ -59,6 +64,11 @@ delay_middleware = make_middleware_fixture('''
     Crawl-Delay: 1
 ''')
 
+subsecond_middleware = make_middleware_fixture('''
+    User-agent: robot
+    Crawl-Delay: 0.5
+''')
+
 no_delay_middleware = make_middleware_fixture('''
     User-agent: robot
     Disallow: /blocked
@@ -77,6 +87,14 @@ def robots_fixture():
         ''',
     )
 
+@pytest.fixture
+def error_fixture():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://error.com/robots.txt',
+        status=500,
+    )
+
 @pytest.fixture
 def plain_fixture():
     httpretty.register_uri(
@@ -102,13 +120,63 @@ def test_check_crawl_delay_none(no_delay_middleware):
 
 
 def test_check_crawl_delay_ok(delay_middleware, monkeypatch):
-    now = datetime.datetime.utcnow()
-    utils.mock_datetime(monkeypatch, utcnow=now)
+    clock = utils.mock_clock(monkeypatch, robotware)
     delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
-    assert delay_middleware.visited['robot']['test.com'] == now
+    assert delay_middleware.visited['robot']['test.com'] == clock.now
     assert delay_middleware.visited['human'] == {}
 
 
+def test_check_crawl_delay_subsecond(subsecond_middleware, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
+    subsecond_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    clock.now += 0.4
+    with pytest.raises(robotware.RobotsThrottledError):
+        subsecond_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    clock.now += 0.2
+    subsecond_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+
+
+def test_check_crawl_delay_schedule(delay_middleware, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
+    delay_middleware.schedule = True
+    for _ in range(3):
+        delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    assert clock.sleeps == [1, 1]
+
+
+def test_reserve_crawl_delay_queues(delay_middleware, monkeypatch):
+    utils.mock_clock(monkeypatch, robotware)
+    delay_middleware.schedule = True
+    waits = [
+        delay_middleware.reserve_crawl_delay('http://test.com/plain', 'robot')
+        for _ in range(3)
+    ]
+    assert waits == [0, 1, 2]
+
+
+def test_check_crawl_delay_max_wait(delay_middleware, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
+    delay_middleware.schedule = True
+    delay_middleware.max_wait = 0.5
+    delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    with pytest.raises(robotware.RobotsThrottledError):
+        delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    clock.now += 0.75
+    delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+    assert clock.sleeps == [0.25]
+
+
+def test_next_allowed(delay_middleware, no_delay_middleware, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
+    url = 'http://test.com/plain'
+    assert delay_middleware.next_allowed(url, 'robot') == clock.now
+    delay_middleware.check_crawl_delay(url, 'robot')
+    assert delay_middleware.next_allowed(url, 'robot') == clock.now + 1
+    assert delay_middleware.next_allowed(url, 'human') == clock.now
+    no_delay_middleware.check_crawl_delay(url, 'robot')
+    assert no_delay_middleware.next_allowed(url, 'robot') == clock.now
+
+
 def test_check_crawl_delay_throttled(delay_middleware):
     delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
     delay_middleware.check_crawl_delay('http://test.com/plain', 'human')
@@ -116,8 +184,99 @@ def test_check_crawl_delay_throttled(delay_middleware):
         delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
 
 
+def test_check_crawl_delay_concurrent(delay_middleware):
+    passed = []
+
+    def worker():
+        try:
+            delay_middleware.check_crawl_delay('http://test.com/plain', 'robot')
+            passed.append(1)
+        except robotware.RobotsThrottledError:
+            pass
+
+    workers = [threading.Thread(target=worker) for _ in range(32)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert len(passed) == 1
+
+
+def make_rules(host, expires):
+    return Rules('http://{0}/robots.txt'.format(host), httplib.OK, '', expires)
+
+
+def test_shared_cache():
+    first, second = robotware.RobotsMiddleware(), robotware.RobotsMiddleware()
+    assert first.cache is second.cache is robotware.shared_robots_cache()
+
+
+def test_private_cache():
+    middleware = robotware.RobotsMiddleware(capacity=5)
+    assert middleware.cache is not robotware.shared_robots_cache()
+    assert middleware.cache.capacity == 5
+
+
+def test_private_cache_positional():
+    middleware = robotware.RobotsMiddleware(5, capacity=3, schedule=True)
+    assert middleware.cache.args == (5, )
+    assert middleware.cache.capacity == 3
+    assert middleware.schedule
+
+
+def test_cache_capacity():
+    cache = robotware.bounded_robots_cache_class()(capacity=2)
+    expires = time.time() + 60
+    cache.add(make_rules('first.com', expires))
+    cache.add(make_rules('second.com', expires))
+    cache.find('http://first.com/page')
+    cache.add(make_rules('third.com', expires))
+    assert len(cache) == 2
+    assert cache.find('http://first.com/page') is not None
+    assert cache.find('http://second.com/page') is None
+
+
+def test_cache_expiry():
+    cache = robotware.bounded_robots_cache_class()()
+    cache.add(make_rules('test.com', time.time() - 1))
+    assert cache.find('http://test.com/page') is None
+
+
 # Integration tests
 
+@pytest.mark.httpretty
+def test_cache_error(error_fixture):
+    cache = robotware.bounded_robots_cache_class()()
+    with pytest.raises(ReppyException):
+        cache.allowed('http://error.com/page', 'robot')
+    with pytest.raises(ReppyException):
+        cache.allowed('http://error.com/other', 'robot')
+    assert len(httpretty.latest_requests()) == 1
+
+
+@pytest.mark.httpretty
+def test_cache_error_expires(error_fixture, monkeypatch):
+    cache = robotware.bounded_robots_cache_class()(error_ttl=10)
+    with pytest.raises(ReppyException):
+        cache.allowed('http://error.com/page', 'robot')
+    later = time.time() + 20
+    monkeypatch.setattr(time, 'time', lambda: later)
+    with pytest.raises(ReppyException):
+        cache.allowed('http://error.com/page', 'robot')
+    assert len(httpretty.latest_requests()) == 2
+
+
+@pytest.mark.httpretty
+def test_prefetch(robots_fixture, error_fixture):
+    cache = robotware.bounded_robots_cache_class()()
+    results = cache.prefetch(['test.com', 'http://error.com'])
+    assert isinstance(results[0], Rules)
+    assert isinstance(results[1], robotware.FetchFailure)
+    assert len(cache) == 2
+    assert not cache.allowed('http://test.com/blocked', 'robot')
+    assert len(httpretty.latest_requests()) == 2
+
+
 @pytest.mark.httpretty
 def test_plain(session, robots_fixture, plain_fixture):
     session.get('http://test.com/plain')
@@ -136,10 +295,24 @@ def test_disallow_allowed_agent(session, robots_fixture, blocked_fixture):
 
 @pytest.mark.httpretty
 def test_delay(session, robots_fixture, plain_fixture, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
     session.get('http://test.com/plain')
     session.get('http://test.com/plain', headers={'User-Agent': 'human'})
     with pytest.raises(robotware.RobotsThrottledError):
         session.get('http://test.com/plain')
-    now = datetime.datetime.utcnow() + relativedelta(seconds=5)
-    utils.mock_datetime(monkeypatch, utcnow=now)
+    clock.now += 5
+    session.get('http://test.com/plain')
+
+
+@pytest.mark.httpretty
+def test_delay_schedule(robots_fixture, plain_fixture, monkeypatch):
+    clock = utils.mock_clock(monkeypatch, robotware)
+    session = requests.Session()
+    session.headers['User-Agent'] = 'robot'
+    middleware = robotware.RobotsMiddleware(
+        cache=robotware.bounded_robots_cache_class()(), schedule=True,
+    )
+    session.mount('http://', MiddlewareHTTPAdapter([middleware]))
+    session.get('http://test.com/plain')
     session.get('http://test.com/plain')
+    assert clock.sleeps == [1]
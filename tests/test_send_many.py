@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import time
+import threading
+
+import requests
+
+from requests_middleware.middleware import MiddlewareHTTPAdapter, BaseMiddleware
+from requests_middleware.contrib import coalesceware, throttleware
+
+from .test_middleware import LocalMiddleware
+from .utils import Handler, Server, serve
+
+
+class CountingServer(Server):
+
+    def __init__(self, *args):
+        Server.__init__(self, *args)
+        self.active = 0
+        self.max_active = 0
+        self.arrivals = []
+        self.lock = threading.Lock()
+
+
+class SlowHandler(Handler):
+
+    def body(self):
+        server = self.server
+        with server.lock:
+            server.arrivals.append(time.time())
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(0.05)
+        with server.lock:
+            server.active -= 1
+        return self.path.encode('ascii')
+
+
+class ThreadMiddleware(BaseMiddleware):
+
+    def __init__(self):
+        self.sent = []
+        self.built = []
+
+    def before_send(self, request, *args, **kwargs):
+        self.sent.append(threading.current_thread())
+
+    def after_build_response(self, req, resp, response):
+        self.built.append(threading.current_thread())
+        return response
+
+
+class LocalPathMiddleware(LocalMiddleware):
+
+    def before_send(self, request, *args, **kwargs):
+        if request.url.endswith('/local'):
+            return super(LocalPathMiddleware, self).before_send(request)
+
+
+@pytest.fixture
+def server():
+    with serve(SlowHandler, CountingServer) as server:
+        yield server
+
+
+def prepared(url):
+    return requests.Request('GET', url).prepare()
+
+
+def prepare(server, *paths):
+    return [
+        prepared('http://127.0.0.1:{0}{1}'.format(
+            server.server_address[1], path,
+        ))
+        for path in paths
+    ]
+
+
+# Integration tests
+
+def test_send_many(server):
+    adapter = MiddlewareHTTPAdapter(pool_maxsize=4)
+    paths = ['/{0}'.format(index) for index in range(12)]
+    responses = list(adapter.send_many(prepare(server, *paths), timeout=5))
+    assert sorted(response.text for response in responses) == sorted(paths)
+    assert 1 < server.max_active <= 4
+
+
+def test_send_many_workers(server):
+    adapter = MiddlewareHTTPAdapter(pool_maxsize=4)
+    batch = prepare(server, '/1', '/2', '/3')
+    assert len(list(adapter.send_many(batch, workers=1))) == 3
+    assert server.max_active == 1
+
+
+def test_send_many_hooks(server):
+    middleware = ThreadMiddleware()
+    adapter = MiddlewareHTTPAdapter([middleware, LocalPathMiddleware()])
+    batch = prepare(server, '/1', '/local', '/2')
+    responses = list(adapter.send_many(batch))
+    assert sorted(response.text for response in responses) == [
+        '/1', '/2', 'local',
+    ]
+    assert len(middleware.sent) == 3
+    assert len(middleware.built) == 2
+    assert threading.current_thread() not in middleware.sent
+    assert threading.current_thread() not in middleware.built
+
+
+def test_send_many_throttled(server):
+    throttler = throttleware.TokenBucketThrottler(20, block=True)
+    adapter = MiddlewareHTTPAdapter([throttleware.ThrottleMiddleware(throttler)])
+    batch = prepare(server, '/1', '/2', '/3', '/4')
+    assert len(list(adapter.send_many(batch))) == 4
+    arrivals = sorted(server.arrivals)
+    gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    assert min(gaps) > 0.03
+
+
+def test_send_many_coalesced(server):
+    middleware = coalesceware.CoalesceMiddleware(timeout=5)
+    adapter = MiddlewareHTTPAdapter([middleware], pool_maxsize=4)
+    start = time.time()
+    responses = list(adapter.send_many(prepare(server, '/1', '/1')))
+    assert time.time() - start < 1
+    assert [response.text for response in responses] == ['/1', '/1']
+    assert len(server.arrivals) == 1
+
+
+def test_send_many_errors(server):
+    adapter = MiddlewareHTTPAdapter()
+    batch = prepare(server, '/1') + [prepared('http://127.0.0.1:1/')]
+    results = list(adapter.send_many(batch, return_exceptions=True))
+    errors = [
+        result for result in results if isinstance(result, Exception)
+    ]
+    assert len(results) == 2
+    assert len(errors) == 1
+    assert isinstance(errors[0], requests.ConnectionError)
+    with pytest.raises(requests.ConnectionError):
+        list(adapter.send_many([prepared('http://127.0.0.1:1/')]))
+
+
+def test_send_many_recovers(server):
+    recovered = requests.Response()
+    recovered.status_code = 299
+
+    class RecoverMiddleware(BaseMiddleware):
+        def on_send_error(self, request, error):
+            return recovered
+
+    adapter = MiddlewareHTTPAdapter([RecoverMiddleware()])
+    batch = [prepared('http://127.0.0.1:1/')]
+    assert list(adapter.send_many(batch)) == [recovered]
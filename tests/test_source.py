@@ -2,21 +2,66 @@
 
 import pytest
 
-import requests
+import socket
+
+import six
 
 from requests_middleware.middleware import MiddlewareHTTPAdapter
 from requests_middleware.contrib import sourceware
 
+from .utils import Handler, make_session, serve
+
+
+ADDRESSES = ['127.0.0.1', '127.0.0.2', '127.0.0.3']
+
 
 @pytest.fixture
 def session():
-    session = requests.Session()
-    source_middleware = sourceware.SourceMiddleware('localhost', 8080)
-    middlewares = [source_middleware]
-    adapter = MiddlewareHTTPAdapter(middlewares=middlewares)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+    return make_session(sourceware.SourceMiddleware('localhost', 8080))
+
+
+class StubPool(object):
+
+    def __init__(self, maxsize):
+        self.pool = six.moves.queue.LifoQueue(maxsize)
+        for _ in range(maxsize):
+            self.pool.put(None)
+
+
+# Unit tests
+
+def test_rotating_source_pools_not_evicted():
+    middleware = sourceware.RotatingSourceMiddleware(ADDRESSES)
+    adapter = MiddlewareHTTPAdapter([middleware], pool_connections=2)
+    poolmanager = adapter.poolmanager
+    pools = set()
+    for _ in range(2):
+        for host in ('one.test', 'two.test'):
+            for _ in ADDRESSES:
+                pools.add(poolmanager.connection_from_host(host, 80, 'http'))
+    assert len(pools) == 6
+    assert len(poolmanager.pools) == 6
+
+
+def test_least_loaded_fetches_one_pool():
+    middleware = sourceware.RotatingSourceMiddleware(
+        ADDRESSES, sourceware.LEAST_LOADED,
+    )
+    fetched = []
+
+    def connection_from_host(host, port, scheme, pool_kwargs=None):
+        fetched.append(pool_kwargs['source_address'])
+        return StubPool(2)
+
+    pools = [
+        middleware.connection_from_host(connection_from_host, 'one.test', 80)
+        for _ in ADDRESSES
+    ]
+    assert fetched == [(address, 0) for address in ADDRESSES]
+    # Busy first address: the next turn, starting there, skips it
+    pools[0].pool.get()
+    middleware.connection_from_host(connection_from_host, 'one.test', 80)
+    assert fetched[3:] == [(ADDRESSES[1], 0)]
 
 
 # Integration tests
@@ -26,3 +71,56 @@ def test_source(session, page_fixture):
     resp = session.get('http://test.com/page')
     pool_kwargs = resp.connection.poolmanager.connection_pool_kw
     assert pool_kwargs.get('source_address') == ('localhost', 8080)
+
+
+class AddressHandler(Handler):
+
+    def body(self):
+        return self.client_address[0].encode('ascii')
+
+
+@pytest.fixture
+def server():
+    try:
+        socket.socket().bind((ADDRESSES[-1], 0))
+    except (IOError, OSError):
+        pytest.skip('Extra loopback addresses are not available.')
+    with serve(AddressHandler) as server:
+        yield 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+
+def rotating_session(strategy):
+    return make_session(
+        sourceware.RotatingSourceMiddleware(ADDRESSES, strategy),
+    )
+
+
+def test_rotating_source_invalid():
+    with pytest.raises(ValueError):
+        sourceware.RotatingSourceMiddleware(ADDRESSES, 'random')
+    with pytest.raises(ValueError):
+        sourceware.RotatingSourceMiddleware([])
+
+
+def test_rotating_source_round_robin(server):
+    session = rotating_session(sourceware.ROUND_ROBIN)
+    sources = [session.get(server).text for _ in range(6)]
+    assert sources == ADDRESSES * 2
+
+
+def test_rotating_source_pools(server):
+    session = rotating_session(sourceware.ROUND_ROBIN)
+    for _ in range(6):
+        session.get(server)
+    pools = session.get_adapter('http://').poolmanager.pools
+    sources = sorted(key.key_source_address for key in pools.keys())
+    assert sources == [(address, 0) for address in ADDRESSES]
+
+
+def test_rotating_source_least_loaded(server):
+    session = rotating_session(sourceware.LEAST_LOADED)
+    held = session.get(server, stream=True)
+    assert [session.get(server).text for _ in range(2)] == ADDRESSES[1:]
+    # The connection from the first address is still checked out
+    assert session.get(server).text == ADDRESSES[1]
+    assert held.text == ADDRESSES[0]
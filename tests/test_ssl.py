@@ -3,21 +3,19 @@
 import pytest
 
 import ssl
+import subprocess
+
 import requests
 
 from requests_middleware.middleware import MiddlewareHTTPAdapter
 from requests_middleware.contrib import sslware
 
+from .utils import Handler, make_session, serve
+
 
 @pytest.fixture
 def session():
-    session = requests.Session()
-    ssl_middleware = sslware.SSLMiddleware(ssl.PROTOCOL_TLSv1)
-    middlewares = [ssl_middleware]
-    adapter = MiddlewareHTTPAdapter(middlewares=middlewares)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+    return make_session(sslware.SSLMiddleware(ssl.PROTOCOL_TLSv1))
 
 
 # Integration tests
@@ -27,3 +25,103 @@ def test_ssl(session, page_fixture):
     resp = session.get('http://test.com/page')
     pool_kwargs = resp.connection.poolmanager.connection_pool_kw
     assert pool_kwargs.get('ssl_version') == ssl.PROTOCOL_TLSv1
+
+
+class ClosingHandler(Handler):
+
+    response_headers = [('Connection', 'close')]
+
+
+@pytest.fixture
+def cert(tmpdir):
+    cert, key = str(tmpdir.join('cert.pem')), str(tmpdir.join('key.pem'))
+    try:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key, '-out', cert, '-days', '1',
+            '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost',
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip('openssl is not available.')
+    return cert, key
+
+
+@pytest.fixture
+def server(cert):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*cert)
+    with serve(ClosingHandler, ssl_context=context) as server:
+        yield 'https://localhost:{0}/'.format(server.server_address[1])
+
+
+# Unit tests
+
+def test_context_shared():
+    middleware = sslware.SSLMiddleware(ciphers='ECDHE+AESGCM')
+    adapter = MiddlewareHTTPAdapter([middleware])
+    first = adapter.poolmanager.connection_from_host(
+        'one.com', 443, 'https', pool_kwargs={'cert_reqs': 'CERT_REQUIRED'},
+    )
+    second = adapter.poolmanager.connection_from_host(
+        'two.com', 443, 'https', pool_kwargs={'cert_reqs': 'CERT_REQUIRED'},
+    )
+    unverified = adapter.poolmanager.connection_from_host(
+        'two.com', 443, 'https', pool_kwargs={'cert_reqs': 'CERT_NONE'},
+    )
+    context = first.conn_kw['ssl_context']
+    assert second.conn_kw['ssl_context'] is context
+    assert context.verify_mode == ssl.CERT_REQUIRED
+    unverified = unverified.conn_kw['ssl_context']
+    assert unverified is not context
+    assert unverified.verify_mode == ssl.CERT_NONE
+    assert not unverified.check_hostname
+
+
+def test_context_http_untouched():
+    adapter = MiddlewareHTTPAdapter([sslware.SSLMiddleware()])
+    pool = adapter.poolmanager.connection_from_host('one.com', 80, 'http')
+    assert 'ssl_context' not in pool.conn_kw
+
+
+def test_context_skips_reloading(monkeypatch):
+    context = sslware.SSLMiddleware().context_for({})
+    calls = []
+    monkeypatch.setattr(
+        ssl.SSLContext, 'load_verify_locations',
+        lambda *args, **kwargs: calls.append(args),
+    )
+    context.load_verify_locations('/path/to/bundle.pem')
+    context.set_alpn_protocols(['h2'])
+    assert calls == []
+
+
+# Integration tests
+
+def test_session_resumed(server, cert):
+    middleware = sslware.SSLMiddleware()
+    session = make_session(middleware)
+    for _ in range(3):
+        assert session.get(server, verify=cert[0]).text == 'content'
+    assert middleware.stats() == {'handshakes': 3, 'resumed': 2}
+    assert len(middleware.contexts) == 1
+
+
+def test_session_reuse_disabled(server, cert):
+    middleware = sslware.SSLMiddleware(max_sessions=0)
+    session = make_session(middleware)
+    for _ in range(2):
+        assert session.get(server, verify=cert[0]).text == 'content'
+    assert middleware.stats() == {'handshakes': 2, 'resumed': 0}
+
+
+def test_ca_certs(server, cert):
+    session = make_session(sslware.SSLMiddleware(ca_certs=cert[0]))
+    assert session.get(server).text == 'content'
+
+
+def test_verify_fails(server):
+    session = make_session(sslware.SSLMiddleware())
+    with pytest.raises(requests.exceptions.SSLError):
+        session.get(server)
+    assert session.get(server, verify=False).text == 'content'
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import httpretty
 
 import datetime
+import threading
 import requests
 from dateutil.relativedelta import relativedelta
 
@@ -66,6 +68,241 @@ def test_throttle_per_hour(throttle_per_hour, monkeypatch):
     throttle_per_hour.check(None)
 
 
+def test_token_bucket_burst(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.TokenBucketThrottler(rate=2, burst=3)
+    for _ in range(3):
+        throttler.check(None)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(None)
+    clock.now += 0.5
+    throttler.check(None)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(None)
+
+
+def test_token_bucket_refill_capped(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.TokenBucketThrottler(rate=10, burst=2)
+    clock.now += 60
+    throttler.check(None)
+    throttler.check(None)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(None)
+
+
+def test_token_bucket_block(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.TokenBucketThrottler(rate=4, block=True)
+    for _ in range(3):
+        throttler.check(None)
+    assert clock.sleeps == [0.25, 0.25]
+
+
+def test_token_bucket_block_queues_reservations(monkeypatch):
+    utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.TokenBucketThrottler(rate=4, block=True)
+    waits = [throttler.reserve() for _ in range(3)]
+    assert waits == [0, 0.25, 0.5]
+
+
+def test_token_bucket_max_wait(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.TokenBucketThrottler(
+        rate=1, block=True, max_wait=0.5,
+    )
+    throttler.check(None)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(None)
+    assert clock.sleeps == []
+    clock.now += 0.6
+    throttler.check(None)
+    assert clock.sleeps == [pytest.approx(0.4)]
+
+
+def test_token_bucket_invalid():
+    with pytest.raises(ValueError):
+        throttleware.TokenBucketThrottler(rate=0)
+    with pytest.raises(ValueError):
+        throttleware.TokenBucketThrottler(rate=1, burst=0)
+
+
+def make_request(url):
+    return requests.Request('GET', url).prepare()
+
+
+def make_response(status=200, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return response
+
+
+def adaptive_send(throttler, status=200, headers=None, latency=0, clock=None):
+    request = make_request('http://test.com/page')
+    throttler.check(request)
+    if clock is not None:
+        clock.now += latency
+    throttler.store(request, None, make_response(status, headers))
+
+
+def test_adaptive_increase(monkeypatch):
+    utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.AdaptiveThrottler(
+        rate=2, max_rate=2.6, block=True,
+    )
+    adaptive_send(throttler)
+    assert throttler.rate == 2.5
+    adaptive_send(throttler, status=404)
+    assert throttler.rate == 2.5
+    adaptive_send(throttler)
+    assert throttler.rate == 2.6
+
+
+def test_adaptive_decrease_once_per_window(monkeypatch):
+    utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.AdaptiveThrottler(
+        rate=8, min_rate=1.5, burst=3, block=True,
+    )
+    requests_ = [make_request('http://test.com/page') for _ in range(3)]
+    for request in requests_:
+        throttler.check(request)
+    for request in requests_:
+        throttler.store(request, None, make_response(429))
+    assert throttler.rate == 4
+    adaptive_send(throttler, status=503)
+    assert throttler.rate == 2
+    adaptive_send(throttler, status=503)
+    assert throttler.rate == 1.5
+
+
+def test_adaptive_retry_after(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.AdaptiveThrottler(rate=4, burst=4)
+    adaptive_send(throttler, headers={'Retry-After': '10'})
+    assert throttler.rate == 2
+    clock.now += 9.9
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(None)
+    clock.now += 0.1
+    throttler.check(None)
+
+
+def test_adaptive_latency(monkeypatch):
+    clock = utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.AdaptiveThrottler(
+        rate=4, latency_target=1, block=True,
+    )
+    adaptive_send(throttler, latency=0.5, clock=clock)
+    assert throttler.rate == 4.25
+    adaptive_send(throttler, latency=2, clock=clock)
+    assert throttler.rate == 2.125
+
+
+def test_adaptive_errors(monkeypatch):
+    utils.mock_clock(monkeypatch, throttleware)
+    throttler = throttleware.AdaptiveThrottler(rate=4)
+    request = make_request('http://test.com/page')
+    throttler.error(request, throttleware.ThrottleError())
+    assert throttler.rate == 4
+    throttler.error(request, requests.exceptions.ConnectTimeout())
+    assert throttler.rate == 2
+
+
+def test_adaptive_invalid():
+    with pytest.raises(ValueError):
+        throttleware.AdaptiveThrottler(rate=1, min_rate=2)
+    with pytest.raises(ValueError):
+        throttleware.AdaptiveThrottler(decrease=1)
+
+
+def test_host_keys():
+    request = make_request('https://Test.com:8443/page')
+    assert throttleware.host_key(request) == 'test.com'
+    assert throttleware.scheme_host_key(request) == 'https://test.com:8443'
+
+
+def test_keyed_throttler_independent_hosts():
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.DelayThrottler(5)
+    )
+    first = make_request('http://first.com/page')
+    second = make_request('http://second.com/page')
+    throttler.check(first)
+    throttler.check(second)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(first)
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(make_request('http://first.com/other'))
+
+
+def test_keyed_throttler_custom_key():
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.DelayThrottler(5),
+        key=lambda request: request.method,
+    )
+    throttler.check(make_request('http://first.com/page'))
+    with pytest.raises(throttleware.ThrottleError):
+        throttler.check(make_request('http://second.com/page'))
+
+
+def test_keyed_throttler_evicts_lru():
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.DelayThrottler(5), max_keys=2, shards=1,
+    )
+    first = make_request('http://first.com/')
+    throttler.check(first)
+    throttler.check(make_request('http://second.com/'))
+    throttler.check(make_request('http://third.com/'))
+    assert len(throttler) == 2
+    throttler.check(first)
+
+
+def test_keyed_throttler_fewer_keys_than_shards():
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.DelayThrottler(5), max_keys=4,
+    )
+    for index in range(64):
+        throttler.check(make_request('http://{0}.com/'.format(index)))
+    assert len(throttler.shards) == 4
+    assert len(throttler) <= 4
+
+
+def count_concurrent_passes(throttler, threads=32, attempts=20):
+    passed = []
+    barrier = threading.Event()
+
+    def worker():
+        barrier.wait()
+        for _ in range(attempts):
+            try:
+                throttler.check(None)
+                passed.append(1)
+            except throttleware.ThrottleError:
+                pass
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.set()
+    for thread in workers:
+        thread.join()
+    return len(passed)
+
+
+def test_throttle_delay_concurrent(throttle_delay):
+    assert count_concurrent_passes(throttle_delay) == 1
+
+
+def test_throttle_per_hour_concurrent(throttle_per_hour):
+    assert count_concurrent_passes(throttle_per_hour) == 5
+
+
+def test_token_bucket_concurrent():
+    throttler = throttleware.TokenBucketThrottler(rate=0.001, burst=5)
+    assert count_concurrent_passes(throttler) == 5
+
+
 # Integration tests
 
 @pytest.mark.httpretty
@@ -89,3 +326,44 @@ def test_throttle_per_hour_integration(throttle_per_hour_session, page_fixture,
     now = datetime.datetime.utcnow() + relativedelta(hours=2)
     utils.mock_datetime(monkeypatch, utcnow=now)
     throttle_per_hour_session.get('http://test.com/page')
+
+
+@pytest.mark.httpretty
+def test_keyed_throttler_integration(page_fixture):
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://other.com/page',
+        body='content',
+    )
+    session = requests.Session()
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.DelayThrottler(5)
+    )
+    adapter = MiddlewareHTTPAdapter([throttleware.ThrottleMiddleware(throttler)])
+    session.mount('http://', adapter)
+    session.get('http://test.com/page')
+    session.get('http://other.com/page')
+    with pytest.raises(throttleware.ThrottleError):
+        session.get('http://test.com/page')
+
+
+@pytest.mark.httpretty
+def test_adaptive_throttler_integration():
+    httpretty.register_uri(
+        httpretty.GET,
+        'http://test.com/page',
+        responses=[
+            httpretty.Response(body='', status=429),
+            httpretty.Response(body='content'),
+        ],
+    )
+    session = requests.Session()
+    throttler = throttleware.KeyedThrottler(
+        lambda: throttleware.AdaptiveThrottler(rate=10, burst=2)
+    )
+    adapter = MiddlewareHTTPAdapter([throttleware.ThrottleMiddleware(throttler)])
+    session.mount('http://', adapter)
+    session.get('http://test.com/page')
+    assert throttler.get('test.com').rate == 5
+    session.get('http://test.com/page')
+    assert throttler.get('test.com').rate == 5.2
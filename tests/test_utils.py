@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from requests_middleware import utils
+
+
+# Unit tests
+
+def test_stale_windows():
+    headers = {
+        'Cache-Control': 'max-age=10, stale-while-revalidate=30, '
+                         'Stale-If-Error="60"',
+    }
+    assert utils.stale_windows(headers) == (30, 60)
+
+
+def test_stale_windows_missing_or_invalid():
+    assert utils.stale_windows({}) == (None, None)
+    headers = {'Cache-Control': 'stale-while-revalidate=soon'}
+    assert utils.stale_windows(headers) == (None, None)
+
+
+def test_retry_after(monkeypatch):
+    assert utils.retry_after({'Retry-After': ' 120 '}) == 120
+    monkeypatch.setattr(utils.time, 'time', lambda: 784111717.0)
+    headers = {'Retry-After': 'Sun, 06 Nov 1994 08:49:37 GMT'}
+    assert utils.retry_after(headers) == 60
+    headers = {'Retry-After': 'Sun, 06 Nov 1994 08:47:37 GMT'}
+    assert utils.retry_after(headers) == 0
+
+
+def test_retry_after_missing_or_invalid():
+    assert utils.retry_after({}) is None
+    assert utils.retry_after({'Retry-After': 'soon'}) is None
+    assert utils.retry_after({'Retry-After': '-1'}) is None
+
+
+def test_revalidator_one_per_key():
+    revalidator = utils.Revalidator(workers=2)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def refresh(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+
+    assert revalidator.submit('key', refresh, 'key')
+    assert started.wait(5)
+    assert not revalidator.submit('key', refresh, 'key')
+    release.set()
+    assert revalidator.wait(5)
+    assert revalidator.submit('key', refresh, 'key')
+    assert revalidator.wait(5)
+    assert calls == ['key', 'key']
+
+
+def test_revalidator_ignores_errors():
+    revalidator = utils.Revalidator(workers=1)
+
+    def refresh():
+        raise RuntimeError('failed')
+
+    revalidator.submit('key', refresh)
+    assert revalidator.wait(5)
+    assert not revalidator.pending
+
+
+def test_rolling_window():
+    window = utils.RollingWindow(10)
+    window.add(100.5, 1, 0)
+    window.add(100.9, 1, 1)
+    window.add(105, 1, 0)
+    assert window.totals == [3, 1]
+    window.expire(110)
+    assert window.totals == [1, 0]
+    window.clear()
+    assert window.totals == [0, 0]
@@ -3,6 +3,13 @@
 import six
 import mock
 import datetime
+import threading
+import contextlib
+
+import requests
+from six.moves import BaseHTTPServer, socketserver
+
+from requests_middleware.middleware import MiddlewareHTTPAdapter
 
 
 def mock_datetime(monkeypatch, **kwargs):
@@ -11,3 +18,82 @@ def mock_datetime(monkeypatch, **kwargs):
         method = getattr(fake, key)
         method.return_value = value
     monkeypatch.setattr(datetime, 'datetime', fake)
+
+
+class FakeClock(object):
+    """Monotonic clock whose `sleep` advances time instead of blocking."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def mock_clock(monkeypatch, module):
+    clock = FakeClock()
+    monkeypatch.setattr(module.compat, 'monotonic', clock)
+    monkeypatch.setattr(module.time, 'sleep', clock.sleep)
+    return clock
+
+
+def make_session(*middlewares):
+    """Return a session sending HTTP and HTTPS requests through a
+    `MiddlewareHTTPAdapter` holding `middlewares`.
+    """
+    session = requests.Session()
+    adapter = MiddlewareHTTPAdapter(list(middlewares))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer GET requests with 200 and the bytes returned by `body`, plus
+    `response_headers`.
+    """
+    protocol_version = 'HTTP/1.1'
+    response_headers = ()
+
+    def body(self):
+        return b'content'
+
+    def do_GET(self):
+        body = self.body()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.response_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serve(handler=Handler, server_class=Server, ssl_context=None):
+    """Run a threaded HTTP server on a free local port, yielding it."""
+    server = server_class(('127.0.0.1', 0), handler)
+    if ssl_context is not None:
+        server.socket = ssl_context.wrap_socket(
+            server.socket, server_side=True,
+        )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()